@@ -14,9 +14,14 @@
 7. Monthly analytics dashboard
 8. Capital tracking & profit calculator
 9. Legal disclaimers on every page
-10. PWA installable on phones
+10. PWA installable on phones, opens offline from a per-deploy cache
 11. Mobile optimized
 12. Track record & performance stats
+13. Live mark-to-market & auto-close on target/stop (set PRICE_FEED)
+14. Full-text search & per-symbol history
+15. Bulk CSV/JSONL import & batch close (admin page or flask import-recs)
+16. Streaming CSV exports of recommendations, payments & users
+17. Append-only event log with audit history (flask archive-events)
 
 🚀 QUICK START:
 1. Copy this ENTIRE file
@@ -32,6 +37,8 @@
 - Flask
 - Werkzeug
 - reportlab (for invoices)
+- Pillow (for chart thumbnails)
+- numpy (for the portfolio simulator)
 
 💳 PAYMENT SETUP:
 1. Sign up at razorpay.com
@@ -55,14 +62,29 @@
 🎉 YOU'RE READY TO LAUNCH!
 """
 
-from flask import Flask, render_template_string, request, redirect, url_for, session, flash, jsonify, send_file
+from flask import Flask, abort, render_template, request, redirect, url_for, session, flash, jsonify, send_file, g, has_app_context, has_request_context, make_response, Response, stream_with_context, before_render_template, template_rendered, message_flashed
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from jinja2 import DictLoader
 import sqlite3
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 import os
 import secrets
+import threading
+import io
+import csv
+import zipfile
+import gzip
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import queue
+from collections import deque, OrderedDict
+import click
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import time
+import hashlib
+import json
+import re
 
 try:
     from reportlab.lib.pagesizes import letter
@@ -73,86 +95,529 @@ try:
 except:
     HAS_PDF = False
 
+try:
+    from PIL import Image, ImageOps
+    HAS_PIL = True
+except:
+    HAS_PIL = False
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except:
+    HAS_NUMPY = False
+
+try:
+    sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE probe USING fts5(x)')
+    HAS_FTS5 = True
+except sqlite3.OperationalError:
+    HAS_FTS5 = False
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
-os.makedirs('uploads/charts', exist_ok=True)
+CHART_DIR = 'uploads/charts'
+# Downscaled WebP copies served in the feeds, by name and max width in px
+CHART_VARIANTS = {'thumb': 480, 'medium': 1024}
+
+os.makedirs(CHART_DIR, exist_ok=True)
 os.makedirs('uploads/logo', exist_ok=True)
 
+INVOICE_DIR = 'invoices'
+# Settings printed on invoices, with their fallbacks; changing any of them
+# re-renders the PDFs
+INVOICE_SETTINGS = {'company_name': 'TradingPro', 'company_address': 'India', 'company_email': '', 'company_phone': ''}
+# Payment fields printed on invoices; nothing else feeds the cache key
+INVOICE_FIELDS = ('invoice_number', 'created_at', 'name', 'email', 'plan_type', 'original_amount', 'amount', 'discount_amount', 'coupon_code')
+# Bump when render_invoice_pdf changes so existing PDFs are re-rendered
+INVOICE_TEMPLATE_VERSION = 1
+INVOICE_EXPORT_WORKERS = int(os.environ.get('INVOICE_EXPORT_WORKERS', min(4, os.cpu_count() or 1)))
+
+os.makedirs(INVOICE_DIR, exist_ok=True)
+
 DATABASE = 'trading.db'
+LOGO_PATH = 'uploads/logo/logo.png'
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 16))
+
+# WAL lets readers proceed while a writer commits; the rest trades a little
+# durability on power loss for far fewer fsyncs and a larger page cache.
+DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA mmap_size=134217728',
+    'PRAGMA temp_store=MEMORY',
+)
+
+# Requests slower than this many ms are logged with their SQL; 0 turns it off
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 0))
+# When set, /metrics wants "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Events older than this move from the events table to gzipped JSONL files
+EVENT_RETENTION_DAYS = int(os.environ.get('EVENT_RETENTION_DAYS', 365))
+EVENT_ARCHIVE_DIR = os.environ.get('EVENT_ARCHIVE_DIR', 'archive/events')
+
+# ═══════════════════ METRICS ═══════════════════
+
+# A small in-process registry rendered in the Prometheus text format at
+# /metrics. Each gunicorn worker keeps its own numbers, so scrape every
+# worker (or run one) rather than relying on whichever answers.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+METRIC_HELP = {
+    'http_requests_total': ('counter', 'Requests served, by route, method and status.'),
+    'http_request_duration_seconds': ('histogram', 'Time to build the response, by route.'),
+    'http_request_queries': ('histogram', 'SQLite statements executed per request, by route.'),
+    'http_request_db_connections': ('histogram', 'Pooled connections taken per request, by route.'),
+    'template_render_seconds': ('histogram', 'Jinja render time, by template.'),
+    'invoice_pdf_seconds': ('histogram', 'Time to render one invoice PDF in this process.'),
+    'slow_requests_total': ('counter', 'Requests over SLOW_REQUEST_MS, by route.'),
+}
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[1][i] += 1
+            hist[2] += value
+            hist[3] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = labels + extra
+        if not pairs:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+    def render(self, gauges=()):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (v[0], list(v[1]), v[2], v[3])) for k, v in self._histograms.items())
+        lines, described = [], set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {METRIC_HELP.get(name, (kind, name))[1]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            describe(name, 'histogram')
+            for bound, n in zip(buckets, counts):
+                lines.append(f'{name}_bucket{self._labels(labels, (("le", bound),))} {n}')
+            lines.append(f'{name}_bucket{self._labels(labels, (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{self._labels(labels)} {total}')
+            lines.append(f'{name}_count{self._labels(labels)} {count}')
+        for name, help_text, value in gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# sqlite hands the trace callback statements with values filled in; the slow
+# log masks string literals so emails and hashes stay out of the logs
+SQL_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+def trace_sql(statement):
+    # sqlite3 trace callback, installed on every pooled connection
+    if has_request_context():
+        g.sql_count = g.get('sql_count', 0) + 1
+        if SLOW_REQUEST_MS:
+            g.setdefault('sql_log', []).append(statement)
+
+def request_route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = (('route', request_route()),)
+    queries = g.get('sql_count', 0)
+    metrics.inc('http_requests_total', route + (('method', request.method), ('status', response.status_code)))
+    metrics.observe('http_request_duration_seconds', elapsed, route)
+    metrics.observe('http_request_queries', queries, route, COUNT_BUCKETS)
+    metrics.observe('http_request_db_connections', g.get('db_connections', 0), route, COUNT_BUCKETS)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        metrics.inc('slow_requests_total', route)
+        app.logger.warning('slow request %s %s: %.1fms, %d queries, %.1fms rendering\n%s', request.method, request.full_path,
+                           elapsed * 1000, queries, g.get('render_seconds', 0) * 1000,
+                           '\n'.join('  ' + SQL_LITERAL.sub('?', ' '.join(sql.split())) for sql in g.get('sql_log', ())))
+    return response
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.setdefault('render_started', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def record_render_time(sender, template, context, **extra):
+    stack = g.get('render_started')
+    if stack:
+        elapsed = time.perf_counter() - stack.pop()
+        g.render_seconds = g.get('render_seconds', 0) + elapsed
+        metrics.observe('template_render_seconds', elapsed, (('template', template.name),))
 
 # ═══════════════════ DATABASE ═══════════════════
 
+class ConnectionPool:
+    def __init__(self, database, size=DB_POOL_SIZE):
+        self.database = database
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._stats = {'opened': 0, 'reused': 0, 'released': 0, 'discarded': 0, 'in_use': 0}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=10, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        conn.set_trace_callback(trace_sql)
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            self._stats['in_use'] += 1
+            if self._idle:
+                self._stats['reused'] += 1
+                return self._idle.pop()
+            self._stats['opened'] += 1
+        return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._stats['in_use'] -= 1
+            if len(self._idle) < self.size:
+                self._stats['released'] += 1
+                self._idle.append(conn)
+                return
+            self._stats['discarded'] += 1
+        conn.close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle), size=self.size)
+
+db_pool = ConnectionPool(DATABASE)
+_thread_db = threading.local()
+
 def get_db():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    # Inside a request the connection lives on g and goes back to the pool on
+    # teardown; background threads and startup code keep one per thread.
+    if has_app_context():
+        if 'db' not in g:
+            g.db = db_pool.acquire()
+            g.db_connections = g.get('db_connections', 0) + 1
+        return g.db
+    conn = getattr(_thread_db, 'conn', None)
+    if conn is None:
+        conn = _thread_db.conn = db_pool.acquire()
     return conn
 
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+# Each migration runs once, in order, inside its own transaction; the applied
+# version is kept in PRAGMA user_version. Steps are SQL strings or callables
+# taking the connection. Never edit a released migration, append a new one.
+MIGRATIONS = [
+    (1, [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            name TEXT,
+            phone TEXT,
+            is_admin INTEGER DEFAULT 0,
+            subscription_status TEXT DEFAULT 'inactive',
+            subscription_end_date TEXT,
+            capital REAL DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS recommendations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stock_name TEXT NOT NULL,
+            stock_symbol TEXT NOT NULL,
+            recommendation_type TEXT NOT NULL,
+            entry_price REAL NOT NULL,
+            target_price REAL,
+            stop_loss REAL,
+            status TEXT DEFAULT 'active',
+            exit_price REAL,
+            profit_loss_percent REAL,
+            notes TEXT,
+            chart_image TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount REAL NOT NULL,
+            original_amount REAL,
+            discount_amount REAL DEFAULT 0,
+            payment_id TEXT,
+            plan_type TEXT,
+            coupon_code TEXT,
+            status TEXT DEFAULT 'success',
+            invoice_number TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE NOT NULL,
+            value TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS coupons (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE NOT NULL,
+            discount_percent INTEGER NOT NULL,
+            valid_until TEXT,
+            max_uses INTEGER DEFAULT 0,
+            current_uses INTEGER DEFAULT 0,
+            active INTEGER DEFAULT 1,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ]),
+    (2, [
+        '''CREATE TABLE IF NOT EXISTS versions (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )''',
+        '''CREATE TABLE IF NOT EXISTS rec_stats (
+            bucket TEXT PRIMARY KEY,
+            trades INTEGER NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0,
+            sum_pl REAL NOT NULL DEFAULT 0,
+            best_pl REAL,
+            worst_pl REAL,
+            peak_pl REAL NOT NULL DEFAULT 0,
+            max_drawdown REAL NOT NULL DEFAULT 0
+        )''',
+        lambda db: rebuild_rec_stats(db),
+    ]),
+    (3, [
+        "ALTER TABLE recommendations ADD COLUMN created_month TEXT GENERATED ALWAYS AS (substr(created_at,1,7)) VIRTUAL",
+        'CREATE INDEX IF NOT EXISTS idx_recs_created ON recommendations(created_at, id)',
+        "CREATE INDEX IF NOT EXISTS idx_recs_closed_month ON recommendations(created_month, created_at) WHERE status='closed'",
+        "CREATE INDEX IF NOT EXISTS idx_recs_closed_updated ON recommendations(updated_at, id) WHERE status='closed'",
+        'CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments(user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_users_admin ON users(is_admin, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_users_subscription ON users(subscription_status, subscription_end_date)',
+        'CREATE INDEX IF NOT EXISTS idx_coupons_created ON coupons(created_at)',
+    ]),
+    (4, [
+        'CREATE INDEX IF NOT EXISTS idx_payments_created ON payments(created_at)',
+    ]),
+    (5, [
+        'ALTER TABLE recommendations ADD COLUMN chart_width INTEGER',
+        'ALTER TABLE recommendations ADD COLUMN chart_height INTEGER',
+    ]),
+    (6, [
+        "CREATE INDEX IF NOT EXISTS idx_recs_active ON recommendations(stock_symbol) WHERE status='active'",
+    ]),
+    (7, [
+        '''CREATE TABLE IF NOT EXISTS rec_events (id INTEGER PRIMARY KEY AUTOINCREMENT, rec_id INTEGER NOT NULL,
+           kind TEXT NOT NULL, payload TEXT NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    ]),
+    (8, [
+        'CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)',
+        '''CREATE TABLE IF NOT EXISTS subscription_events (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+           kind TEXT NOT NULL, end_date TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP)''',
+        'ALTER TABLE users ADD COLUMN renewal_reminded_for TEXT',
+        lambda db: recount_active_subscribers(db),
+    ]),
+    (9, [
+        'ALTER TABLE payments ADD COLUMN idempotency_key TEXT',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_idempotency ON payments(user_id, idempotency_key) WHERE idempotency_key IS NOT NULL',
+    ]),
+    (10, [
+        'CREATE TABLE IF NOT EXISTS invoice_sequences (fy TEXT PRIMARY KEY, last_value INTEGER NOT NULL DEFAULT 0)',
+        'ALTER TABLE payments ADD COLUMN legacy_invoice_number TEXT',
+        lambda db: renumber_duplicate_invoices(db),
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_invoice_number ON payments(invoice_number)',
+    ]),
+    (11, [
+        'ALTER TABLE recommendations ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE payments ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0',
+        lambda db: seed_row_versions(db, ('recommendations', 'payments')),
+        'CREATE INDEX IF NOT EXISTS idx_recs_row_version ON recommendations(row_version)',
+        'CREATE INDEX IF NOT EXISTS idx_payments_user_row_version ON payments(user_id, row_version)',
+    ]),
+    (12, [
+        'CREATE INDEX IF NOT EXISTS idx_recs_symbol ON recommendations(stock_symbol COLLATE NOCASE, created_at)',
+        lambda db: create_rec_search(db),
+    ]),
+    (13, [
+        'DROP TRIGGER IF EXISTS recs_fts_insert',
+        lambda db: create_rec_search(db),
+    ]),
+    (14, [
+        '''CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, at INTEGER NOT NULL, kind TEXT NOT NULL,
+           ref INTEGER, actor INTEGER, data TEXT)''',
+        'CREATE INDEX IF NOT EXISTS idx_events_ref ON events(ref, seq)',
+    ]),
+    (15, [
+        lambda db: recount_row_totals(db),
+    ]),
+    (16, [
+        'CREATE INDEX IF NOT EXISTS idx_recs_status_created ON recommendations(status, created_at)',
+    ]),
+    (17, [
+        'DROP TABLE IF EXISTS rec_events',
+        'DROP TABLE IF EXISTS subscription_events',
+    ]),
+]
+
+def migrate(db):
+    db.commit()
+    current = db.execute('PRAGMA user_version').fetchone()[0]
+    for version, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # another worker may have applied it while we waited for the lock
+            if db.execute('PRAGMA user_version').fetchone()[0] >= version:
+                db.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            db.execute(f'PRAGMA user_version = {version}')
+            db.commit()
+        except:
+            db.rollback()
+            raise
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+# Hot route queries, checked with EXPLAIN QUERY PLAN by 'flask --app app
+# check-query-plans'. Keep in step with the SQL in the views.
+ROUTE_QUERIES = [
+    ('index.recent', 'SELECT * FROM recommendations ORDER BY created_at DESC LIMIT 5', ()),
+    ('login.user', 'SELECT * FROM users WHERE email=?', ('a@b.c',)),
+    ('dashboard.user', 'SELECT * FROM users WHERE id=?', (1,)),
+    ('feed.first', 'SELECT * FROM recommendations ORDER BY created_at DESC, id DESC LIMIT 21', ()),
+    ('feed.next', 'SELECT * FROM recommendations WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 21', ('2024-01-01', 1)),
+    ('dashboard.payments', 'SELECT * FROM payments WHERE user_id=? ORDER BY created_at DESC LIMIT 5', (1,)),
+    ('subscribe.coupon', 'SELECT * FROM coupons WHERE code=? AND active=1', ('SAVE20',)),
+    ('admin.totals', "SELECT value FROM counters WHERE name='total_recommendations'", ()),
+    ('admin.users', 'SELECT * FROM users WHERE is_admin=0 AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 21', ('2024-01-01', 1)),
+    ('admin.payments', 'SELECT * FROM payments WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 21', ('2024-01-01', 1)),
+    ('admin.active', "SELECT value FROM counters WHERE name='active_subscribers'", ()),
+    ('symbol.history', 'SELECT * FROM recommendations WHERE stock_symbol = ? COLLATE NOCASE ORDER BY created_at DESC, id DESC LIMIT ?', ('REL', 21)),
+    ('search.filtered_edge', "SELECT r.created_at, r.id FROM recommendations r WHERE 1 AND r.status = ? AND r.created_at >= ? ORDER BY r.created_at DESC, r.id DESC LIMIT 1 OFFSET ?",
+        ('closed', '2024-01-01', 4999)),
+    ('search.filtered_range', "SELECT MIN(r.id), MAX(r.id) FROM recommendations r WHERE 1 AND r.created_at >= ? AND r.created_at < ? AND (r.created_at, r.id) >= (?, ?)",
+        ('2024-01-01', '2024-02-01', '2024-01-10', 1)),
+    ('search.filtered_hits', '''SELECT r.id FROM recommendations r WHERE 1 AND r.status = ? AND r.created_at >= ? AND r.id IN (
+        SELECT rowid FROM recs_fts WHERE recs_fts MATCH ? AND rowid BETWEEN ? AND ?) ORDER BY r.created_at DESC, r.id DESC LIMIT ?''',
+        ('active', '2024-01-01', '"rel"', 1, 5000, 200)),
+    ('search.exact', "SELECT * FROM recommendations r INDEXED BY idx_recs_symbol WHERE r.stock_symbol = ? COLLATE NOCASE AND r.status = ? ORDER BY r.created_at DESC LIMIT ?", ('REL', 'closed', 50)),
+    ('import.close_symbol', "SELECT * FROM recommendations WHERE stock_symbol = ? COLLATE NOCASE AND status='active'", ('REL',)),
+    ('import.staged', 'SELECT * FROM recommendations WHERE row_version = ?', (-1,)),
+    ('symbol.stats', "SELECT COUNT(*) FROM recommendations WHERE stock_symbol = ? COLLATE NOCASE AND status = 'closed'", ('REL',)),
+    ('api.recs', 'SELECT id FROM recommendations WHERE (row_version, id) > (?, ?) AND status = ? ORDER BY row_version, id LIMIT ?', (0, 0, 'active', 500)),
+    ('api.payments', 'SELECT id FROM payments WHERE (row_version, id) > (?, ?) AND user_id = ? ORDER BY row_version, id LIMIT ?', (0, 0, 1, 500)),
+    ('checkout.replay', "SELECT id, discount_amount, plan_type, original_amount, created_at >= datetime('now', ?) AS recent FROM payments WHERE user_id=? AND idempotency_key=?",
+        ('-900 seconds', 1, 'k')),
+    ('subs.expire', "SELECT id FROM users WHERE subscription_status='active' AND subscription_end_date < ? ORDER BY subscription_end_date LIMIT 500", ('2026-01-01',)),
+    ('subs.remind', '''SELECT id, subscription_end_date FROM users WHERE subscription_status='active' AND subscription_end_date BETWEEN ? AND ?
+        AND (renewal_reminded_for IS NULL OR renewal_reminded_for <> subscription_end_date) ORDER BY subscription_end_date LIMIT 500''', ('2026-01-01', '2026-01-04')),
+    ('admin.coupons', 'SELECT * FROM coupons WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 21', ('2024-01-01', 1)),
+    ('analytics.month', "SELECT * FROM recommendations WHERE created_month=? AND status='closed' ORDER BY created_at", ('2024-01',)),
+    ('stats.rebuild', "SELECT created_at, profit_loss_percent FROM recommendations WHERE status='closed' ORDER BY updated_at, id", ()),
+    ('events.tail', "SELECT seq, kind, ref, data FROM events WHERE seq > ? AND seq <= ? AND kind LIKE 'rec.%' ORDER BY seq LIMIT ?", (0, 100, 500)),
+    ('events.recs', 'SELECT * FROM recommendations WHERE id IN (?, ?)', (1, 2)),
+    ('sim.history', "SELECT id, updated_at, profit_loss_percent FROM recommendations WHERE status='closed' ORDER BY updated_at, id", ()),
+    ('mtm.active', "SELECT id, stock_symbol, recommendation_type, entry_price, target_price, stop_loss FROM recommendations WHERE status='active' ORDER BY stock_symbol", ()),
+    ('chart.lookup', 'SELECT chart_image FROM recommendations WHERE id = ?', (1,)),
+    ('invoice.export', "SELECT p.*, u.name FROM payments p JOIN users u ON p.user_id = u.id WHERE p.created_at >= ? AND p.created_at < ? ORDER BY p.created_at, p.id", ('2024-01-01', '2024-02-01')),
+    ('invoice.owner', 'SELECT user_id FROM payments WHERE id = ?', (1,)),
+    ('eventlog.after', 'SELECT * FROM events WHERE seq > ? ORDER BY seq LIMIT ?', (0, 1000)),
+    ('eventlog.kinds', "SELECT * FROM events WHERE seq > ? AND kind IN (?, ?) ORDER BY seq LIMIT ?", (0, 'rec.new', 'rec.close', 1000)),
+    ('eventlog.latest', 'SELECT COALESCE(MAX(seq), 0) FROM events', ()),
+    ('eventlog.rec', """SELECT e.*, u.email AS actor_email FROM events e LEFT JOIN users u ON u.id = e.actor
+        WHERE e.ref = ? AND e.kind LIKE 'rec.%' ORDER BY e.seq DESC LIMIT ?""", (1, 50)),
+]
+
+# Queries that are meant to read a whole table or range, and why they are
+# allowed to; anything else that scans must be bounded by a LIMIT.
+BULK_QUERIES = {
+    'stats.rebuild': 'rebuild-stats and edits of closed trades only, never a page view',
+    'sim.history': 'loaded once per process, then kept current from the event log',
+    'mtm.active': 'loads the active book into the mark-to-market engine on change',
+}
+
+def find_full_scans(db):
+    # "SCAN t" without USING visits every row of t. With an index it still
+    # walks the whole index unless a LIMIT stops it early, so that only
+    # passes for queries listed in BULK_QUERIES. An FTS5 MATCH shows up as
+    # "SCAN t VIRTUAL TABLE INDEX n:M...", which is a lookup, not a scan.
+    problems = []
+    for name, sql, params in ROUTE_QUERIES:
+        bounded = re.search(r'\bLIMIT\b', sql, re.I) or name in BULK_QUERIES
+        for row in db.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row['detail']
+            indexed = 'USING' in detail or re.search(r'VIRTUAL TABLE INDEX \d+:M', detail)
+            if detail.startswith('SCAN') and (not indexed or not bounded):
+                problems.append((name, detail))
+    return problems
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any hot route query scans a whole table or index without a LIMIT."""
+    db = get_db()
+    migrate(db)
+    problems = find_full_scans(db)
+    for name, detail in problems:
+        print(f'FULL SCAN  {name}: {detail}')
+    if problems:
+        raise SystemExit(1)
+    print(f'{len(ROUTE_QUERIES)} queries checked, no unbounded scans ({len(BULK_QUERIES)} allowed bulk reads)')
+
 def init_db():
     db = get_db()
-    
-    db.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        email TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        name TEXT,
-        phone TEXT,
-        is_admin INTEGER DEFAULT 0,
-        subscription_status TEXT DEFAULT 'inactive',
-        subscription_end_date TEXT,
-        capital REAL DEFAULT 0,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )''')
-    
-    db.execute('''CREATE TABLE IF NOT EXISTS recommendations (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        stock_name TEXT NOT NULL,
-        stock_symbol TEXT NOT NULL,
-        recommendation_type TEXT NOT NULL,
-        entry_price REAL NOT NULL,
-        target_price REAL,
-        stop_loss REAL,
-        status TEXT DEFAULT 'active',
-        exit_price REAL,
-        profit_loss_percent REAL,
-        notes TEXT,
-        chart_image TEXT,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )''')
-    
-    db.execute('''CREATE TABLE IF NOT EXISTS payments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        amount REAL NOT NULL,
-        original_amount REAL,
-        discount_amount REAL DEFAULT 0,
-        payment_id TEXT,
-        plan_type TEXT,
-        coupon_code TEXT,
-        status TEXT DEFAULT 'success',
-        invoice_number TEXT,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )''')
-    
-    db.execute('''CREATE TABLE IF NOT EXISTS settings (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        key TEXT UNIQUE NOT NULL,
-        value TEXT NOT NULL
-    )''')
-    
-    db.execute('''CREATE TABLE IF NOT EXISTS coupons (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        code TEXT UNIQUE NOT NULL,
-        discount_percent INTEGER NOT NULL,
-        valid_until TEXT,
-        max_uses INTEGER DEFAULT 0,
-        current_uses INTEGER DEFAULT 0,
-        active INTEGER DEFAULT 1,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )''')
+    migrate(db)
     
     defaults = {
         'monthly_price': '999',
@@ -164,7 +629,8 @@ def init_db():
         'company_email': 'contact@tradingpro.com',
         'gst_number': '',
         'razorpay_key_id': '',
-        'razorpay_key_secret': ''
+        'razorpay_key_secret': '',
+        'logo_version': str(int(os.path.getmtime(LOGO_PATH))) if os.path.exists(LOGO_PATH) else ''
     }
     
     for key, value in defaults.items():
@@ -180,19 +646,1039 @@ def init_db():
         pass
     
     db.commit()
-    db.close()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or migrate the schema and seed default settings and the admin user."""
+    init_db()
+    print(f"Database ready at schema version {get_db().execute('PRAGMA user_version').fetchone()[0]}")
+
+def get_version(db, name):
+    row = db.execute('SELECT value FROM versions WHERE name = ?', (name,)).fetchone()
+    return row['value'] if row else 0
+
+def bump_version(db, name):
+    db.execute('INSERT INTO versions (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,))
+
+def touch_row(db, table, row_id):
+    # Bumps the table's change counter and stamps the row with it; ?since=
+    # delta sync in the API pages through rows in row_version order
+    bump_version(db, table)
+    db.execute(f'UPDATE {table} SET row_version = (SELECT value FROM versions WHERE name = ?) WHERE id = ?', (table, row_id))
+
+def seed_row_versions(db, tables):
+    # Existing rows take their id as row_version, and the counter is moved
+    # past them so later stamps sort after every one of them
+    for table in tables:
+        db.execute(f'UPDATE {table} SET row_version = id')
+        top = db.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+        db.execute('INSERT INTO versions (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)',
+                   (table, top))
+
+class SettingsCache:
+    # Holds the whole settings table in memory. Like VersionedCache, the
+    # 'settings' version row is re-read at most every check_interval
+    # seconds, so cached reads never touch SQLite; invalidate() makes this
+    # worker re-read it at once, and edits made in another worker show up
+    # within the interval.
+    def __init__(self, check_interval=2.0):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._values = {}
+        self._version = None
+        self._checked = 0.0
+
+    def _sync(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked < self.check_interval:
+            return
+        db = get_db()
+        version = get_version(db, 'settings')
+        self._checked = now
+        if version == self._version:
+            return
+        values = {r['key']: r['value'] for r in db.execute('SELECT key, value FROM settings')}
+        with self._lock:
+            self._values = values
+            self._version = version
+
+    def get(self, key, default=''):
+        self._sync()
+        return self._values.get(key, default)
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+settings_cache = SettingsCache()
 
 def get_setting(key, default=''):
-    db = get_db()
-    result = db.execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
-    db.close()
-    return result['value'] if result else default
+    return settings_cache.get(key, default)
 
 def set_setting(key, value):
+    set_settings({key: value})
+
+def set_settings(values):
+    db = get_db()
+    marks = ','.join('?' * len(values))
+    old = {r['key']: r['value'] for r in db.execute(f'SELECT key, value FROM settings WHERE key IN ({marks})', list(values))}
+    db.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', list(values.items()))
+    changed = {k: [old.get(k), str(v)] for k, v in values.items() if old.get(k) != str(v)}
+    for key in SECRET_SETTINGS & changed.keys():
+        changed[key] = ['***', '***']
+    if changed:
+        log_event(db, 'setting', None, changed)
+    bump_version(db, 'settings')
+    db.commit()
+    settings_cache.invalidate()
+
+# ═══════════════════ EVENT LOG ═══════════════════
+
+# events is append-only: every state change writes one row in the same
+# transaction as the change, so the log and the tables never disagree.
+# Rows are kept small: kind is a short dotted name, at is epoch seconds,
+# ref is the rec or user id, and data is compact JSON holding only what
+# changed, {field: [old, new]}, or the initial fields for a new row.
+# Consumers remember the last seq they saw and read what came after it;
+# archive_events moves rows past EVENT_RETENTION_DAYS to monthly gzipped
+# JSONL files and records the highest archived seq, so a consumer that has
+# fallen behind it knows to reload from the tables instead.
+
+EVENT_ARCHIVE_BATCH = 5000
+SECRET_SETTINGS = {'razorpay_key_secret'}
+# recommendations columns under their short names in event data
+REC_EVENT_FIELDS = {'stock_symbol': 'sym', 'stock_name': 'name', 'recommendation_type': 'type', 'entry_price': 'entry',
+                    'target_price': 'target', 'stop_loss': 'stop', 'status': 'status', 'exit_price': 'exit',
+                    'profit_loss_percent': 'pl', 'notes': 'notes'}
+
+def event_actor():
+    return session.get('user_id') if has_request_context() else None
+
+def log_event(db, kind, ref, data):
+    log_events(db, kind, [(ref, data)])
+
+def log_events(db, kind, items):
+    # (ref, data) pairs, all of one kind
+    at, actor = int(time.time()), event_actor()
+    db.executemany('INSERT INTO events (at, kind, ref, actor, data) VALUES (?, ?, ?, ?, ?)',
+                   [(at, kind, ref, actor, json.dumps(data, separators=(',', ':')) if data else None) for ref, data in items])
+
+def rec_fields(rec):
+    return {short: rec[col] for col, short in REC_EVENT_FIELDS.items() if rec[col] not in (None, '')}
+
+def rec_changes(before, after):
+    return {short: [before[col], after[col]] for col, short in REC_EVENT_FIELDS.items() if before[col] != after[col]}
+
+def decode_event(row):
+    return {'seq': row['seq'], 'at': row['at'], 'kind': row['kind'], 'ref': row['ref'], 'actor': row['actor'],
+            'data': json.loads(row['data']) if row['data'] else {}}
+
+def archived_seq(db):
+    return get_counter(db, 'events_archived_seq')
+
+def events_after(db, seq, kinds=None, limit=1000):
+    # None when seq is behind the archive: the caller has to resync
+    if seq < archived_seq(db):
+        return None
+    if kinds:
+        rows = db.execute(f"SELECT * FROM events WHERE seq > ? AND kind IN ({','.join('?' * len(kinds))}) ORDER BY seq LIMIT ?",
+                          (seq, *kinds, limit))
+    else:
+        rows = db.execute('SELECT * FROM events WHERE seq > ? ORDER BY seq LIMIT ?', (seq, limit))
+    return [decode_event(row) for row in rows]
+
+def rec_history(db, rec_id, limit=50):
+    rows = db.execute("""SELECT e.*, u.email AS actor_email FROM events e LEFT JOIN users u ON u.id = e.actor
+                         WHERE e.ref = ? AND e.kind LIKE 'rec.%' ORDER BY e.seq DESC LIMIT ?""", (rec_id, limit)).fetchall()
+    return [dict(decode_event(row), actor_email=row['actor_email'],
+                 when=datetime.fromtimestamp(row['at'], timezone.utc).strftime('%Y-%m-%d %H:%M')) for row in rows]
+
+def latest_event_seq(db):
+    return db.execute('SELECT COALESCE(MAX(seq), 0) FROM events').fetchone()[0]
+
+def archive_events(db, days=EVENT_RETENTION_DAYS):
+    # Files are written and fsynced before the rows are deleted; a crash in
+    # between only means some events appear twice in the archive, so readers
+    # should dedupe by seq.
+    cutoff = int(time.time()) - days * 86400
+    archived = 0
+    while True:
+        # the oldest row alone answers "anything to do?" on the usual pass
+        first = db.execute('SELECT at FROM events WHERE seq > ? ORDER BY seq LIMIT 1', (archived_seq(db),)).fetchone()
+        if not first or first[0] >= cutoff:
+            return archived
+        rows = db.execute('SELECT * FROM events WHERE seq > ? ORDER BY seq LIMIT ?', (archived_seq(db), EVENT_ARCHIVE_BATCH)).fetchall()
+        old = []
+        for row in rows:
+            if row['at'] >= cutoff:
+                break
+            old.append(decode_event(row))
+        if not old:
+            return archived
+        os.makedirs(EVENT_ARCHIVE_DIR, exist_ok=True)
+        by_month = {}
+        for event in old:
+            month = datetime.fromtimestamp(event['at'], timezone.utc).strftime('%Y-%m')
+            by_month.setdefault(month, []).append(json.dumps(event, separators=(',', ':')))
+        for month, lines in by_month.items():
+            with open(os.path.join(EVENT_ARCHIVE_DIR, f'events-{month}.jsonl.gz'), 'ab') as f:
+                with gzip.GzipFile(fileobj=f, mode='ab') as gz:
+                    gz.write(('\n'.join(lines) + '\n').encode())
+                f.flush()
+                os.fsync(f.fileno())
+        last = old[-1]['seq']
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM events WHERE seq <= ?', (last,))
+            db.execute('INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)',
+                       ('events_archived_seq', last))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        archived += len(old)
+        if len(old) < EVENT_ARCHIVE_BATCH:
+            return archived
+
+@app.cli.command('archive-events')
+@click.option('--days', default=EVENT_RETENTION_DAYS, show_default=True, help='Archive events older than this many days.')
+def archive_events_command(days):
+    """Move old events to gzipped JSONL files under EVENT_ARCHIVE_DIR and delete them from the table."""
+    db = get_db()
+    migrate(db)
+    archived = archive_events(db, days)
+    print(f"{archived} events archived to {EVENT_ARCHIVE_DIR}, {db.execute('SELECT COUNT(*) FROM events').fetchone()[0]} kept")
+
+# ═══════════════════ TRACK RECORD ═══════════════════
+
+# rec_stats keeps one row for the whole history ('all') and one per month of
+# created_at. Drawdown is measured on cumulative P/L% in close order.
+
+STATS_APPLY_SQL = '''UPDATE rec_stats SET trades=trades+1, wins=wins+?, sum_pl=sum_pl+?,
+    best_pl=CASE WHEN ? IS NULL THEN best_pl ELSE MAX(COALESCE(best_pl,?),?) END,
+    worst_pl=CASE WHEN ? IS NULL THEN worst_pl ELSE MIN(COALESCE(worst_pl,?),?) END,
+    peak_pl=MAX(peak_pl,sum_pl+?),
+    max_drawdown=MAX(max_drawdown,MAX(peak_pl,sum_pl+?)-(sum_pl+?))
+    WHERE bucket=?'''
+
+def stats_buckets(created_at):
+    return ('all', created_at[:7])
+
+def apply_closed_trade(db, created_at, pl):
+    apply_closed_trades(db, [(created_at, pl)])
+
+def apply_closed_trades(db, trades):
+    # (created_at, pl) pairs, applied in close order
+    params = []
+    for created_at, pl in trades:
+        step = pl or 0
+        for bucket in stats_buckets(created_at):
+            params.append((1 if pl and pl > 0 else 0, step, pl, pl, pl, pl, pl, pl, step, step, step, bucket))
+    db.executemany('INSERT OR IGNORE INTO rec_stats (bucket) VALUES (?)', [(b,) for b in {p[-1] for p in params}])
+    db.executemany(STATS_APPLY_SQL, params)
+    bump_version(db, 'rec_stats')
+
+def rebuild_rec_stats(db):
+    acc = {}
+    rows = db.execute("SELECT created_at, profit_loss_percent FROM recommendations WHERE status='closed' ORDER BY updated_at, id")
+    for row in rows:
+        pl = row['profit_loss_percent']
+        for bucket in stats_buckets(row['created_at']):
+            s = acc.setdefault(bucket, {'trades': 0, 'wins': 0, 'sum_pl': 0.0, 'best_pl': None, 'worst_pl': None, 'peak_pl': 0.0, 'max_drawdown': 0.0})
+            s['trades'] += 1
+            s['wins'] += 1 if pl and pl > 0 else 0
+            s['sum_pl'] += pl or 0
+            if pl is not None:
+                s['best_pl'] = pl if s['best_pl'] is None else max(s['best_pl'], pl)
+                s['worst_pl'] = pl if s['worst_pl'] is None else min(s['worst_pl'], pl)
+            s['peak_pl'] = max(s['peak_pl'], s['sum_pl'])
+            s['max_drawdown'] = max(s['max_drawdown'], s['peak_pl'] - s['sum_pl'])
+    db.execute('DELETE FROM rec_stats')
+    db.executemany('''INSERT INTO rec_stats (bucket,trades,wins,sum_pl,best_pl,worst_pl,peak_pl,max_drawdown)
+                      VALUES (?,?,?,?,?,?,?,?)''',
+                   [(b, s['trades'], s['wins'], s['sum_pl'], s['best_pl'], s['worst_pl'], s['peak_pl'], s['max_drawdown']) for b, s in acc.items()])
+    bump_version(db, 'rec_stats')
+
+def get_rec_stats(db, bucket='all'):
+    row = db.execute('SELECT * FROM rec_stats WHERE bucket = ?', (bucket,)).fetchone()
+    total = row['trades'] if row else 0
+    wins = row['wins'] if row else 0
+    return {'total_trades': total, 'winning_trades': wins,
+            'win_rate': (wins/total*100) if total > 0 else 0,
+            'avg_return': row['sum_pl']/total if total > 0 else 0,
+            'sum_pl': row['sum_pl'] if row else 0,
+            'best_pl': row['best_pl'] if row else None,
+            'worst_pl': row['worst_pl'] if row else None,
+            'max_drawdown': row['max_drawdown'] if row else 0}
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute rec_stats from the recommendations table."""
+    db = get_db()
+    migrate(db)
+    rebuild_rec_stats(db)
+    # tells running workers to drop anything derived from closed trades
+    log_event(db, 'stats.rebuild', None, None)
+    db.commit()
+    print(f"rec_stats rebuilt: {db.execute('SELECT COUNT(*) FROM rec_stats').fetchone()[0]} buckets")
+
+# ═══════════════════ SIMULATOR ═══════════════════
+
+# "What if I had followed every call": replays closed trades in close order
+# against a starting capital under a position-sizing rule. The history is
+# loaded into arrays once per rec_stats version, so a run is a few
+# vectorised passes over it.
+
+SIZING_RULES = ('fixed_pct', 'fixed_amount', 'compounding', 'kelly')
+KELLY_MIN_TRADES = 10
+SIM_CURVE_POINTS = 250
+# used when a subscriber has not entered their capital yet
+SIM_DEFAULT_CAPITAL = 100000
+
+class TradeHistory:
+    # Closed trades in close order, kept current by tailing the event log:
+    # a close appends one trade, anything that rewrites history (editing or
+    # reopening a closed rec, backfilled imports, rebuild-stats, an archive
+    # gap) reloads.
+    def __init__(self):
+        self._data = (None, None, None, None)
+
+    def load(self, db):
+        seq, ids, days, returns = self._data
+        events = None if seq is None else events_after(db, seq, ('rec.new', 'rec.update', 'rec.close', 'stats.rebuild'))
+        if events is None or len(events) == 1000 or any(self._rewrites(event, ids) for event in events):
+            return self._reload(db)
+        if events:
+            closes = [event for event in events if event['kind'] == 'rec.close']
+            ids = ids | {event['ref'] for event in closes}
+            days = np.concatenate((days, np.array([datetime.fromtimestamp(event['at'], timezone.utc).date() for event in closes], dtype='datetime64[D]')))
+            returns = np.concatenate((returns, np.array([(event['data'].get('pl', [None, None])[1] or 0) for event in closes], dtype=np.float64) / 100))
+            self._data = (events[-1]['seq'], ids, days, returns)
+        return days, returns
+
+    @staticmethod
+    def _rewrites(event, ids):
+        if event['kind'] == 'stats.rebuild':
+            return True
+        if event['kind'] == 'rec.new':
+            return event['data'].get('status') == 'closed'
+        return event['kind'] == 'rec.update' and event['ref'] in ids and not event['data'].keys().isdisjoint(('status', 'exit', 'pl'))
+
+    def _reload(self, db):
+        # one read snapshot, so no close lands between the rows and the seq
+        snapshot = not db.in_transaction
+        if snapshot:
+            db.execute('BEGIN')
+        try:
+            seq = latest_event_seq(db)
+            rows = db.execute("SELECT id, updated_at, profit_loss_percent FROM recommendations WHERE status='closed' ORDER BY updated_at, id").fetchall()
+        finally:
+            if snapshot:
+                db.commit()
+        days = np.array([row[1][:10] for row in rows], dtype='datetime64[D]')
+        returns = np.array([row[2] or 0 for row in rows], dtype=np.float64) / 100
+        self._data = (seq, frozenset(row[0] for row in rows), days, returns)
+        return days, returns
+
+    def window(self, db, start=None, end=None):
+        days, returns = self.load(db)
+        lo = np.searchsorted(days, np.datetime64(start, 'D'), 'left') if start else 0
+        hi = np.searchsorted(days, np.datetime64(end, 'D'), 'right') if end else len(days)
+        return days[lo:hi], returns[lo:hi]
+
+trade_history = TradeHistory()
+
+def prior_cumsum(values):
+    # out[i] = sum(values[:i]), i.e. what was known before trade i closed
+    out = np.zeros(len(values))
+    np.cumsum(values[:-1], out=out[1:])
+    return out
+
+def kelly_fractions(returns, fallback, cap):
+    # f = W - (1-W)/R from the trades closed before each one, so the rule
+    # never sees the future; fallback is used until there is enough history.
+    wins, losses = returns > 0, returns < 0
+    seen = np.arange(len(returns))
+    win_count, loss_count = prior_cumsum(wins), prior_cumsum(losses)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        win_rate = win_count / seen
+        payoff = (prior_cumsum(np.where(wins, returns, 0)) / win_count) / (prior_cumsum(np.where(losses, -returns, 0)) / loss_count)
+        kelly = win_rate - (1 - win_rate) / payoff
+    kelly = np.clip(np.nan_to_num(kelly, nan=0.0, posinf=cap, neginf=0.0), 0, cap)
+    return np.where(seen >= KELLY_MIN_TRADES, kelly, fallback)
+
+def simulate(days, returns, capital, rule='fixed_pct', pct=5.0, amount=None, kelly_cap=25.0, start=None, end=None):
+    if rule not in SIZING_RULES:
+        raise ValueError(f'unknown sizing rule {rule!r}')
+    fraction = pct / 100
+    if rule == 'fixed_pct':
+        equity = capital + np.cumsum(capital * fraction * returns)
+    elif rule == 'fixed_amount':
+        equity = capital + np.cumsum((capital * fraction if amount is None else amount) * returns)
+    elif rule == 'compounding':
+        equity = capital * np.cumprod(1 + fraction * returns)
+    else:
+        equity = capital * np.cumprod(1 + kelly_fractions(returns, fraction, kelly_cap / 100) * returns)
+    curve = np.maximum(np.concatenate(([capital], equity)), 0)
+    first = np.datetime64(start, 'D') if start else (days[0] if len(days) else None)
+    last = np.datetime64(end, 'D') if end else (days[-1] if len(days) else None)
+    years = ((last - first).astype(int) + 1) / 365.25 if first is not None else 0
+
+    peak = np.maximum.accumulate(curve)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drawdown = np.nan_to_num((peak - curve) / peak)
+        steps = np.nan_to_num(curve[1:] / curve[:-1] - 1)
+    final = float(curve[-1])
+    cagr = None
+    if years >= 1 / 12 and capital > 0:
+        cagr = float(((final / capital) ** (1 / years) - 1) * 100)
+    sharpe = None
+    if len(steps) > 1 and years > 0 and steps.std(ddof=1) > 0:
+        # per-trade returns, annualised by how often calls actually close
+        sharpe = float(steps.mean() / steps.std(ddof=1) * np.sqrt(len(steps) / years))
+
+    picks = np.unique(np.linspace(0, len(curve) - 1, min(len(curve), SIM_CURVE_POINTS)).round().astype(int))
+    dates = np.concatenate(([first], days)) if first is not None else np.array([], dtype='datetime64[D]')
+    return {'rule': rule, 'trades': int(len(returns)), 'capital': capital,
+            'final_equity': round(final, 2),
+            'total_return': round((final / capital - 1) * 100, 2) if capital > 0 else 0,
+            'cagr': None if cagr is None else round(cagr, 2),
+            'max_drawdown': round(float(drawdown.max()) * 100, 2),
+            'sharpe': None if sharpe is None else round(sharpe, 2),
+            'curve': {'dates': [str(d) for d in dates[picks]] if len(dates) else [],
+                      'equity': [round(float(v), 2) for v in curve[picks]]}}
+
+# ═══════════════════ ANALYTICS CACHE ═══════════════════
+
+class VersionedCache:
+    # LRU + TTL memo whose keys are prefixed with a row of the versions
+    # table. That version is re-read at most every check_interval seconds, so
+    # hits never touch SQLite; invalidate() makes this worker re-read it on
+    # the next lookup, and other workers pick the change up within the
+    # interval.
+    def __init__(self, version_name, maxsize=1024, ttl=300, check_interval=2.0):
+        self.version_name = version_name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._version = None
+        self._checked = 0.0
+        self.hits = self.misses = self.expired = self.evicted = 0
+
+    def _current_version(self):
+        now = time.monotonic()
+        if self._version is None or now - self._checked >= self.check_interval:
+            self._version = get_version(get_db(), self.version_name)
+            self._checked = now
+        return self._version
+
+    def get_or_build(self, key, build):
+        key = (self._current_version(),) + key
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+                self.expired += 1
+            self.misses += 1
+        value = build()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'expired': self.expired, 'evicted': self.evicted, 'version': self._version}
+
+analytics_cache = VersionedCache('rec_stats')
+
+def build_analytics(month, capital, today):
+    # Everything /analytics shows for one (month, capital), with each row's
+    # profit at 5% of capital already worked out; the simulations run up to
+    # today, so it is part of the key too
     db = get_db()
-    db.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+    stats = get_rec_stats(db, month)
+    per_stock = capital * 0.05
+    monthly = [dict(row, profit=per_stock * (row['profit_loss_percent'] or 0) / 100 if capital > 0 else 0)
+               for row in db.execute("SELECT * FROM recommendations WHERE created_month=? AND status='closed' ORDER BY created_at", (month,))]
+    sims = None
+    if HAS_NUMPY:
+        year_start = month[:4] + '-01-01'
+        days, returns = trade_history.window(db, year_start)
+        sims = [simulate(days, returns, capital or SIM_DEFAULT_CAPITAL, rule, start=year_start, end=today)
+                for rule in SIZING_RULES]
+    return {'total': stats['total_trades'], 'wins': stats['winning_trades'], 'avg': stats['avg_return'],
+            'potential': per_stock * stats['sum_pl'] / 100 if capital > 0 and stats['total_trades'] > 0 else 0,
+            'monthly_recs': monthly, 'sims': sims}
+
+def session_capital():
+    # Capital rides in the session (set at login and by update_capital) so a
+    # cached analytics view needs no users lookup
+    if 'capital' not in session:
+        row = get_db().execute('SELECT capital FROM users WHERE id=?', (session['user_id'],)).fetchone()
+        session['capital'] = row['capital'] or 0
+    return session['capital']
+
+# ═══════════════════ SUBSCRIPTIONS ═══════════════════
+
+# A subscription runs through its end date. Every worker runs a scheduler
+# thread, but only the holder of the 'subscriptions' lease does any work:
+# it expires lapsed users in batches off idx_users_subscription, logs a
+# sub.reminder event REMINDER_DAYS ahead, and keeps the active-subscriber
+# counter in step so the admin dashboard never has to COUNT users.
+
+SCHEDULER_INTERVAL = int(os.environ.get('SCHEDULER_INTERVAL', 60))
+REMINDER_DAYS = int(os.environ.get('REMINDER_DAYS', 3))
+EXPIRY_BATCH = 500
+
+def get_counter(db, name):
+    row = db.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+    return row['value'] if row else 0
+
+def add_counter(db, name, delta):
+    db.execute('INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+               (name, delta))
+
+def recount_active_subscribers(db):
+    count = db.execute("SELECT COUNT(*) FROM users WHERE subscription_status='active'").fetchone()[0]
+    db.execute("INSERT OR REPLACE INTO counters (name, value) VALUES ('active_subscribers', ?)", (count,))
+    return count
+
+def recount_row_totals(db):
+    # The admin dashboard's totals, kept by add_counter wherever rows are
+    # inserted; this is the slow path for migrations and repairs
+    recs = db.execute('SELECT COUNT(*) FROM recommendations').fetchone()[0]
+    users = db.execute('SELECT COUNT(*) FROM users WHERE is_admin=0').fetchone()[0]
+    db.executemany('INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)', [('total_recommendations', recs), ('total_users', users)])
+    return recs, users
+
+def acquire_lease(db, name, holder, ttl):
+    # Takes the lease if it is free, expired or already ours, and extends it.
+    # The upsert is a single statement, so two workers can never both win.
+    now = time.time()
+    cur = db.execute('''INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+                         ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                         WHERE leases.holder = excluded.holder OR leases.expires_at < ?''', (name, holder, now + ttl, now))
     db.commit()
-    db.close()
+    return cur.rowcount == 1
+
+def expire_subscriptions(db, today=None):
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    expired = 0
+    while True:
+        ids = [r[0] for r in db.execute("SELECT id FROM users WHERE subscription_status='active' AND subscription_end_date < ? ORDER BY subscription_end_date LIMIT ?",
+                                        (today, EXPIRY_BATCH))]
+        if not ids:
+            return expired
+        marks = ','.join('?' * len(ids))
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # re-checked under the write lock: a renewal may have landed since
+            rows = db.execute(f"SELECT id, subscription_end_date FROM users WHERE id IN ({marks}) AND subscription_status='active' AND subscription_end_date < ?",
+                              (*ids, today)).fetchall()
+            db.executemany("UPDATE users SET subscription_status='expired' WHERE id=?", [(r['id'],) for r in rows])
+            add_counter(db, 'active_subscribers', -len(rows))
+            log_events(db, 'sub.expired', [(r['id'], {'end': r['subscription_end_date']}) for r in rows])
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        expired += len(rows)
+        if len(ids) < EXPIRY_BATCH:
+            return expired
+
+def send_renewal_reminders(db, today=None):
+    today = datetime.strptime(today, '%Y-%m-%d') if today else datetime.now()
+    until = (today + timedelta(days=REMINDER_DAYS)).strftime('%Y-%m-%d')
+    sent = 0
+    while True:
+        rows = db.execute('''SELECT id, subscription_end_date FROM users WHERE subscription_status='active' AND subscription_end_date BETWEEN ? AND ?
+                             AND (renewal_reminded_for IS NULL OR renewal_reminded_for <> subscription_end_date) ORDER BY subscription_end_date LIMIT ?''',
+                          (today.strftime('%Y-%m-%d'), until, EXPIRY_BATCH)).fetchall()
+        if not rows:
+            return sent
+        db.executemany('UPDATE users SET renewal_reminded_for=? WHERE id=?', [(r['subscription_end_date'], r['id']) for r in rows])
+        log_events(db, 'sub.reminder', [(r['id'], {'end': r['subscription_end_date']}) for r in rows])
+        db.commit()
+        sent += len(rows)
+        if len(rows) < EXPIRY_BATCH:
+            return sent
+
+class SubscriptionScheduler:
+    # Started lazily per process like InvoiceQueue. Followers just retry the
+    # lease every interval, so if the leader dies another worker takes over
+    # once its lease runs out.
+    LEASE = 'subscriptions'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self.holder = None
+        self.runs = 0
+        self.expired = 0
+        self.reminded = 0
+        self.archived = 0
+
+    def ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid() or SCHEDULER_INTERVAL <= 0:
+                return
+            self._pid = os.getpid()
+            self.holder = f'{os.uname().nodename}:{os.getpid()}:{secrets.token_hex(4)}'
+            threading.Thread(target=self._run, name='subscription-scheduler', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once(get_db())
+            except Exception:
+                app.logger.exception('subscription scheduler pass failed')
+            time.sleep(SCHEDULER_INTERVAL)
+
+    def run_once(self, db, holder=None):
+        if not acquire_lease(db, self.LEASE, holder or self.holder, SCHEDULER_INTERVAL * 3):
+            return None
+        expired = expire_subscriptions(db)
+        reminded = send_renewal_reminders(db)
+        self.archived += archive_events(db)
+        self.runs += 1
+        self.expired += expired
+        self.reminded += reminded
+        return expired, reminded
+
+subscription_scheduler = SubscriptionScheduler()
+
+@app.before_request
+def ensure_subscription_scheduler():
+    subscription_scheduler.ensure_started()
+
+# GST wants invoice numbers unique and consecutive within a financial year
+# (April to March), at most 16 characters: INV/26-27/000042. Numbers come
+# from invoice_sequences inside the checkout transaction, so a rolled back
+# checkout also rolls back its number and the series stays gapless.
+#
+# INVOICE_BLOCK_SIZE > 1 lets each worker reserve a block of numbers at a
+# time, for throughput under heavy checkout load. Numbers are then only
+# unique and increasing per worker, and a worker that exits leaves the rest
+# of its block unused; keep the default of 1 unless that is acceptable.
+INVOICE_BLOCK_SIZE = int(os.environ.get('INVOICE_BLOCK_SIZE', 1))
+
+def financial_year(when):
+    start = when.year if when.month >= 4 else when.year - 1
+    return f'{start % 100:02d}-{(start + 1) % 100:02d}'
+
+def format_invoice_number(fy, value):
+    return f'INV/{fy}/{value:06d}'
+
+def reserve_invoice_numbers(db, fy, count):
+    # Call inside a write transaction; returns the first of count numbers
+    db.execute('INSERT OR IGNORE INTO invoice_sequences (fy) VALUES (?)', (fy,))
+    db.execute('UPDATE invoice_sequences SET last_value = last_value + ? WHERE fy = ?', (count, fy))
+    return db.execute('SELECT last_value FROM invoice_sequences WHERE fy = ?', (fy,)).fetchone()[0] - count + 1
+
+class InvoiceNumbers:
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._blocks = {}
+
+    def allocate(self, db, fy):
+        # Returns (number, reserved); reserved says a block was taken in the
+        # caller's transaction, which undo() needs to know if it rolls back.
+        if self.block_size <= 1:
+            return reserve_invoice_numbers(db, fy, 1), True
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._blocks = {}
+            block = self._blocks.get(fy)
+            if block:
+                return block.popleft(), False
+            first = reserve_invoice_numbers(db, fy, self.block_size)
+            self._blocks[fy] = deque(range(first + 1, first + self.block_size))
+            return first, True
+
+    def undo(self, fy, number, reserved):
+        if self.block_size <= 1:
+            return
+        with self._lock:
+            if reserved:
+                # the reservation itself rolled back; those numbers are free again
+                self._blocks.pop(fy, None)
+            elif fy in self._blocks:
+                self._blocks[fy].appendleft(number)
+
+invoice_numbers = InvoiceNumbers(INVOICE_BLOCK_SIZE)
+
+def renumber_duplicate_invoices(db):
+    # Before the sequence, two purchases by one user on one day shared a
+    # number. The earliest payment keeps it; the others get a -2, -3...
+    # suffix and remember the number they were issued under.
+    dupes = db.execute('''SELECT id, invoice_number FROM payments WHERE invoice_number IN
+                          (SELECT invoice_number FROM payments WHERE invoice_number IS NOT NULL GROUP BY invoice_number HAVING COUNT(*) > 1)
+                          ORDER BY invoice_number, created_at, id''').fetchall()
+    seen = {}
+    for row in dupes:
+        n = seen[row['invoice_number']] = seen.get(row['invoice_number'], 0) + 1
+        if n > 1:
+            db.execute('UPDATE payments SET invoice_number=?, legacy_invoice_number=? WHERE id=?',
+                       (f"{row['invoice_number']}-{n}", row['invoice_number'], row['id']))
+
+# A checkout key is only replayed for the same order placed a moment ago;
+# an older or different one is a stale form, and must not pass for a
+# purchase that never happened.
+CHECKOUT_REPLAY_SECONDS = 900
+
+def checkout(db, user_id, plan, coupon='', idempotency_key=None):
+    # The coupon use, the subscription and the payment row commit together
+    # in one short write transaction. The coupon UPDATE only matches while a
+    # use is left, so max_uses cannot be oversold however many checkouts
+    # race. A repeated idempotency key (double submit, retry after a dropped
+    # response) returns the first payment instead of charging again, as
+    # long as it is for the same plan and price within
+    # CHECKOUT_REPLAY_SECONDS; otherwise ValueError.
+    # Returns (payment_id, end_date, discount, replayed).
+    price = int(get_setting('monthly_price' if plan == 'monthly' else 'quarterly_price', '999' if plan == 'monthly' else '2999'))
+    now = datetime.now()
+    end_date = (now + timedelta(days=30 if plan == 'monthly' else 90)).strftime('%Y-%m-%d')
+    fy = financial_year(now)
+    invoice_seq = None
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        if idempotency_key:
+            row = db.execute('''SELECT id, discount_amount, plan_type, original_amount, created_at >= datetime('now', ?) AS recent
+                                FROM payments WHERE user_id=? AND idempotency_key=?''',
+                             (f'-{CHECKOUT_REPLAY_SECONDS} seconds', user_id, idempotency_key)).fetchone()
+            if row:
+                db.rollback()
+                if not row['recent'] or (row['plan_type'], row['original_amount']) != (plan, price):
+                    raise ValueError('This checkout form has expired. Please review the plan and pay again.')
+                end = db.execute('SELECT subscription_end_date FROM users WHERE id=?', (user_id,)).fetchone()[0]
+                return row['id'], end, row['discount_amount'], True
+        discount = 0
+        if coupon:
+            cur = db.execute('''UPDATE coupons SET current_uses=current_uses+1 WHERE code=? AND active=1
+                                 AND (valid_until IS NULL OR valid_until='' OR valid_until>=?) AND (max_uses=0 OR current_uses<max_uses)''',
+                             (coupon, now.strftime('%Y-%m-%d')))
+            if cur.rowcount:
+                discount = int(price * db.execute('SELECT discount_percent FROM coupons WHERE code=?', (coupon,)).fetchone()[0] / 100)
+        user = db.execute('SELECT subscription_status, subscription_end_date FROM users WHERE id=?', (user_id,)).fetchone()
+        if user['subscription_status'] != 'active':
+            add_counter(db, 'active_subscribers', 1)
+        db.execute("UPDATE users SET subscription_status='active', subscription_end_date=? WHERE id=?", (end_date, user_id))
+        invoice_seq = invoice_numbers.allocate(db, fy)
+        cur = db.execute('''INSERT INTO payments (user_id,amount,original_amount,discount_amount,plan_type,coupon_code,invoice_number,idempotency_key)
+                            VALUES (?,?,?,?,?,?,?,?)''',
+                         (user_id, price - discount, price, discount, plan, coupon if discount else None,
+                          format_invoice_number(fy, invoice_seq[0]), idempotency_key))
+        touch_row(db, 'payments', cur.lastrowid)
+        paid = {'plan': plan, 'payment': cur.lastrowid, 'amount': price - discount, 'end': [user['subscription_end_date'], end_date]}
+        if discount:
+            paid['coupon'] = coupon
+        log_event(db, 'sub.paid', user_id, paid)
+        db.commit()
+    except:
+        # undo before releasing the write lock, so no other checkout in this
+        # worker can draw from a block that is about to vanish
+        if invoice_seq:
+            invoice_numbers.undo(fy, *invoice_seq)
+        db.rollback()
+        raise
+    return cur.lastrowid, end_date, discount, False
+
+def subscription_active(user):
+    # The scheduler may not have run yet today; never serve a lapsed user
+    return user['subscription_status'] == 'active' and (user['subscription_end_date'] or '') >= datetime.now().strftime('%Y-%m-%d')
+
+def subscriber_allowed():
+    # Paid features read the users row, not the session: the cookie only
+    # learns a subscription lapsed when the user next opens /dashboard.
+    if session.get('is_admin'):
+        return True
+    user = get_db().execute('SELECT subscription_status, subscription_end_date FROM users WHERE id=?', (session.get('user_id'),)).fetchone()
+    active = user is not None and subscription_active(user)
+    status = 'active' if active else 'expired'
+    if session.get('subscription_status') != status:
+        session['subscription_status'] = status
+    return active
+
+@app.cli.command('expire-subscriptions')
+@click.option('--recount', is_flag=True, help='Also recount the active-subscriber and admin dashboard counters from their tables.')
+def expire_subscriptions_command(recount):
+    """Run one scheduler pass now: expire lapsed subscriptions and log renewal reminders."""
+    db = get_db()
+    migrate(db)
+    result = subscription_scheduler.run_once(db, holder=f'cli:{os.getpid()}')
+    if result is None:
+        print('Another worker holds the scheduler lease; try again later.')
+    else:
+        print(f'{result[0]} subscriptions expired, {result[1]} renewal reminders logged')
+    if recount:
+        print(f'{recount_active_subscribers(db)} active subscribers')
+        print('{} recommendations, {} users'.format(*recount_row_totals(db)))
+        db.commit()
+
+# ═══════════════════ MARK TO MARKET ═══════════════════
+
+def calc_pl(rec_type, entry_price, exit_price):
+    if rec_type == 'BUY':
+        return ((exit_price - entry_price) / entry_price) * 100
+    return ((entry_price - exit_price) / entry_price) * 100
+
+def close_recommendation(db, rec_id, exit_price, note):
+    # Closes an active rec at exit_price. The status guard in the UPDATE makes
+    # this safe to race from several workers: only one of them gets a row.
+    rec = db.execute('SELECT * FROM recommendations WHERE id=?', (rec_id,)).fetchone()
+    if not rec or rec['status'] != 'active':
+        return False
+    pl = calc_pl(rec['recommendation_type'], rec['entry_price'], exit_price)
+    notes = f"{rec['notes']}\n{note}" if rec['notes'] else note
+    try:
+        cur = db.execute("""UPDATE recommendations SET status='closed', exit_price=?, profit_loss_percent=?, notes=?,
+                              updated_at=CURRENT_TIMESTAMP WHERE id=? AND status='active'""", (exit_price, pl, notes, rec_id))
+        if cur.rowcount:
+            apply_closed_trade(db, rec['created_at'], pl)
+            touch_row(db, 'recommendations', rec_id)
+            log_event(db, 'rec.close', rec_id, rec_changes(rec, db.execute('SELECT * FROM recommendations WHERE id=?', (rec_id,)).fetchone()))
+        db.commit()
+    except:
+        # a lock timeout mid-close must not leave the feed's connection
+        # holding a half-written transaction
+        db.rollback()
+        raise
+    if cur.rowcount:
+        analytics_cache.invalidate()
+    return bool(cur.rowcount)
+
+class Position:
+    __slots__ = ('rec_id', 'symbol', 'rec_type', 'entry', 'target', 'stop', 'price', 'pl')
+
+    def __init__(self, row):
+        self.rec_id = row['id']
+        self.symbol = row['stock_symbol'].strip().upper()
+        self.rec_type = row['recommendation_type']
+        self.entry = row['entry_price']
+        self.target = row['target_price'] or 0
+        self.stop = row['stop_loss'] or 0
+        self.price = None
+        self.pl = None
+
+    def mark(self, price):
+        self.price = price
+        self.pl = calc_pl(self.rec_type, self.entry, price)
+
+    def crossed(self, price):
+        if self.rec_type == 'BUY':
+            if self.target and price >= self.target:
+                return 'target'
+            if self.stop and price <= self.stop:
+                return 'stop loss'
+        else:
+            if self.target and price <= self.target:
+                return 'target'
+            if self.stop and price >= self.stop:
+                return 'stop loss'
+        return None
+
+class MarkToMarketEngine:
+    # Active recs indexed by symbol, so a tick only touches the positions on
+    # that symbol. The index is reloaded when the 'recommendations' version
+    # moves, checked at most every RESYNC_INTERVAL seconds from the feed.
+    RESYNC_INTERVAL = 2.0
+
+    def __init__(self):
+        self._by_symbol = {}
+        self._by_id = {}
+        self._last_price = {}
+        self._version = None
+        self._checked = 0.0
+        self.on_close = []
+        self.ticks = 0
+        self.closes = 0
+
+    def load(self, db):
+        by_symbol, by_id = {}, {}
+        rows = db.execute('''SELECT id, stock_symbol, recommendation_type, entry_price, target_price, stop_loss
+                             FROM recommendations WHERE status='active' ORDER BY stock_symbol''')
+        for row in rows:
+            if not row['entry_price'] or row['entry_price'] <= 0:
+                # no P/L can be worked out; older rows predate the add_rec check
+                continue
+            pos = Position(row)
+            if pos.symbol in self._last_price:
+                pos.mark(self._last_price[pos.symbol])
+            by_symbol.setdefault(pos.symbol, []).append(pos)
+            by_id[pos.rec_id] = pos
+        self._by_symbol, self._by_id = by_symbol, by_id
+
+    def invalidate(self):
+        self._version = None
+        self._checked = 0.0
+
+    def maybe_resync(self, db):
+        now = time.monotonic()
+        if now - self._checked < self.RESYNC_INTERVAL:
+            return
+        self._checked = now
+        version = get_version(db, 'recommendations')
+        if version != self._version:
+            self._version = version
+            self.load(db)
+
+    def on_tick(self, symbol, price):
+        self.ticks += 1
+        symbol = symbol.strip().upper()
+        self._last_price[symbol] = price
+        crossed = []
+        for pos in self._by_symbol.get(symbol, ()):
+            pos.mark(price)
+            reason = pos.crossed(price)
+            if reason:
+                crossed.append((pos, reason))
+        for pos, reason in crossed:
+            self._close(pos, price, reason)
+
+    def _close(self, pos, price, reason):
+        self._by_id.pop(pos.rec_id, None)
+        remaining = [p for p in self._by_symbol.get(pos.symbol, ()) if p.rec_id != pos.rec_id]
+        if remaining:
+            self._by_symbol[pos.symbol] = remaining
+        else:
+            self._by_symbol.pop(pos.symbol, None)
+        try:
+            closed = close_recommendation(get_db(), pos.rec_id, price, f'Auto-closed: {reason} hit at {price:.2f}')
+        except Exception:
+            # still active in the table: reload it so the next tick retries
+            self.invalidate()
+            raise
+        if closed:
+            self.closes += 1
+            for listener in self.on_close:
+                listener(pos.rec_id, reason, price)
+
+    def quote(self, rec_id):
+        pos = self._by_id.get(rec_id)
+        return pos if pos is not None and pos.price is not None else None
+
+    def stats(self):
+        return {'symbols': len(self._by_symbol), 'positions': len(self._by_id), 'ticks': self.ticks, 'closes': self.closes}
+
+class PriceFeed:
+    # A feed yields (symbol, price) ticks; run() pushes them into an engine
+    def ticks(self):
+        raise NotImplementedError
+
+    def run(self, engine, stop=None):
+        for symbol, price in self.ticks():
+            if stop is not None and stop.is_set():
+                break
+            # a failed tick (locked database, a bad rec) must not end the
+            # feed thread, or auto-closes stop until the process restarts
+            try:
+                engine.maybe_resync(get_db())
+                engine.on_tick(symbol, price)
+            except Exception:
+                app.logger.exception('price tick failed for %s at %s', symbol, price)
+
+class FileFeed(PriceFeed):
+    # Lines of "symbol,price" or "timestamp,symbol,price" (epoch seconds).
+    # follow=True tails the file for lines appended by another process,
+    # starting at its current end: older ticks would mark recs that are
+    # active now at stale prices, and could auto-close them. Only a replay
+    # reads from the start. speed>0 paces timestamped lines at that
+    # multiple of real time.
+    def __init__(self, path, follow=False, speed=0.0):
+        self.path = path
+        self.follow = follow
+        self.speed = speed
+
+    def ticks(self):
+        previous = None
+        with open(self.path) as f:
+            if self.follow:
+                f.seek(0, os.SEEK_END)
+            partial = ''
+            while True:
+                line = f.readline()
+                if self.follow and line and not line.endswith('\n'):
+                    # the writer is mid-line; wait for the rest of it
+                    partial += line
+                    line = ''
+                if not line:
+                    if not self.follow:
+                        return
+                    time.sleep(0.2)
+                    continue
+                line, partial = partial + line, ''
+                parts = [p.strip() for p in line.split(',')]
+                try:
+                    if len(parts) == 3:
+                        stamp, symbol, price = float(parts[0]), parts[1], float(parts[2])
+                        if self.speed and previous is not None and stamp > previous:
+                            time.sleep((stamp - previous) / self.speed)
+                        previous = stamp
+                    else:
+                        symbol, price = parts[0], float(parts[1])
+                except (ValueError, IndexError):
+                    continue
+                yield symbol, price
+
+def make_price_feed(spec):
+    # PRICE_FEED=file:<path> tails a file, replay:<path>[@speed] replays one
+    kind, _, target = spec.partition(':')
+    if kind == 'file':
+        return FileFeed(target, follow=True)
+    if kind == 'replay':
+        path, _, speed = target.partition('@')
+        return FileFeed(path, speed=float(speed or 0))
+    raise ValueError(f'unknown PRICE_FEED {spec!r}')
+
+mtm_engine = MarkToMarketEngine()
+_feed_pid = None
+
+@app.before_request
+def ensure_price_feed():
+    # Started per process on first request so it survives gunicorn's fork
+    global _feed_pid
+    if _feed_pid == os.getpid() or not os.environ.get('PRICE_FEED'):
+        return
+    _feed_pid = os.getpid()
+    feed = make_price_feed(os.environ['PRICE_FEED'])
+    threading.Thread(target=feed.run, args=(mtm_engine,), name='price-feed', daemon=True).start()
+
+def live_quote(rec_id):
+    return mtm_engine.quote(rec_id)
+
+@app.cli.command('replay-ticks')
+@click.argument('path')
+@click.option('--speed', default=0.0, help='Pace timestamped ticks at this multiple of real time (0 = as fast as possible).')
+def replay_ticks_command(path, speed):
+    """Replay a tick file through the mark-to-market engine, auto-closing crossed recs."""
+    migrate(get_db())
+    started = time.perf_counter()
+    FileFeed(path, speed=speed).run(mtm_engine)
+    elapsed = time.perf_counter() - started
+    stats = mtm_engine.stats()
+    print(f"{stats['ticks']} ticks in {elapsed:.2f}s ({stats['ticks']/elapsed if elapsed else 0:,.0f}/s), "
+          f"{stats['closes']} recs auto-closed, {stats['positions']} still active")
 
 # ═══════════════════ DECORATORS ═══════════════════
 
@@ -214,31 +1700,168 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            return jsonify({'error': 'login required'}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
 # ═══════════════════ HELPERS ═══════════════════
 
+PAGE_SIZE = 20
+USER_COLUMNS = 'id,email,name,phone,is_admin,subscription_status,subscription_end_date,capital,created_at'
+
+def encode_cursor(row):
+    return urlsafe_b64encode(f"{row['created_at']}|{row['id']}".encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        created_at, row_id = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().rsplit('|', 1)
+        return created_at, int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def keyset_page(db, table, where='', params=(), cursor=None, columns='*', limit=PAGE_SIZE):
+    # Seeks past the last (created_at, id) seen instead of using OFFSET, so
+    # every page costs the same however deep it is. Needs an index ending in
+    # created_at on the table (the rowid is implicit).
+    clauses = [where] if where else []
+    params = list(params)
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        clauses.append('(created_at, id) < (?, ?)')
+        params.extend(position)
+    sql = f"SELECT {columns} FROM {table}"
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    rows = db.execute(sql + ' ORDER BY created_at DESC, id DESC LIMIT ?', params + [limit + 1]).fetchall()
+    return rows[:limit], (encode_cursor(rows[limit - 1]) if len(rows) > limit else None)
+
+def paged_response(template, items_template, target, items, next_cursor, **context):
+    if request.args.get('format') == 'json':
+        return jsonify({'items': [dict(r) for r in items], 'next_cursor': next_cursor})
+    if request.args.get('partial'):
+        return render_template('more.html', items_template=items_template, target=target, items=items, next_cursor=next_cursor)
+    return render_template(template, target=target, items=items, next_cursor=next_cursor, **context)
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png','jpg','jpeg','gif','webp'}
 
-def generate_invoice_pdf(payment_id):
-    if not HAS_PDF:
-        return None
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def conditional_response(etag, build, last_modified=None, max_age=0, immutable=False, private=False):
+    # build() only runs when the client's copy is stale, so a matching
+    # If-None-Match is answered from the etag alone.
+    stale = not request.if_none_match.contains(etag)
+    if stale and not request.if_none_match and last_modified and request.if_modified_since:
+        stale = last_modified.replace(microsecond=0) > request.if_modified_since
+    resp = make_response(build()) if stale else app.response_class(status=304)
+    resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = last_modified
+    if private:
+        resp.cache_control.private = True
+    else:
+        resp.cache_control.public = True
+    resp.cache_control.max_age = max_age
+    resp.cache_control.no_cache = None if immutable else True
+    resp.cache_control.immutable = immutable or None
+    return resp
+
+def chart_variant_path(filename, variant):
+    return f"{CHART_DIR}/{filename.rsplit('.', 1)[0]}_{variant}.webp"
+
+def build_chart_variants(filename):
+    # Returns the original's (width, height), or (None, None) when Pillow is
+    # missing or the file isn't a readable image; the feed then falls back
+    # to the original file.
+    if not HAS_PIL:
+        return None, None
+    try:
+        with Image.open(f"{CHART_DIR}/{filename}") as img:
+            img = ImageOps.exif_transpose(img)
+            width, height = img.size
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA')
+            for variant, max_width in CHART_VARIANTS.items():
+                out = chart_variant_path(filename, variant)
+                if os.path.exists(out):
+                    continue
+                resized = img.copy()
+                resized.thumbnail((max_width, height))
+                resized.save(out + '.tmp', 'WEBP', quality=80, method=4)
+                os.replace(out + '.tmp', out)
+        return width, height
+    except (OSError, Image.DecompressionBombError):
+        return None, None
+
+def save_chart(file):
+    # Charts are stored under a hash of their bytes, so re-uploading the same
+    # screenshot reuses the stored original and its variants.
+    data = file.read()
+    filename = f"{hashlib.sha256(data).hexdigest()[:32]}.{file.filename.rsplit('.', 1)[1].lower()}"
+    path = f"{CHART_DIR}/{filename}"
+    if not os.path.exists(path):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+    width, height = build_chart_variants(filename)
+    return filename, width, height
+
+def chart_url(filename, variant=None):
+    # Chart files are named by content hash, so the URL itself is the version
+    name = os.path.basename(chart_variant_path(filename, variant)) if variant else filename
+    return url_for('chart_file', name=name)
+
+@app.cli.command('process-charts')
+def process_charts_command():
+    """Build WebP variants and record dimensions for charts uploaded before the pipeline."""
     db = get_db()
-    pay = db.execute('''SELECT p.*, u.name, u.email, u.phone FROM payments p 
-                       JOIN users u ON p.user_id = u.id WHERE p.id = ?''', (payment_id,)).fetchone()
-    db.close()
-    if not pay:
-        return None
-    
+    migrate(db)
+    rows = db.execute('SELECT id, chart_image FROM recommendations WHERE chart_image IS NOT NULL AND chart_width IS NULL').fetchall()
+    done = 0
+    for row in rows:
+        if not os.path.exists(f"{CHART_DIR}/{row['chart_image']}"):
+            continue
+        width, height = build_chart_variants(row['chart_image'])
+        if width:
+            db.execute('UPDATE recommendations SET chart_width=?, chart_height=? WHERE id=?', (width, height, row['id']))
+            done += 1
+    db.commit()
+    print(f'{done} of {len(rows)} charts processed')
+
+def load_invoice_payment(db, payment_id):
+    return db.execute('''SELECT p.*, u.name, u.email, u.phone FROM payments p 
+                         JOIN users u ON p.user_id = u.id WHERE p.id = ?''', (payment_id,)).fetchone()
+
+def invoice_company():
+    return {key: get_setting(key, default) for key, default in INVOICE_SETTINGS.items()}
+
+def invoice_path(pay, company):
+    # The name carries a hash of everything printed on the invoice, so a
+    # cached file is valid exactly as long as its inputs are unchanged.
+    # Only rendered fields count: bookkeeping columns and the user's phone
+    # change without touching the PDF.
+    inputs = {key: pay[key] for key in INVOICE_FIELDS}
+    inputs['created_at'] = (pay['created_at'] or '')[:10]
+    inputs.update(company, template=INVOICE_TEMPLATE_VERSION)
+    digest = hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    number = re.sub(r'[^A-Za-z0-9_-]', '_', pay['invoice_number'] or f"payment-{pay['id']}")
+    return f"{INVOICE_DIR}/{number}-{digest}.pdf", digest
+
+def render_invoice_pdf(pay, company):
     buffer = BytesIO()
     c = canvas.Canvas(buffer, pagesize=letter)
     width, height = letter
     
     c.setFont("Helvetica-Bold", 20)
-    c.drawString(1*inch, height-1*inch, get_setting('company_name','TradingPro'))
+    c.drawString(1*inch, height-1*inch, company['company_name'])
     c.setFont("Helvetica", 10)
-    c.drawString(1*inch, height-1.3*inch, get_setting('company_address','India'))
-    c.drawString(1*inch, height-1.5*inch, f"Email: {get_setting('company_email','')}")
-    c.drawString(1*inch, height-1.7*inch, f"Phone: {get_setting('company_phone','')}")
+    c.drawString(1*inch, height-1.3*inch, company['company_address'])
+    c.drawString(1*inch, height-1.5*inch, f"Email: {company['company_email']}")
+    c.drawString(1*inch, height-1.7*inch, f"Phone: {company['company_phone']}")
     
     c.setFont("Helvetica-Bold", 16)
     c.drawString(1*inch, height-2.5*inch, "TAX INVOICE")
@@ -273,66 +1896,512 @@ def generate_invoice_pdf(payment_id):
     c.drawString(1*inch, y, "Total Paid")
     c.drawString(5*inch, y, f"₹{pay['amount']:.2f}")
     
-    c.setFont("Helvetica-Italic", 9)
+    c.setFont("Helvetica-Oblique", 9)
     c.drawString(1*inch, 1*inch, "Thank you for your subscription!")
     c.drawString(1*inch, 0.8*inch, "Computer-generated invoice")
     
     c.save()
-    buffer.seek(0)
-    return buffer
+    return buffer.getvalue()
+
+def write_invoice_file(pay, company):
+    # Returns (path, digest) of the rendered PDF, rendering it first if needed.
+    # Takes plain dicts and never touches the DB, so it can run in a pool.
+    path, digest = invoice_path(pay, company)
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        started = time.perf_counter()
+        with open(tmp, 'wb') as f:
+            f.write(render_invoice_pdf(pay, company))
+        metrics.observe('invoice_pdf_seconds', time.perf_counter() - started)
+        os.replace(tmp, path)
+    return path, digest
+
+def ensure_invoice(payment_id):
+    if not HAS_PDF:
+        return None
+    pay = load_invoice_payment(get_db(), payment_id)
+    if not pay:
+        return None
+    return write_invoice_file(dict(pay), invoice_company())
+
+def render_all_invoices(prune=False):
+    db = get_db()
+    current = set()
+    rendered = 0
+    last_id = 0
+    while True:
+        ids = [r['id'] for r in db.execute('SELECT id FROM payments WHERE id > ? ORDER BY id LIMIT 500', (last_id,))]
+        if not ids:
+            break
+        for payment_id in ids:
+            result = ensure_invoice(payment_id)
+            if result:
+                current.add(os.path.basename(result[0]))
+                rendered += 1
+        last_id = ids[-1]
+    pruned = 0
+    if prune:
+        for name in os.listdir(INVOICE_DIR):
+            if name.endswith('.pdf') and name not in current:
+                os.remove(f"{INVOICE_DIR}/{name}")
+                pruned += 1
+    return rendered, pruned
+
+class InvoiceQueue:
+    # One daemon thread per process renders invoices off the request path.
+    # The thread is started lazily so each gunicorn worker gets its own
+    # after the fork. None in the queue means "every payment".
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, args=(self._queue,), name='invoice-renderer', daemon=True).start()
+            return self._queue
+
+    def enqueue(self, payment_id):
+        self._ensure_worker().put(payment_id)
+
+    def enqueue_all(self):
+        self._ensure_worker().put(None)
+
+    def join(self):
+        self._ensure_worker().join()
+
+    def _run(self, jobs):
+        while True:
+            payment_id = jobs.get()
+            try:
+                if payment_id is None:
+                    render_all_invoices()
+                else:
+                    ensure_invoice(payment_id)
+            except Exception:
+                app.logger.exception('invoice render failed for %s', payment_id or 'all payments')
+            finally:
+                jobs.task_done()
+
+invoice_queue = InvoiceQueue()
+
+class ZipStream(io.RawIOBase):
+    # Write-only sink for zipfile; drain() hands back what has been written
+    # since the last call. zipfile sees it is unseekable and uses data
+    # descriptors, so entries can be streamed out as soon as they are added.
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+PAYMENT_CSV_COLUMNS = ('id', 'invoice_number', 'created_at', 'name', 'email', 'phone', 'plan_type',
+                       'original_amount', 'discount_amount', 'coupon_code', 'amount', 'status', 'payment_id')
+
+def invoice_zip_stream(payments, company):
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w') as zf:
+        summary = io.StringIO()
+        writer = csv.writer(summary)
+        writer.writerow(PAYMENT_CSV_COLUMNS)
+        writer.writerows([pay[col] for col in PAYMENT_CSV_COLUMNS] for pay in payments)
+        zf.writestr('payments.csv', summary.getvalue(), compress_type=zipfile.ZIP_DEFLATED)
+        yield stream.drain()
+        if not HAS_PDF:
+            return
+        def add(pay, path):
+            zf.write(path, arcname=f"invoice_{pay['id']}_{os.path.basename(path).rsplit('-', 1)[0]}.pdf")
+            return stream.drain()
+        cached, missing = [], []
+        for pay in payments:
+            path, _ = invoice_path(pay, company)
+            (cached if os.path.exists(path) else missing).append((pay, path))
+        if len(missing) < 2:
+            for pay, path in cached + missing:
+                yield add(pay, write_invoice_file(pay, company)[0])
+        else:
+            # spawn, not fork: the parent may be a threaded server
+            with ProcessPoolExecutor(INVOICE_EXPORT_WORKERS, mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = {pool.submit(write_invoice_file, pay, company): pay for pay, _ in missing}
+                for pay, path in cached:
+                    yield add(pay, path)
+                for future in as_completed(futures):
+                    yield add(futures[future], future.result()[0])
+    yield stream.drain()
+
+@app.cli.command('render-invoices')
+@click.option('--prune', is_flag=True, help='Delete cached PDFs that no longer match any payment.')
+def render_invoices_command(prune):
+    """Render every missing or outdated invoice PDF, e.g. after company details change."""
+    migrate(get_db())
+    rendered, pruned = render_all_invoices(prune)
+    print(f'{rendered} invoices up to date, {pruned} stale files removed')
+
+# ═══════════════════ LIVE PUSH ═══════════════════
+
+class RecEvent:
+    __slots__ = ('id', 'rec_id', 'kind', 'rec', '_html')
+
+    def __init__(self, row, rec):
+        self.id, self.rec_id, self.kind, self.rec = row['seq'], row['ref'], row['kind'].split('.', 1)[1], rec
+        # a backfilled import is history, not news for the feed
+        if self.kind == 'new' and row['data'] and json.loads(row['data']).get('status') == 'closed':
+            self.rec = None
+        self._html = None
+
+    def html(self):
+        # Rendered once per process, however many clients are listening.
+        # None if the rec is gone or will not render: that one event is
+        # skipped, since every reconnect would replay it and stall the feed.
+        if self._html is None:
+            try:
+                self._html = self.rec is not None and render_template('dashboard_recs.html', items=[self.rec])
+            except Exception:
+                app.logger.exception('rec event %s failed to render', self.id)
+                self._html = False
+        return self._html or None
+
+    def message(self):
+        html = self.html()
+        if html is None:
+            return None
+        return json.dumps({'id': self.id, 'rec_id': self.rec_id, 'kind': self.kind, 'html': html},
+                          separators=(',', ':'))
+
+def load_rec_events(db, after, upto=None, limit=500):
+    # rec.* events after seq `after`, each with the rec as it is now: event
+    # data only holds what changed, and a replay showing the current card is
+    # what the feed wants anyway
+    bound, params = (' AND seq <= ?', (after, upto, limit)) if upto is not None else ('', (after, limit))
+    rows = db.execute(f"SELECT seq, kind, ref, data FROM events WHERE seq > ?{bound} AND kind LIKE 'rec.%' ORDER BY seq LIMIT ?",
+                      params).fetchall()
+    ids = list({row['ref'] for row in rows})
+    recs = {}
+    for i in range(0, len(ids), 500):
+        part = ids[i:i + 500]
+        recs.update((rec['id'], dict(rec)) for rec in
+                    db.execute(f"SELECT * FROM recommendations WHERE id IN ({','.join('?' * len(part))})", part))
+    return [RecEvent(row, recs.get(row['ref'])) for row in rows]
+
+class RecEventBroker:
+    # One poller thread per process tails the rec.* events into a ring
+    # buffer and wakes every waiting client through a single Condition.
+    # Clients hold no thread or queue of their own, so under gunicorn -k
+    # gevent an idle stream is just a parked greenlet. Reconnecting clients
+    # resume from Last-Event-ID, an event seq: recent ones come from the
+    # ring, older ones from SQLite.
+    POLL_INTERVAL = 0.5
+    BACKLOG = 1000
+    BATCH = 500
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pid = None
+        self._events = deque(maxlen=self.BACKLOG)
+        # every rec event after _floor is in the ring; _last_id is the seq
+        # the poller has read up to, other kinds included
+        self._floor = 0
+        self._last_id = 0
+        self.clients = 0
+        self.delivered = 0
+
+    def _ensure_poller(self):
+        with self._cond:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._events.clear()
+                self._last_id = self._floor = latest_event_seq(get_db())
+                threading.Thread(target=self._run, name='rec-events', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll(get_db())
+            except Exception:
+                app.logger.exception('rec event poll failed')
+            time.sleep(self.POLL_INTERVAL)
+
+    def poll(self, db):
+        # reading up to the current top first lets the cursor skip past
+        # other kinds of events instead of rescanning them every poll
+        top = latest_event_seq(db)
+        if top <= self._last_id:
+            return
+        events = load_rec_events(db, self._last_id, top, self.BATCH)
+        with self._cond:
+            for event in events:
+                if len(self._events) == self.BACKLOG:
+                    self._floor = self._events[0].id
+                self._events.append(event)
+            self._last_id = events[-1].id if len(events) == self.BATCH else top
+            if events:
+                self._cond.notify_all()
+
+    def since(self, after, timeout):
+        # Events with seq > after, waiting up to timeout for the first one
+        self._ensure_poller()
+        if after < self._floor:
+            events = load_rec_events(get_db(), after, limit=self.BATCH)
+            if events:
+                return events
+            after = self._floor
+        with self._cond:
+            # a cursor from before the log was reset would otherwise wait
+            # for a seq that may never come
+            after = min(after, self._last_id)
+            fresh = self._after(after)
+            if not fresh:
+                self._cond.wait(timeout)
+                fresh = self._after(after)
+            return fresh
+
+    def _after(self, after):
+        fresh = []
+        for event in reversed(self._events):
+            if event.id <= after:
+                break
+            fresh.append(event)
+        fresh.reverse()
+        return fresh
+
+    def stats(self):
+        return {'clients': self.clients, 'buffered': len(self._events), 'last_id': self._last_id, 'delivered': self.delivered}
+
+rec_events = RecEventBroker()
+
+def push_cursor():
+    return latest_event_seq(get_db())
+
+EVENT_STREAM_SECONDS = 300
+EVENT_KEEPALIVE_SECONDS = 15
+EVENT_POLL_SECONDS = 25
+
+def event_cursor(value):
+    try:
+        return max(int(value or 0), 0)
+    except ValueError:
+        return 0
+
+@app.route('/events')
+@login_required
+def event_stream():
+    if not subscriber_allowed():
+        return '', 403
+    after = event_cursor(request.headers.get('Last-Event-ID') or request.args.get('after'))
+
+    def stream():
+        # Streams end after EVENT_STREAM_SECONDS; EventSource reconnects with
+        # Last-Event-ID, so nothing is lost and a lapsed subscription is
+        # caught at the next reconnect.
+        nonlocal after
+        rec_events.clients += 1
+        try:
+            yield 'retry: 3000\n\n'
+            deadline = time.monotonic() + EVENT_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                # an idle stream holds no pooled connection between waits
+                release_db(None)
+                events = rec_events.since(after, EVENT_KEEPALIVE_SECONDS)
+                if not events:
+                    yield ': ping\n\n'
+                    continue
+                for event in events:
+                    message = event.message()
+                    if message:
+                        yield f'id: {event.id}\nevent: rec\ndata: {message}\n\n'
+                after = events[-1].id
+                rec_events.delivered += len(events)
+        finally:
+            rec_events.clients -= 1
+
+    resp = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+@app.route('/events/poll')
+@login_required
+def event_poll():
+    # Long-poll fallback for clients without EventSource or behind proxies
+    # that buffer streams.
+    if not subscriber_allowed():
+        return jsonify({'error': 'subscription required'}), 403
+    after = event_cursor(request.args.get('after'))
+    events = rec_events.since(after, EVENT_POLL_SECONDS)
+    rec_events.delivered += len(events)
+    messages = (event.message() for event in events)
+    return jsonify({'events': [json.loads(message) for message in messages if message],
+                    'after': events[-1].id if events else after})
 
 # ═══════════════════ PWA ROUTES ═══════════════════
 
+# The service worker is generated per deploy: its caches are named after a
+# hash of the app source (or BUILD_VERSION) and the shell URLs, so a new
+# build installs a new worker, precaches the shell under the new name and
+# deletes every cache it does not know on activate. Strategies:
+#   /                   stale-while-revalidate, so launches paint from cache
+#   shell assets        stale-while-revalidate (manifest, logo)
+#   /charts/<file>      cache-first LRU of SW_CHART_CACHE_MAX files; names are
+#                       content hashes, so a cached file is never stale
+#   other pages         network-first, falling back to the cached copy (or
+#                       the cached /) after SW_NETWORK_TIMEOUT_MS or offline
+#   SW_NETWORK_ONLY     never cached: streams, API, admin, invoices, and
+#                       /subscribe, whose form carries a one-time checkout key
+# Page caches are per user, so logging in or out clears them, and pages that
+# showed flash messages are sent no-store so a one-off alert is not replayed.
+APP_BUILD = os.environ.get('BUILD_VERSION')
+if not APP_BUILD:
+    with open(__file__, 'rb') as f:
+        APP_BUILD = hashlib.sha1(f.read()).hexdigest()[:12]
+SW_CHART_CACHE_MAX = int(os.environ.get('SW_CHART_CACHE_MAX', 60))
+SW_PAGE_CACHE_MAX = int(os.environ.get('SW_PAGE_CACHE_MAX', 30))
+SW_NETWORK_TIMEOUT_MS = int(os.environ.get('SW_NETWORK_TIMEOUT_MS', 3000))
+SW_NETWORK_ONLY = ('/events', '/api/', '/admin', '/invoice', '/logout', '/subscribe', '/sw.js')
+
+SERVICE_WORKER_JS = '''const C=__CONFIG__,SHELL='shell-'+C.version,PAGES='pages-'+C.version,CHARTS='charts',KEEP=[SHELL,PAGES,CHARTS];
+const cacheable=r=>r&&r.ok&&r.type==='basic'&&!/no-store/.test(r.headers.get('Cache-Control')||'');
+const cached=req=>caches.match(req,{ignoreVary:true});
+// Cache.put appends, so keys() is oldest first and a re-put marks a hit as recent
+const trim=(c,max)=>c.keys().then(ks=>Promise.all(ks.slice(0,Math.max(ks.length-max,0)).map(k=>c.delete(k))));
+self.addEventListener('install',e=>e.waitUntil(caches.open(SHELL).then(c=>c.addAll(C.shell)).then(()=>self.skipWaiting())));
+self.addEventListener('activate',e=>e.waitUntil(caches.keys().then(ks=>Promise.all(ks.filter(k=>!KEEP.includes(k)).map(k=>caches.delete(k))))
+.then(()=>self.clients.claim())));
+function fetchInto(e,name,max){
+const net=fetch(e.request);
+e.waitUntil(net.then(r=>{if(!cacheable(r))return;const copy=r.clone();
+return caches.open(name).then(c=>c.put(e.request,copy).then(()=>max&&trim(c,max)))}).catch(()=>{}));
+return net}
+function staleWhileRevalidate(e,name){const net=fetchInto(e,name);return cached(e.request).then(hit=>hit||net)}
+function networkFirst(e){
+const net=fetchInto(e,PAGES,C.pages),fallback=()=>cached(e.request)
+.then(hit=>hit||(e.request.mode==='navigate'&&cached('/'))).then(hit=>hit||Response.error());
+const slow=new Promise(res=>setTimeout(res,C.timeout)).then(()=>cached(e.request).then(hit=>hit||net));
+return Promise.race([net,slow]).catch(fallback)}
+function chartLru(e){return caches.open(CHARTS).then(c=>c.match(e.request).then(hit=>{
+if(hit){e.waitUntil(c.put(e.request,hit.clone()));return hit}
+return fetchInto(e,CHARTS,C.charts)}))}
+self.addEventListener('fetch',e=>{const url=new URL(e.request.url),path=url.pathname;
+if(url.origin!==location.origin)return;
+if(path==='/logout'||(path==='/login'&&e.request.method==='POST'))
+e.waitUntil(Promise.all([caches.delete(PAGES),caches.open(SHELL).then(c=>c.delete('/'))]));
+if(e.request.method!=='GET'||C.networkOnly.some(p=>path.startsWith(p)))return;
+if(path.startsWith('/charts/'))e.respondWith(chartLru(e));
+else if(C.shell.includes(path+url.search))e.respondWith(staleWhileRevalidate(e,SHELL));
+else if(e.request.mode==='navigate'||url.searchParams.has('partial'))e.respondWith(networkFirst(e))});
+'''
+
+DEFAULT_LOGO_SVG = '''<svg width="512" height="512" xmlns="http://www.w3.org/2000/svg">
+<rect width="512" height="512" fill="#667eea"/>
+<text x="256" y="300" font-size="200" fill="white" text-anchor="middle">📈</text>
+</svg>'''
+
+def logo_url():
+    version = get_setting('logo_version')
+    return url_for('logo_icon', v=version) if version else url_for('logo_icon')
+
 @app.route('/manifest.json')
 def manifest():
-    return jsonify({
+    body = json.dumps({
         "name": f"{get_setting('app_name')} Trading",
         "short_name": get_setting('app_name','TradingPro'),
         "start_url": "/",
         "display": "standalone",
         "background_color": "#667eea",
         "theme_color": "#667eea",
-        "icons": [{"src":"/logo-icon","sizes":"192x192","type":"image/png"},
-                  {"src":"/logo-icon","sizes":"512x512","type":"image/png"}]
+        "icons": [{"src":logo_url(),"sizes":"192x192","type":"image/png"},
+                  {"src":logo_url(),"sizes":"512x512","type":"image/png"}]
     })
+    return conditional_response(hashlib.sha1(body.encode()).hexdigest(),
+                                lambda: app.response_class(body, mimetype='application/manifest+json'))
 
 @app.route('/sw.js')
 def service_worker():
-    return '''const CACHE='v1';
-self.addEventListener('install',e=>e.waitUntil(caches.open(CACHE).then(c=>c.addAll(['/']))));
-self.addEventListener('fetch',e=>e.respondWith(caches.match(e.request).then(r=>r||fetch(e.request))));
-''', 200, {'Content-Type': 'application/javascript'}
+    shell = [url_for('index'), url_for('manifest'), logo_url()]
+    config = {'version': hashlib.sha1('|'.join([APP_BUILD] + shell).encode()).hexdigest()[:12], 'shell': shell,
+              'charts': SW_CHART_CACHE_MAX, 'pages': SW_PAGE_CACHE_MAX, 'timeout': SW_NETWORK_TIMEOUT_MS,
+              'networkOnly': SW_NETWORK_ONLY}
+    body = SERVICE_WORKER_JS.replace('__CONFIG__', json.dumps(config, separators=(',', ':')))
+    return conditional_response(hashlib.sha1(body.encode()).hexdigest(),
+                                lambda: app.response_class(body, mimetype='application/javascript'))
+
+@app.before_request
+def note_pending_flashes():
+    # flashed by the request that redirected here, shown by this page
+    g.flashed = '_flashes' in session
+
+@message_flashed.connect_via(app)
+def note_flash(sender, message, category, **extra):
+    g.flashed = True
+
+@app.after_request
+def no_store_flashed_pages(response):
+    if g.get('flashed') and response.mimetype == 'text/html':
+        response.cache_control.no_store = True
+    return response
 
 @app.route('/logo-icon')
 def logo_icon():
-    if os.path.exists('uploads/logo/logo.png'):
-        return send_file('uploads/logo/logo.png')
-    return f'''<svg width="512" height="512" xmlns="http://www.w3.org/2000/svg">
-<rect width="512" height="512" fill="#667eea"/>
-<text x="256" y="300" font-size="200" fill="white" text-anchor="middle">📈</text>
-</svg>''', 200, {'Content-Type': 'image/svg+xml'}
+    # ?v=<logo_version> URLs never change content and are cached forever;
+    # the bare URL is revalidated against the same version.
+    version = get_setting('logo_version')
+    if not version:
+        return conditional_response('logo-default', lambda: app.response_class(DEFAULT_LOGO_SVG, mimetype='image/svg+xml'))
+    fingerprinted = request.args.get('v') == version
+    return conditional_response(f'logo-{version}', lambda: send_file(os.path.abspath(LOGO_PATH), conditional=False, etag=False),
+                                last_modified=datetime.fromtimestamp(int(version), timezone.utc),
+                                max_age=IMMUTABLE_MAX_AGE if fingerprinted else 0, immutable=fingerprinted)
+
+@app.route('/charts/<name>')
+def chart_file(name):
+    path = f"{CHART_DIR}/{name}"
+    if not re.fullmatch(r'[A-Za-z0-9_-][A-Za-z0-9_.-]*', name):
+        return '', 404
+    if not request.if_none_match.contains(name) and not os.path.exists(path):
+        return '', 404
+    return conditional_response(name, lambda: send_file(os.path.abspath(path), conditional=False, etag=False),
+                                max_age=IMMUTABLE_MAX_AGE, immutable=True)
 
 @app.route('/chart/<int:rec_id>')
-def get_chart(rec_id):
+@app.route('/chart/<int:rec_id>/<variant>')
+def get_chart(rec_id, variant=None):
+    if variant and variant not in CHART_VARIANTS:
+        return '', 404
     db = get_db()
     rec = db.execute('SELECT chart_image FROM recommendations WHERE id = ?', (rec_id,)).fetchone()
-    db.close()
-    if rec and rec['chart_image'] and os.path.exists(f"uploads/charts/{rec['chart_image']}"):
-        return send_file(f"uploads/charts/{rec['chart_image']}")
-    return '', 404
+    if not rec or not rec['chart_image']:
+        return '', 404
+    if variant and os.path.exists(chart_variant_path(rec['chart_image'], variant)):
+        return redirect(chart_url(rec['chart_image'], variant))
+    return redirect(chart_url(rec['chart_image']))
 
 @app.route('/invoice/<int:payment_id>')
 @login_required
 def download_invoice(payment_id):
     db = get_db()
     pay = db.execute('SELECT user_id FROM payments WHERE id = ?', (payment_id,)).fetchone()
-    db.close()
     if not pay or (pay['user_id']!=session['user_id'] and not session.get('is_admin')):
         flash('Unauthorized','danger')
         return redirect(url_for('index'))
-    pdf = generate_invoice_pdf(payment_id)
-    if pdf:
-        return send_file(pdf, as_attachment=True, download_name=f'invoice_{payment_id}.pdf', mimetype='application/pdf')
+    invoice = ensure_invoice(payment_id)
+    if invoice:
+        path, digest = invoice
+        resp = send_file(os.path.abspath(path), as_attachment=True, download_name=f'invoice_{payment_id}.pdf', mimetype='application/pdf',
+                         etag=digest, max_age=86400)
+        resp.cache_control.public = None
+        resp.cache_control.private = True
+        return resp
     flash('PDF library not installed','warning')
     return redirect(url_for('dashboard'))
 
@@ -366,7 +2435,7 @@ select.form-control,textarea.form-control{cursor:pointer}textarea.form-control{m
 .grid-2{display:grid;grid-template-columns:1fr 1fr;gap:1rem}.grid-3{display:grid;grid-template-columns:repeat(3,1fr);gap:1rem}
 table{width:100%;border-collapse:collapse;margin:1rem 0;font-size:0.9rem}
 th,td{padding:0.75rem;text-align:left;border-bottom:1px solid #ddd}th{background:#f8f9fa;font-weight:600}
-.chart-img{width:100%;max-width:500px;border-radius:8px;margin:1rem 0;cursor:pointer;border:2px solid #e1e8ed}
+.chart-img{width:100%;max-width:500px;height:auto;border-radius:8px;margin:1rem 0;cursor:pointer;border:2px solid #e1e8ed}
 .stat-box{text-align:center;padding:1.5rem;background:#f8f9fa;border-radius:8px}
 .stat-number{font-size:2rem;font-weight:bold;color:#667eea}
 .profit-calc{background:linear-gradient(135deg,#28a745 0%,#20c997 100%);color:#fff;padding:1.5rem;border-radius:12px;margin:1rem 0}
@@ -385,10 +2454,10 @@ th,td{padding:0.75rem;text-align:left;border-bottom:1px solid #ddd}th{background
 <p style="margin:0.5rem 0">📊 Past performance ≠ Future results</p></div>
 <label style="display:block;margin-bottom:1rem"><input type="checkbox" id="disclaimerAccept" style="margin-right:0.5rem">I understand and accept</label>
 <button onclick="acceptDisclaimer()" class="btn btn-primary" style="width:100%">Continue</button></div></div>
-<div class="nav">{% if logo_exists %}<img src="/logo-icon" class="nav-logo">{% endif %}
+<div class="nav">{% if logo_exists %}<img src="{{logo_url()}}" class="nav-logo">{% endif %}
 <h2>📈 {{app_name}}</h2><div class="nav-menu">
 {% if session.user_id %}{% if session.is_admin %}<a href="{{url_for('admin_dashboard')}}">Admin</a>
-{% else %}<a href="{{url_for('dashboard')}}">Dashboard</a>{% endif %}<a href="{{url_for('logout')}}">Logout</a>
+{% else %}<a href="{{url_for('dashboard')}}">Dashboard</a>{% endif %}<a href="{{url_for('search')}}">Search</a><a href="{{url_for('logout')}}">Logout</a>
 {% else %}<a href="{{url_for('login')}}">Login</a><a href="{{url_for('register')}}">Register</a>{% endif %}
 </div><div style="clear:both"></div></div>
 <div class="container">{% with messages=get_flashed_messages(with_categories=true) %}
@@ -406,61 +2475,332 @@ th,td{padding:0.75rem;text-align:left;border-bottom:1px solid #ddd}th{background
 function acceptDisclaimer(){if(document.getElementById('disclaimerAccept').checked){
 document.getElementById('disclaimerPopup').style.display='none';localStorage.setItem('disc_v1','true');
 }else{alert('Please accept the terms')}}
-if(!localStorage.getItem('disc_v1')){document.getElementById('disclaimerPopup').style.display='block'}</script>
+if(!localStorage.getItem('disc_v1')){document.getElementById('disclaimerPopup').style.display='block'}
+document.addEventListener('click',e=>{const b=e.target.closest('.load-more');if(!b)return;e.preventDefault();
+fetch(b.href+'&partial=1').then(r=>r.text()).then(h=>{const t=document.createElement('template');t.innerHTML=h;
+const box=document.getElementById(b.dataset.target);t.content.querySelectorAll('[data-row]').forEach(n=>box.appendChild(n));
+const nb=t.content.querySelector('.load-more');nb?b.replaceWith(nb):b.remove()})});
+(()=>{const feed=document.getElementById('recFeed');if(!feed||feed.dataset.push===undefined)return;let after=+feed.dataset.push;
+const apply=ev=>{after=Math.max(after,ev.id);const t=document.createElement('template');t.innerHTML=ev.html;const card=t.content.firstElementChild;
+const old=feed.querySelector('[data-rec="'+ev.rec_id+'"]');if(old)old.replaceWith(card);else if(ev.kind==='new')feed.prepend(card)};
+if(window.EventSource){const es=new EventSource('/events?after='+after);es.addEventListener('rec',m=>apply(JSON.parse(m.data)))}
+else{const poll=()=>fetch('/events/poll?after='+after).then(r=>r.ok?r.json():Promise.reject(r)).then(d=>{d.events.forEach(apply);poll()},()=>setTimeout(poll,5000));poll()}})();</script>
 </body></html>'''
 
+# ═══════════════════ PAGE TEMPLATES ═══════════════════
+
+def page(content):
+    return "{% extends 'base.html' %}{% block content %}" + content + "{% endblock %}"
+
+TEMPLATES = {'base.html': BASE_HTML}
+
+# Feed cards show a WebP thumbnail sized by srcset; width/height reserve the
+# box before it loads and the full-resolution original opens only on click.
+TEMPLATES['chart_img.html'] = '''<a href="{{chart_url(rec.chart_image)}}" target="_blank">{% if rec.chart_width %}<img src="{{chart_url(rec.chart_image,'thumb')}}"
+width="{{rec.chart_width}}" height="{{rec.chart_height}}" sizes="(max-width:768px) 100vw, 500px"
+srcset="{{chart_url(rec.chart_image,'thumb')}} {{[rec.chart_width,chart_variants.thumb]|min}}w, {{chart_url(rec.chart_image,'medium')}} {{[rec.chart_width,chart_variants.medium]|min}}w"
+{% else %}<img src="{{chart_url(rec.chart_image)}}"{% endif %} class="chart-img" loading="lazy" alt="{{rec.stock_symbol}} chart"></a>'''
+
+TEMPLATES['index.html'] = page('''<div class="card" style="text-align:center">
+<h1>Professional Swing Trading</h1><p style="font-size:1.1rem;color:#666;margin:1rem 0">Expert recommendations for Indian markets</p>
+{% if not session.user_id %}<a href="{{url_for('register')}}" class="btn btn-primary">Get Started</a>{% endif %}</div>
+<div class="card"><h2>Track Record</h2><div class="grid-3">
+<div class="stat-box"><div class="stat-number">{{stats.total_trades}}</div><div>Trades</div></div>
+<div class="stat-box"><div class="stat-number">{{stats.winning_trades}}</div><div>Winners</div></div>
+<div class="stat-box"><div class="stat-number {% if stats.avg_return>0 %}text-success{% endif %}">{{"%.2f"|format(stats.avg_return)}}%</div><div>Avg Return</div></div></div></div>
+<div class="card"><h2>Recent Recommendations</h2>
+{% for rec in recommendations %}<div class="rec-card {% if rec.status=='closed' and rec.profit_loss_percent %}{% if rec.profit_loss_percent>0 %}profit{% else %}loss{% endif %}{% endif %}">
+<div style="display:flex;justify-content:space-between"><h3>{{rec.stock_name}} ({{rec.stock_symbol}})</h3>
+<span class="badge badge-{{rec.recommendation_type.lower()}}">{{rec.recommendation_type}}</span></div>
+{% if session.subscription_status=='active' %}
+<p><strong>Entry:</strong> ₹{{"%.2f"|format(rec.entry_price)}} | <strong>Target:</strong> ₹{{"%.2f"|format(rec.target_price or 0)}} | <strong>SL:</strong> ₹{{"%.2f"|format(rec.stop_loss or 0)}}</p>
+{% if rec.status=='active' %}{% set q=live_quote(rec.id) %}{% if q %}<p><strong>Live:</strong> ₹{{"%.2f"|format(q.price)}} |
+<strong>Unrealized:</strong> <span class="{% if q.pl>0 %}text-success{% else %}text-danger{% endif %}">{{"%+.2f"|format(q.pl)}}%</span></p>{% endif %}{% endif %}
+{% if rec.status=='closed' and rec.profit_loss_percent %}
+<p style="font-size:1.2rem"><strong>Result:</strong> <span class="{% if rec.profit_loss_percent>0 %}text-success{% else %}text-danger{% endif %}">{{"%.2f"|format(rec.profit_loss_percent)}}% {% if rec.profit_loss_percent>0 %}📈{% else %}📉{% endif %}</span></p>{% endif %}
+{% if rec.chart_image %}{% include 'chart_img.html' %}{% endif %}
+<div class="rec-disclaimer">📚 Educational only | Not financial advice</div>
+{% else %}<p style="text-align:center;padding:1rem;background:#f8f9fa;border-radius:8px">🔒 Subscribe to view</p>{% endif %}
+</div>{% endfor %}</div>''')
+
+TEMPLATES['login.html'] = page('''<div class="card" style="max-width:400px;margin:2rem auto"><h2>Login</h2>
+<form method="POST"><div class="form-group"><label>Email:</label><input type="email" name="email" required class="form-control"></div>
+<div class="form-group"><label>Password:</label><input type="password" name="password" required class="form-control"></div>
+<button type="submit" class="btn btn-primary" style="width:100%">Login</button></form>
+<p style="text-align:center;margin-top:1rem">No account? <a href="{{url_for('register')}}">Register</a></p>
+<div style="background:#f8f9fa;padding:1rem;border-radius:8px;margin-top:1rem"><p><strong>Demo:</strong> admin@ugesh.com / admin@123</p></div></div>''')
+
+TEMPLATES['register.html'] = page('''<div class="card" style="max-width:400px;margin:2rem auto"><h2>Create Account</h2>
+<form method="POST"><div class="form-group"><label>Name:</label><input type="text" name="name" class="form-control"></div>
+<div class="form-group"><label>Email:</label><input type="email" name="email" required class="form-control"></div>
+<div class="form-group"><label>Password:</label><input type="password" name="password" required class="form-control"></div>
+<div class="form-group"><label>Confirm:</label><input type="password" name="confirm" required class="form-control"></div>
+<button type="submit" class="btn btn-primary" style="width:100%">Register</button></form>
+<p style="text-align:center;margin-top:1rem">Have account? <a href="{{url_for('login')}}">Login</a></p></div>''')
+
+TEMPLATES['dashboard.html'] = page('''<div class="card"><h1>Welcome! 👋</h1><p>{{session.email}}</p>
+{% if active %}<p style="color:#28a745;font-weight:bold;margin-top:1rem">✓ Active until {{user.subscription_end_date}}</p>
+{% if renew_soon %}<p style="margin-top:0.5rem">Your plan ends soon. <a href="{{url_for('subscribe')}}" class="btn btn-primary btn-sm">Renew</a></p>{% endif %}
+{% else %}<div style="background:#fff3cd;padding:1rem;border-radius:8px;margin-top:1rem">
+<p style="color:#856404;font-weight:bold">⚠ No Active Subscription</p>
+<a href="{{url_for('subscribe')}}" class="btn btn-primary" style="margin-top:0.5rem">Subscribe Now</a></div>{% endif %}</div>
+{% if active %}<div class="card"><h2>Recommendations</h2>
+<div id="recFeed" data-push="{{push_cursor()}}">{% include 'dashboard_recs.html' %}</div>{% include 'load_more.html' %}</div>
+{% if payments %}<div class="card"><h2>Payment History</h2><table><tr><th>Date</th><th>Plan</th><th>Amount</th><th>Invoice</th></tr>
+{% for pay in payments %}<tr><td>{{pay.created_at[:10]}}</td><td>{{pay.plan_type}}</td><td>₹{{"%.2f"|format(pay.amount)}}</td>
+<td><a href="/invoice/{{pay.id}}" class="btn btn-secondary btn-sm">PDF</a></td></tr>{% endfor %}</table></div>{% endif %}
+{% endif %}''')
+
+TEMPLATES['dashboard_recs.html'] = '''{% for rec in items %}<div data-row data-rec="{{rec.id}}" class="rec-card {% if rec.status=='closed' and rec.profit_loss_percent is not none %}{% if rec.profit_loss_percent>0 %}profit{% else %}loss{% endif %}{% endif %}">
+<div style="display:flex;justify-content:space-between"><h3>{{rec.stock_name}} (<a href="{{url_for('symbol_history', symbol=rec.stock_symbol)}}">{{rec.stock_symbol}}</a>)</h3>
+<span class="badge badge-{{rec.recommendation_type.lower()}}">{{rec.recommendation_type}}</span></div>
+<p><strong>Entry:</strong> ₹{{"%.2f"|format(rec.entry_price)}} | <strong>Target:</strong> ₹{{"%.2f"|format(rec.target_price or 0)}} | <strong>SL:</strong> ₹{{"%.2f"|format(rec.stop_loss or 0)}}</p>
+{% if rec.status=='active' %}{% set q=live_quote(rec.id) %}{% if q %}<p><strong>Live:</strong> ₹{{"%.2f"|format(q.price)}} |
+<strong>Unrealized:</strong> <span class="{% if q.pl>0 %}text-success{% else %}text-danger{% endif %}">{{"%+.2f"|format(q.pl)}}%</span></p>{% endif %}{% endif %}
+{% if rec.status=='closed' %}<p><strong>Exit:</strong> ₹{{"%.2f"|format(rec.exit_price or 0)}} | <strong>Result:</strong>
+{% if rec.profit_loss_percent is not none %}<span class="{% if rec.profit_loss_percent>0 %}text-success{% else %}text-danger{% endif %}">{{"%.2f"|format(rec.profit_loss_percent)}}% {% if rec.profit_loss_percent>0 %}📈{% else %}📉{% endif %}</span>{% else %}-{% endif %}</p>{% endif %}
+{% if rec.chart_image %}{% include 'chart_img.html' %}{% endif %}
+<div class="rec-disclaimer">📚 Educational only | Not financial advice</div></div>{% endfor %}'''
+
+TEMPLATES['subscribe.html'] = page('''<div class="card" style="text-align:center">
+<h1>Choose Your Plan</h1><p style="color:#666;margin:1rem 0">Start receiving professional recommendations</p></div>
+<div class="grid-2"><div class="card"><h3>Monthly</h3><h1 style="color:#667eea;font-size:2.5rem">₹{{monthly}}</h1><p style="color:#666">/month</p>
+<ul style="text-align:left;margin:1.5rem 0;list-style:none"><li>✓ All recommendations</li><li>✓ Performance tracking</li><li>✓ Full history</li></ul>
+<form method="POST"><input type="hidden" name="plan" value="monthly"><input type="hidden" name="checkout_key" value="{{checkout_key}}">
+<div class="form-group"><input type="text" name="coupon" class="form-control" placeholder="Coupon code (optional)"></div>
+<button type="submit" class="btn btn-primary" style="width:100%">Subscribe Monthly</button></form></div>
+<div class="card" style="border:3px solid #667eea"><span class="badge badge-buy">POPULAR</span><h3>Quarterly</h3>
+<h1 style="color:#667eea;font-size:2.5rem">₹{{quarterly}}</h1><p style="color:#666">/3 months</p>
+<p style="color:#28a745;font-weight:bold">Save {{((int(monthly)*3-int(quarterly))/int(monthly)/3*100)|int}}%</p>
+<ul style="text-align:left;margin:1.5rem 0;list-style:none"><li>✓ All recommendations</li><li>✓ Performance tracking</li><li>✓ Full history</li><li>✓ Priority support</li></ul>
+<form method="POST"><input type="hidden" name="plan" value="quarterly"><input type="hidden" name="checkout_key" value="{{checkout_key}}">
+<div class="form-group"><input type="text" name="coupon" class="form-control" placeholder="Coupon code (optional)"></div>
+<button type="submit" class="btn btn-primary" style="width:100%">Subscribe Quarterly</button></form></div></div>
+<div class="card" style="background:#f8f9fa"><p style="text-align:center"><strong>Note:</strong> Demo mode - instant activation for testing</p></div>''')
+
+TEMPLATES['admin_dashboard.html'] = page('''<div class="card"><h1 style="display:inline">Admin Dashboard</h1>
+<a href="{{url_for('add_rec')}}" class="btn btn-primary" style="float:right">+ Add New</a><div style="clear:both"></div></div>
+<div class="grid-3"><div class="card" style="text-align:center;background:#f8f9fa">
+<h3 style="color:#667eea;font-size:2rem">{{rec_count}}</h3><p>Total Recommendations</p></div>
+<div class="card" style="text-align:center;background:#f8f9fa"><h3 style="color:#28a745;font-size:2rem">{{active.cnt}}</h3><p>Active Subscribers</p></div>
+<div class="card" style="text-align:center;background:#f8f9fa"><h3 style="color:#667eea;font-size:2rem">{{user_count}}</h3><p>Total Users</p></div></div>
+<div class="card"><a href="{{url_for('admin_users')}}" class="btn btn-secondary btn-sm">Users</a>
+<a href="{{url_for('admin_payments')}}" class="btn btn-secondary btn-sm">Payments</a>
+<a href="{{url_for('import_recs_page')}}" class="btn btn-secondary btn-sm">Bulk Import</a></div>
+<div class="card"><h2>All Recommendations</h2>{% set kind='recommendations' %}{% include 'export_form.html' %}<table>
+<thead><tr><th>Stock</th><th>Type</th><th>Entry</th><th>Status</th><th>Result</th><th>Action</th></tr></thead>
+<tbody id="adminRecRows">{% include 'admin_rec_rows.html' %}</tbody></table>{% include 'load_more.html' %}</div>''')
+
+TEMPLATES['admin_rec_rows.html'] = '''{% for rec in items %}<tr data-row><td><strong>{{rec.stock_name}}</strong><br><small>{{rec.stock_symbol}}</small></td>
+<td><span class="badge badge-{{rec.recommendation_type.lower()}}">{{rec.recommendation_type}}</span></td>
+<td>₹{{"%.2f"|format(rec.entry_price)}}</td><td>{{rec.status}}</td>
+<td>{% if rec.profit_loss_percent %}<span class="{% if rec.profit_loss_percent>0 %}text-success{% else %}text-danger{% endif %}">{{"%.2f"|format(rec.profit_loss_percent)}}%</span>{% else %}-{% endif %}</td>
+<td><a href="{{url_for('update_rec',rec_id=rec.id)}}" class="btn btn-secondary btn-sm">Update</a></td></tr>{% endfor %}'''
+
+TEMPLATES['add_rec.html'] = page('''<div class="card"><h1>Add Recommendation</h1>
+<form method="POST" enctype="multipart/form-data"><div class="grid-2">
+<div class="form-group"><label>Stock Name *</label><input type="text" name="stock_name" required class="form-control" placeholder="Reliance Industries"></div>
+<div class="form-group"><label>Symbol *</label><input type="text" name="stock_symbol" required class="form-control" placeholder="RELIANCE"></div></div>
+<div class="form-group"><label>Type *</label><select name="rec_type" required class="form-control"><option value="BUY">BUY</option><option value="SELL">SELL</option></select></div>
+<div class="grid-2">
+<div class="form-group"><label>Entry Price (₹) *</label><input type="number" step="0.01" name="entry_price" required min="0.01" class="form-control" placeholder="2500.00"></div>
+<div class="form-group"><label>Target (₹)</label><input type="number" step="0.01" name="target_price" class="form-control" placeholder="2650.00"></div></div>
+<div class="form-group"><label>Stop Loss (₹)</label><input type="number" step="0.01" name="stop_loss" class="form-control" placeholder="2450.00"></div>
+<div class="form-group"><label>Chart Screenshot</label><input type="file" name="chart_image" accept="image/*" class="form-control"></div>
+<div class="form-group"><label>Notes</label><textarea name="notes" class="form-control" placeholder="Analysis..."></textarea></div>
+<button type="submit" class="btn btn-primary" style="width:100%">Add Recommendation</button>
+<a href="{{url_for('admin_dashboard')}}" class="btn btn-secondary" style="width:100%">Cancel</a></form></div>''')
+
+TEMPLATES['update_rec.html'] = page('''<div class="card"><h1>Update: {{rec.stock_name}}</h1>
+<div style="background:#f8f9fa;padding:1rem;border-radius:8px;margin:1rem 0">
+<p><strong>Symbol:</strong> {{rec.stock_symbol}}</p><p><strong>Type:</strong> {{rec.recommendation_type}}</p>
+<p><strong>Entry:</strong> ₹{{"%.2f"|format(rec.entry_price)}}</p></div>
+<form method="POST"><div class="form-group"><label>Status *</label>
+<select name="status" required class="form-control">
+<option value="active" {% if rec.status=='active' %}selected{% endif %}>Active</option>
+<option value="closed" {% if rec.status=='closed' %}selected{% endif %}>Closed</option></select></div>
+<div class="form-group"><label>Exit Price (₹)</label>
+<input type="number" step="0.01" name="exit_price" class="form-control" value="{{rec.exit_price or ''}}" placeholder="Enter exit price">
+<small style="color:#666">P/L calculated automatically</small></div>
+<div class="grid-2"><div class="form-group"><label>Target (₹)</label>
+<input type="number" step="0.01" name="target_price" class="form-control" value="{{rec.target_price or ''}}"></div>
+<div class="form-group"><label>Stop Loss (₹)</label>
+<input type="number" step="0.01" name="stop_loss" class="form-control" value="{{rec.stop_loss or ''}}"></div></div>
+<div class="form-group"><label>Update Notes</label><textarea name="notes" class="form-control">{{rec.notes or ''}}</textarea></div>
+<button type="submit" class="btn btn-primary" style="width:100%">Update</button>
+<a href="{{url_for('admin_dashboard')}}" class="btn btn-secondary" style="width:100%">Cancel</a></form></div>
+{% if history %}<div class="card"><h2>History</h2><table><thead><tr><th>When (UTC)</th><th>Event</th><th>By</th><th>Changes</th></tr></thead><tbody>
+{% for e in history %}<tr><td>{{e.when}}</td><td>{{e.kind[4:]}}</td><td>{{e.actor_email or 'system'}}</td>
+<td>{% for k,v in e.data.items() %}{{k}}: {% if e.kind=='rec.new' %}{{v}}{% else %}{{v[0]}} → {{v[1]}}{% endif %}{% if not loop.last %}; {% endif %}{% endfor %}</td></tr>{% endfor %}
+</tbody></table></div>{% endif %}''')
+
+TEMPLATES['admin_settings.html'] = page('''<div class="card"><h1>Settings</h1></div>
+<div class="card"><h2>Logo Upload</h2>
+<form method="POST" enctype="multipart/form-data">
+<div class="form-group"><label>Upload Logo (PNG/JPG, 512x512px recommended)</label>
+<input type="file" name="logo" accept="image/*" class="form-control"></div>
+<button type="submit" class="btn btn-primary">Upload Logo</button></form>
+{% if logo_exists %}<p style="margin-top:1rem">Current logo: <img src="{{logo_url()}}" style="height:50px;border-radius:8px"></p>{% endif %}</div>
+<div class="card"><h2>App Settings</h2><form method="POST">
+<div class="form-group"><label>App Name</label><input type="text" name="app_name" value="{{settings.app_name}}" class="form-control"></div>
+<h3 style="margin-top:2rem">Company Details</h3>
+<div class="form-group"><label>Company Name</label><input type="text" name="company_name" value="{{settings.company_name}}" class="form-control"></div>
+<div class="form-group"><label>Address</label><input type="text" name="company_address" value="{{settings.company_address}}" class="form-control"></div>
+<div class="grid-2">
+<div class="form-group"><label>Phone</label><input type="text" name="company_phone" value="{{settings.company_phone}}" class="form-control"></div>
+<div class="form-group"><label>Email</label><input type="email" name="company_email" value="{{settings.company_email}}" class="form-control"></div></div>
+<div class="form-group"><label>GST Number</label><input type="text" name="gst_number" value="{{settings.gst_number}}" class="form-control"></div>
+<h3 style="margin-top:2rem">Subscription Pricing</h3><div class="grid-2">
+<div class="form-group"><label>Monthly Price (₹)</label><input type="number" name="monthly_price" value="{{settings.monthly_price}}" class="form-control"></div>
+<div class="form-group"><label>Quarterly Price (₹)</label><input type="number" name="quarterly_price" value="{{settings.quarterly_price}}" class="form-control"></div></div>
+<h3 style="margin-top:2rem">Razorpay Integration</h3><div class="grid-2">
+<div class="form-group"><label>Razorpay Key ID</label><input type="text" name="razorpay_key_id" value="{{settings.razorpay_key_id}}" class="form-control" placeholder="rzp_live_..."></div>
+<div class="form-group"><label>Razorpay Key Secret</label><input type="password" name="razorpay_key_secret" value="{{settings.razorpay_key_secret}}" class="form-control" placeholder="Secret key"></div></div>
+<button type="submit" class="btn btn-success" style="width:100%">Save All Settings</button></form></div>
+<div class="card"><h2>Discount Coupons</h2><a href="{{url_for('admin_coupons')}}" class="btn btn-primary">Manage Coupons</a></div>''')
+
+TEMPLATES['admin_coupons.html'] = page('''<div class="card"><h1>Discount Coupons</h1>
+<form method="POST"><div class="grid-2">
+<div class="form-group"><label>Coupon Code</label><input type="text" name="code" required class="form-control" placeholder="SAVE20"></div>
+<div class="form-group"><label>Discount %</label><input type="number" name="discount_percent" required class="form-control" placeholder="20"></div></div>
+<div class="grid-2">
+<div class="form-group"><label>Valid Until</label><input type="date" name="valid_until" class="form-control"></div>
+<div class="form-group"><label>Max Uses (0=unlimited)</label><input type="number" name="max_uses" value="0" class="form-control"></div></div>
+<button type="submit" class="btn btn-primary">Create Coupon</button></form></div>
+<div class="card"><h2>Active Coupons</h2><table><thead><tr><th>Code</th><th>Discount</th><th>Used</th><th>Valid Until</th><th>Status</th></tr></thead>
+<tbody id="couponRows">{% include 'coupon_rows.html' %}</tbody></table>{% include 'load_more.html' %}</div>
+<a href="{{url_for('admin_settings')}}" class="btn btn-secondary">Back to Settings</a>''')
+
+TEMPLATES['coupon_rows.html'] = '''{% for c in items %}<tr data-row><td><strong>{{c.code}}</strong></td><td>{{c.discount_percent}}% OFF</td>
+<td>{{c.current_uses}}/{% if c.max_uses==0 %}∞{% else %}{{c.max_uses}}{% endif %}</td>
+<td>{{c.valid_until or 'No expiry'}}</td><td>{% if c.active %}✅ Active{% else %}❌{% endif %}</td></tr>{% endfor %}'''
+
+TEMPLATES['admin_users.html'] = page('''<div class="card"><h1>Users</h1>{% set kind='users' %}{% include 'export_form.html' %}<table>
+<thead><tr><th>Email</th><th>Name</th><th>Subscription</th><th>Ends</th><th>Joined</th></tr></thead>
+<tbody id="userRows">{% include 'user_rows.html' %}</tbody></table>{% include 'load_more.html' %}</div>
+<a href="{{url_for('admin_dashboard')}}" class="btn btn-secondary">Back</a>''')
+
+TEMPLATES['user_rows.html'] = '''{% for u in items %}<tr data-row><td>{{u.email}}</td><td>{{u.name or '-'}}</td>
+<td>{{u.subscription_status}}</td><td>{{u.subscription_end_date or '-'}}</td><td>{{u.created_at[:10]}}</td></tr>{% endfor %}'''
+
+TEMPLATES['export_form.html'] = '''<form method="GET" action="{{url_for('export_csv', kind=kind)}}"><div class="grid-3">
+<div class="form-group"><label>From</label><input type="date" name="start" class="form-control"></div>
+<div class="form-group"><label>To</label><input type="date" name="end" class="form-control"></div>
+<div class="form-group"><label>&nbsp;</label><button type="submit" class="btn btn-secondary">Export {{kind}} (CSV)</button></div></div></form>'''
+
+TEMPLATES['admin_payments.html'] = page('''<div class="card"><h1>Payments</h1>
+<form method="GET" action="{{url_for('export_invoices')}}"><div class="grid-3">
+<div class="form-group"><label>From</label><input type="date" name="start" class="form-control"></div>
+<div class="form-group"><label>To</label><input type="date" name="end" class="form-control"></div>
+<div class="form-group"><label>&nbsp;</label><button type="submit" class="btn btn-primary">Export invoices (ZIP)</button>
+<button type="submit" formaction="{{url_for('export_csv', kind='payments')}}" class="btn btn-secondary">Payments (CSV)</button></div></div></form><table>
+<thead><tr><th>Date</th><th>Invoice</th><th>User</th><th>Plan</th><th>Amount</th><th>Coupon</th><th></th></tr></thead>
+<tbody id="paymentRows">{% include 'payment_rows.html' %}</tbody></table>{% include 'load_more.html' %}</div>
+<a href="{{url_for('admin_dashboard')}}" class="btn btn-secondary">Back</a>''')
+
+TEMPLATES['payment_rows.html'] = '''{% for pay in items %}<tr data-row><td>{{pay.created_at[:10]}}</td><td>{{pay.invoice_number}}</td>
+<td>{{pay.user_id}}</td><td>{{pay.plan_type}}</td><td>₹{{"%.2f"|format(pay.amount)}}</td><td>{{pay.coupon_code or '-'}}</td>
+<td><a href="/invoice/{{pay.id}}" class="btn btn-secondary btn-sm">PDF</a></td></tr>{% endfor %}'''
+
+# A paged list renders its rows template followed by this link. With JS the
+# base script fetches the next page with partial=1 and appends the rows to
+# the element named by data-target; without JS it is a plain next-page link.
+TEMPLATES['load_more.html'] = '''{% if next_cursor %}<a href="{{url_for(request.endpoint, cursor=next_cursor, **request.view_args)}}" class="btn btn-secondary load-more" data-target="{{target}}" style="width:100%">Load more</a>{% endif %}'''
+
+TEMPLATES['more.html'] = "{% include items_template %}{% include 'load_more.html' %}"
+
+TEMPLATES['import_recs.html'] = page('''<div class="card"><h1>Bulk Import</h1>
+<p>Upload a CSV (with a header row) or a JSONL file. Rows with <code>entry_price</code> add a recommendation:
+<code>stock_name, stock_symbol, rec_type, entry_price, target_price, stop_loss, notes</code>, plus optional
+<code>status, exit_price, created_at, closed_at</code> for past calls. Other rows close active calls:
+<code>id</code> or <code>stock_symbol</code>, <code>exit_price</code> and an optional <code>note</code>.</p>
+<form method="POST" enctype="multipart/form-data"><div class="form-group"><input type="file" name="file" accept=".csv,.jsonl,.ndjson" required class="form-control"></div>
+<button type="submit" class="btn btn-primary" style="width:100%">Import</button>
+<a href="{{url_for('admin_dashboard')}}" class="btn btn-secondary" style="width:100%">Back</a></form></div>
+{% if report and report.errors %}<div class="card"><h2>Rejected Rows ({{report.failed}})</h2><table><tr><th>Line</th><th>Problem</th></tr>
+{% for line, message in report.errors %}<tr><td>{{line}}</td><td>{{message}}</td></tr>{% endfor %}</table>
+{% if report.failed > report.errors|length %}<p>... and {{report.failed - report.errors|length}} more</p>{% endif %}</div>{% endif %}''')
+
+TEMPLATES['search.html'] = page('''<div class="card"><h1>🔍 Search Recommendations</h1><form method="GET">
+<div class="form-group"><input type="search" name="q" value="{{q}}" class="form-control" placeholder="Symbol, company or words from the notes" autofocus></div>
+<div class="grid-3"><div class="form-group"><select name="status" class="form-control"><option value="">Any status</option>
+<option value="active" {% if status=='active' %}selected{% endif %}>Active</option><option value="closed" {% if status=='closed' %}selected{% endif %}>Closed</option></select></div>
+<div class="form-group"><input type="date" name="start" value="{{start}}" class="form-control" title="From"></div>
+<div class="form-group"><input type="date" name="end" value="{{end}}" class="form-control" title="To"></div></div>
+<button type="submit" class="btn btn-primary">Search</button></form></div>
+{% if q %}<div class="card"><h2>{{items|length}} result{% if items|length!=1 %}s{% endif %}</h2>{% include 'dashboard_recs.html' %}</div>{% endif %}''')
+
+TEMPLATES['symbol.html'] = page('''<div class="card"><h1>{{symbol}} History</h1><div class="grid-3">
+<div class="stat-box"><div class="stat-number">{{stats.trades}}</div><div>Closed Trades</div></div>
+<div class="stat-box"><div class="stat-number">{{"%.0f"|format(stats.win_rate)}}%</div><div>Win Rate</div></div>
+<div class="stat-box"><div class="stat-number {% if stats.avg_pl>0 %}text-success{% endif %}">{{"%.2f"|format(stats.avg_pl)}}%</div><div>Avg Return</div></div></div></div>
+<div class="card"><h2>All Calls</h2><div id="symbolRecs">{% include 'dashboard_recs.html' %}</div>{% include 'load_more.html' %}</div>''')
+
+TEMPLATES['analytics.html'] = page('''<div class="card"><h1>📊 Monthly Analytics</h1><p>Performance for {{month}}</p></div>
+<div class="card"><h2>Your Capital</h2><div class="grid-2">
+<div class="stat-box"><div class="stat-number">₹{{"{:,.0f}".format(capital)}}</div><div>Total Capital</div></div>
+<div class="stat-box"><div class="stat-number">₹{{"{:,.0f}".format(capital*0.05)}}</div><div>Per Stock (5%)</div></div></div>
+<form method="POST" action="/update-capital"><div class="form-group"><label>Update Capital</label>
+<input type="number" name="capital" value="{{capital}}" class="form-control" placeholder="100000"></div>
+<button type="submit" class="btn btn-primary">Update</button></form></div>
+<div class="profit-calc"><h2 style="color:#fff">💰 Potential Monthly Profit</h2>
+<div style="font-size:2rem;margin:1rem 0">{% if potential>=0 %}+₹{{"{:,.2f}".format(potential)}}{% else %}-₹{{"{:,.2f}".format(abs(potential))}}{% endif %}</div>
+<p>Based on 5% capital per stock</p>
+<p><small>This month: {{total}} trades | {{wins}} profitable | {{"%.1f"|format((wins/total*100) if total>0 else 0)}}% win rate</small></p></div>
+<div class="card"><h2>Monthly Performance</h2><div class="grid-3">
+<div class="stat-box"><div class="stat-number">{{total}}</div><div>Trades</div></div>
+<div class="stat-box"><div class="stat-number">{{wins}}</div><div>Winners</div></div>
+<div class="stat-box"><div class="stat-number {% if avg>0 %}text-success{% endif %}">{{"%.2f"|format(avg)}}%</div><div>Avg Return</div></div></div></div>
+<div class="card"><h2>This Month's Trades</h2>
+{% for rec in monthly_recs %}{% set pl=rec.profit_loss_percent or 0 %}<div class="rec-card {% if pl>0 %}profit{% else %}loss{% endif %}">
+<h3>{{rec.stock_name}} ({{rec.stock_symbol}})</h3>
+<p><strong>Entry:</strong> ₹{{"%.2f"|format(rec.entry_price)}} | <strong>Exit:</strong> ₹{{"%.2f"|format(rec.exit_price or 0)}}</p>
+<p style="font-size:1.2rem"><strong>Result:</strong> <span class="{% if pl>0 %}text-success{% else %}text-danger{% endif %}">
+{{"%.2f"|format(pl)}}% {% if pl>0 %}📈{% else %}📉{% endif %}</span></p>
+<p><strong>Your Profit:</strong> ₹{{"{:,.2f}".format(rec.profit) if capital>0 else '0'}}</p></div>{% endfor %}</div>
+{% if sims %}<div class="card"><h2>🧪 If You Followed Every Call This Year</h2>
+<svg id="simChart" viewBox="0 0 600 200" preserveAspectRatio="none" style="width:100%;height:200px;background:#f8f9fa;border-radius:8px"><polyline fill="none" stroke="#667eea" stroke-width="2"/></svg>
+<table><tr><th>Sizing</th><th>Final</th><th>CAGR</th><th>Max DD</th><th>Sharpe</th></tr>
+{% for s in sims %}<tr data-sim="{{s.rule}}" style="cursor:pointer"><td>{{s.rule.replace('_',' ')}}</td><td>₹{{"{:,.0f}".format(s.final_equity)}} ({{"%+.1f"|format(s.total_return)}}%)</td>
+<td>{{"%.1f%%"|format(s.cagr) if s.cagr is not none else '–'}}</td><td>{{"%.1f"|format(s.max_drawdown)}}%</td><td>{{"%.2f"|format(s.sharpe) if s.sharpe is not none else '–'}}</td></tr>{% endfor %}</table>
+<p><small>Fixed % and compounding size each call at 5% of capital; Kelly sizing is capped at 25%. Past results do not guarantee future returns.</small></p></div>
+<script>(()=>{const line=document.querySelector('#simChart polyline');const draw=s=>{const e=s.curve.equity,lo=Math.min(...e),hi=Math.max(...e)||1;
+line.setAttribute('points',e.map((v,i)=>(i/Math.max(e.length-1,1)*600).toFixed(1)+','+(195-(v-lo)/((hi-lo)||1)*190).toFixed(1)).join(' '))};
+fetch('/analytics/simulate?start={{sims[0].curve.dates[0] if sims[0].curve.dates else ''}}').then(r=>r.json()).then(d=>{const by={};d.results.forEach(s=>by[s.rule]=s);draw(d.results[0]);
+document.querySelectorAll('[data-sim]').forEach(tr=>tr.onclick=()=>draw(by[tr.dataset.sim]))})})();</script>{% endif %}''')
+
+# Pages are compiled once at import; Jinja keeps the compiled objects in its
+# cache so a request only pays for rendering.
+app.jinja_loader = DictLoader(TEMPLATES)
+app.jinja_env.globals.update(int=int, abs=abs, chart_variants=CHART_VARIANTS, chart_url=chart_url, logo_url=logo_url, live_quote=live_quote, push_cursor=push_cursor)
+for _name in TEMPLATES:
+    app.jinja_env.get_template(_name)
+
+@app.context_processor
+def inject_layout():
+    return {'app_name': get_setting('app_name', 'TradingPro'), 'logo_exists': bool(get_setting('logo_version'))}
+
 # ═══════════════════ APPLICATION ROUTES ═══════════════════
 
 @app.route('/')
 def index():
     db = get_db()
     recs = db.execute('SELECT * FROM recommendations ORDER BY created_at DESC LIMIT 5').fetchall()
-    closed = db.execute("SELECT * FROM recommendations WHERE status='closed'").fetchall()
-    total = len(closed)
-    wins = len([t for t in closed if t['profit_loss_percent'] and t['profit_loss_percent'] > 0])
-    avg = sum([t['profit_loss_percent'] or 0 for t in closed]) / total if total > 0 else 0
-    stats = {'total_trades': total, 'winning_trades': wins, 'win_rate': (wins/total*100) if total>0 else 0, 'avg_return': avg}
-    db.close()
+    stats = get_rec_stats(db)
     
-    html = BASE_HTML.replace('{% block content %}{% endblock %}', '''<div class="card" style="text-align:center">
-<h1>Professional Swing Trading</h1><p style="font-size:1.1rem;color:#666;margin:1rem 0">Expert recommendations for Indian markets</p>
-{% if not session.user_id %}<a href="{{url_for('register')}}" class="btn btn-primary">Get Started</a>{% endif %}</div>
-<div class="card"><h2>Track Record</h2><div class="grid-3">
-<div class="stat-box"><div class="stat-number">{{stats.total_trades}}</div><div>Trades</div></div>
-<div class="stat-box"><div class="stat-number">{{stats.winning_trades}}</div><div>Winners</div></div>
-<div class="stat-box"><div class="stat-number {% if stats.avg_return>0 %}text-success{% endif %}">{{"%.2f"|format(stats.avg_return)}}%</div><div>Avg Return</div></div></div></div>
-<div class="card"><h2>Recent Recommendations</h2>
-{% for rec in recommendations %}<div class="rec-card {% if rec.status=='closed' and rec.profit_loss_percent %}{% if rec.profit_loss_percent>0 %}profit{% else %}loss{% endif %}{% endif %}">
-<div style="display:flex;justify-content:space-between"><h3>{{rec.stock_name}} ({{rec.stock_symbol}})</h3>
-<span class="badge badge-{{rec.recommendation_type.lower()}}">{{rec.recommendation_type}}</span></div>
-{% if session.subscription_status=='active' %}
-<p><strong>Entry:</strong> ₹{{"%.2f"|format(rec.entry_price)}} | <strong>Target:</strong> ₹{{"%.2f"|format(rec.target_price or 0)}} | <strong>SL:</strong> ₹{{"%.2f"|format(rec.stop_loss or 0)}}</p>
-{% if rec.status=='closed' and rec.profit_loss_percent %}
-<p style="font-size:1.2rem"><strong>Result:</strong> <span class="{% if rec.profit_loss_percent>0 %}text-success{% else %}text-danger{% endif %}">{{"%.2f"|format(rec.profit_loss_percent)}}% {% if rec.profit_loss_percent>0 %}📈{% else %}📉{% endif %}</span></p>{% endif %}
-{% if rec.chart_image %}<img src="/chart/{{rec.id}}" class="chart-img" onclick="window.open(this.src)">{% endif %}
-<div class="rec-disclaimer">📚 Educational only | Not financial advice</div>
-{% else %}<p style="text-align:center;padding:1rem;background:#f8f9fa;border-radius:8px">🔒 Subscribe to view</p>{% endif %}
-</div>{% endfor %}</div>''')
-    return render_template_string(html, recommendations=recs, stats=stats, app_name=get_setting('app_name','TradingPro'), logo_exists=os.path.exists('uploads/logo/logo.png'))
+    return render_template('index.html', recommendations=recs, stats=stats)
 
 @app.route('/login', methods=['GET','POST'])
 def login():
     if request.method=='POST':
         db=get_db()
         user=db.execute('SELECT * FROM users WHERE email=?',(request.form['email'],)).fetchone()
-        db.close()
         if user and check_password_hash(user['password'],request.form['password']):
-            session.update({'user_id':user['id'],'email':user['email'],'is_admin':user['is_admin'],'subscription_status':user['subscription_status']})
+            session.update({'user_id':user['id'],'email':user['email'],'is_admin':user['is_admin'],'subscription_status':user['subscription_status'],'capital':user['capital'] or 0})
             flash('Login successful! 🎉','success')
             return redirect(url_for('admin_dashboard' if user['is_admin'] else 'dashboard'))
         flash('Invalid credentials','danger')
-    html=BASE_HTML.replace('{% block content %}{% endblock %}','''<div class="card" style="max-width:400px;margin:2rem auto"><h2>Login</h2>
-<form method="POST"><div class="form-group"><label>Email:</label><input type="email" name="email" required class="form-control"></div>
-<div class="form-group"><label>Password:</label><input type="password" name="password" required class="form-control"></div>
-<button type="submit" class="btn btn-primary" style="width:100%">Login</button></form>
-<p style="text-align:center;margin-top:1rem">No account? <a href="{{url_for('register')}}">Register</a></p>
-<div style="background:#f8f9fa;padding:1rem;border-radius:8px;margin-top:1rem"><p><strong>Demo:</strong> admin@ugesh.com / admin@123</p></div></div>''')
-    return render_template_string(html,app_name=get_setting('app_name','TradingPro'),logo_exists=os.path.exists('uploads/logo/logo.png'))
+    return render_template('login.html')
 
 @app.route('/register', methods=['GET','POST'])
 def register():
@@ -472,21 +2812,13 @@ def register():
         try:
             db.execute('INSERT INTO users (email,password,name) VALUES (?,?,?)',
                       (request.form['email'],generate_password_hash(request.form['password']),request.form.get('name','')))
+            add_counter(db,'total_users',1)
             db.commit()
             flash('Registration successful!','success')
             return redirect(url_for('login'))
         except:
             flash('Email already registered','danger')
-        finally:
-            db.close()
-    html=BASE_HTML.replace('{% block content %}{% endblock %}','''<div class="card" style="max-width:400px;margin:2rem auto"><h2>Create Account</h2>
-<form method="POST"><div class="form-group"><label>Name:</label><input type="text" name="name" class="form-control"></div>
-<div class="form-group"><label>Email:</label><input type="email" name="email" required class="form-control"></div>
-<div class="form-group"><label>Password:</label><input type="password" name="password" required class="form-control"></div>
-<div class="form-group"><label>Confirm:</label><input type="password" name="confirm" required class="form-control"></div>
-<button type="submit" class="btn btn-primary" style="width:100%">Register</button></form>
-<p style="text-align:center;margin-top:1rem">Have account? <a href="{{url_for('login')}}">Login</a></p></div>''')
-    return render_template_string(html,app_name=get_setting('app_name','TradingPro'),logo_exists=os.path.exists('uploads/logo/logo.png'))
+    return render_template('register.html')
 
 @app.route('/logout')
 def logout():
@@ -499,191 +2831,157 @@ def logout():
 def dashboard():
     db=get_db()
     user=db.execute('SELECT * FROM users WHERE id=?',(session['user_id'],)).fetchone()
-    recs=[]
-    if user['subscription_status']=='active':
-        recs=db.execute('SELECT * FROM recommendations ORDER BY created_at DESC').fetchall()
+    active=subscription_active(user)
+    session['subscription_status']='active' if active else 'expired'
+    recs,next_cursor=[],None
+    if active:
+        recs,next_cursor=keyset_page(db,'recommendations',cursor=request.args.get('cursor'))
+    renew_soon=active and user['subscription_end_date']<=(datetime.now()+timedelta(days=REMINDER_DAYS)).strftime('%Y-%m-%d')
     payments=db.execute('SELECT * FROM payments WHERE user_id=? ORDER BY created_at DESC LIMIT 5',(session['user_id'],)).fetchall()
-    db.close()
-    html=BASE_HTML.replace('{% block content %}{% endblock %}','''<div class="card"><h1>Welcome! 👋</h1><p>{{session.email}}</p>
-{% if user.subscription_status=='active' %}<p style="color:#28a745;font-weight:bold;margin-top:1rem">✓ Active until {{user.subscription_end_date}}</p>
-{% else %}<div style="background:#fff3cd;padding:1rem;border-radius:8px;margin-top:1rem">
-<p style="color:#856404;font-weight:bold">⚠ No Active Subscription</p>
-<a href="{{url_for('subscribe')}}" class="btn btn-primary" style="margin-top:0.5rem">Subscribe Now</a></div>{% endif %}</div>
-{% if user.subscription_status=='active' %}<div class="card"><h2>Recommendations</h2>
-{% for rec in recommendations %}<div class="rec-card {% if rec.status=='closed' and rec.profit_loss_percent %}{% if rec.profit_loss_percent>0 %}profit{% else %}loss{% endif %}{% endif %}">
-<div style="display:flex;justify-content:space-between"><h3>{{rec.stock_name}} ({{rec.stock_symbol}})</h3>
-<span class="badge badge-{{rec.recommendation_type.lower()}}">{{rec.recommendation_type}}</span></div>
-<p><strong>Entry:</strong> ₹{{"%.2f"|format(rec.entry_price)}} | <strong>Target:</strong> ₹{{"%.2f"|format(rec.target_price or 0)}} | <strong>SL:</strong> ₹{{"%.2f"|format(rec.stop_loss or 0)}}</p>
-{% if rec.status=='closed' %}<p><strong>Exit:</strong> ₹{{"%.2f"|format(rec.exit_price)}} | <strong>Result:</strong>
-<span class="{% if rec.profit_loss_percent>0 %}text-success{% else %}text-danger{% endif %}">{{"%.2f"|format(rec.profit_loss_percent)}}% {% if rec.profit_loss_percent>0 %}📈{% else %}📉{% endif %}</span></p>{% endif %}
-{% if rec.chart_image %}<img src="/chart/{{rec.id}}" class="chart-img" onclick="window.open(this.src)">{% endif %}
-<div class="rec-disclaimer">📚 Educational only | Not financial advice</div></div>{% endfor %}</div>
-{% if payments %}<div class="card"><h2>Payment History</h2><table><tr><th>Date</th><th>Plan</th><th>Amount</th><th>Invoice</th></tr>
-{% for pay in payments %}<tr><td>{{pay.created_at[:10]}}</td><td>{{pay.plan_type}}</td><td>₹{{"%.2f"|format(pay.amount)}}</td>
-<td><a href="/invoice/{{pay.id}}" class="btn btn-secondary btn-sm">PDF</a></td></tr>{% endfor %}</table></div>{% endif %}
-{% endif %}''')
-    return render_template_string(html,user=user,recommendations=recs,payments=payments,app_name=get_setting('app_name','TradingPro'),logo_exists=os.path.exists('uploads/logo/logo.png'))
+    return paged_response('dashboard.html','dashboard_recs.html','recFeed',recs,next_cursor,user=user,payments=payments,
+                          active=active,renew_soon=renew_soon)
 
 @app.route('/subscribe', methods=['GET','POST'])
 @login_required
 def subscribe():
     if request.method=='POST':
         plan=request.form.get('plan','monthly')
-        coupon=request.form.get('coupon','').upper()
-        
-        monthly_price=int(get_setting('monthly_price','999'))
-        quarterly_price=int(get_setting('quarterly_price','2999'))
-        amount=monthly_price if plan=='monthly' else quarterly_price
-        original=amount
-        discount=0
-        
-        if coupon:
-            db=get_db()
-            c=db.execute('SELECT * FROM coupons WHERE code=? AND active=1',(coupon,)).fetchone()
-            if c and (not c['valid_until'] or c['valid_until']>=datetime.now().strftime('%Y-%m-%d')) and (c['max_uses']==0 or c['current_uses']<c['max_uses']):
-                discount=int(amount*c['discount_percent']/100)
-                amount-=discount
-                db.execute('UPDATE coupons SET current_uses=current_uses+1 WHERE id=?',(c['id'],))
-                db.commit()
-            db.close()
-        
-        days=30 if plan=='monthly' else 90
-        end_date=(datetime.now()+timedelta(days=days)).strftime('%Y-%m-%d')
-        invoice_num=f"INV-{datetime.now().strftime('%Y%m%d')}-{session['user_id']}"
-        
-        db=get_db()
-        db.execute('UPDATE users SET subscription_status=?, subscription_end_date=? WHERE id=?',('active',end_date,session['user_id']))
-        db.execute('INSERT INTO payments (user_id,amount,original_amount,discount_amount,plan_type,coupon_code,invoice_number) VALUES (?,?,?,?,?,?,?)',
-                  (session['user_id'],amount,original,discount,plan,coupon if discount else None,invoice_num))
-        db.commit()
-        db.close()
-        
+        coupon=request.form.get('coupon','').strip().upper()
+        try:
+            payment_id,end_date,discount,replayed=checkout(get_db(),session['user_id'],plan,coupon,request.form.get('checkout_key') or None)
+        except ValueError as e:
+            flash(str(e),'danger')
+            return redirect(url_for('subscribe'))
         session['subscription_status']='active'
+        if replayed:
+            flash(f'This order was already placed. Valid until {end_date}','warning')
+            return redirect(url_for('dashboard'))
+        invoice_queue.enqueue(payment_id)
+        if coupon and not discount:
+            flash(f'Coupon {coupon} is invalid or fully used; charged full price','warning')
         flash(f'Subscription activated! Valid until {end_date} 🎉','success')
         return redirect(url_for('dashboard'))
     
     monthly=get_setting('monthly_price','999')
     quarterly=get_setting('quarterly_price','2999')
-    html=BASE_HTML.replace('{% block content %}{% endblock %}','''<div class="card" style="text-align:center">
-<h1>Choose Your Plan</h1><p style="color:#666;margin:1rem 0">Start receiving professional recommendations</p></div>
-<div class="grid-2"><div class="card"><h3>Monthly</h3><h1 style="color:#667eea;font-size:2.5rem">₹{{monthly}}</h1><p style="color:#666">/month</p>
-<ul style="text-align:left;margin:1.5rem 0;list-style:none"><li>✓ All recommendations</li><li>✓ Performance tracking</li><li>✓ Full history</li></ul>
-<form method="POST"><input type="hidden" name="plan" value="monthly">
-<div class="form-group"><input type="text" name="coupon" class="form-control" placeholder="Coupon code (optional)"></div>
-<button type="submit" class="btn btn-primary" style="width:100%">Subscribe Monthly</button></form></div>
-<div class="card" style="border:3px solid #667eea"><span class="badge badge-buy">POPULAR</span><h3>Quarterly</h3>
-<h1 style="color:#667eea;font-size:2.5rem">₹{{quarterly}}</h1><p style="color:#666">/3 months</p>
-<p style="color:#28a745;font-weight:bold">Save {{((int(monthly)*3-int(quarterly))/int(monthly)/3*100)|int}}%</p>
-<ul style="text-align:left;margin:1.5rem 0;list-style:none"><li>✓ All recommendations</li><li>✓ Performance tracking</li><li>✓ Full history</li><li>✓ Priority support</li></ul>
-<form method="POST"><input type="hidden" name="plan" value="quarterly">
-<div class="form-group"><input type="text" name="coupon" class="form-control" placeholder="Coupon code (optional)"></div>
-<button type="submit" class="btn btn-primary" style="width:100%">Subscribe Quarterly</button></form></div></div>
-<div class="card" style="background:#f8f9fa"><p style="text-align:center"><strong>Note:</strong> Demo mode - instant activation for testing</p></div>''')
-    return render_template_string(html,monthly=monthly,quarterly=quarterly,app_name=get_setting('app_name','TradingPro'),logo_exists=os.path.exists('uploads/logo/logo.png'))
+    # the checkout key is single-use: a cached copy would replay the last order
+    resp=make_response(render_template('subscribe.html',monthly=monthly,quarterly=quarterly,checkout_key=secrets.token_urlsafe(16)))
+    resp.cache_control.no_store=True
+    return resp
 
 @app.route('/admin')
 @admin_required
 def admin_dashboard():
     db=get_db()
-    recs=db.execute('SELECT * FROM recommendations ORDER BY created_at DESC').fetchall()
-    users=db.execute('SELECT * FROM users WHERE is_admin=0').fetchall()
-    active=db.execute("SELECT COUNT(*) as cnt FROM users WHERE subscription_status='active'").fetchone()
-    db.close()
-    html=BASE_HTML.replace('{% block content %}{% endblock %}','''<div class="card"><h1 style="display:inline">Admin Dashboard</h1>
-<a href="{{url_for('add_rec')}}" class="btn btn-primary" style="float:right">+ Add New</a><div style="clear:both"></div></div>
-<div class="grid-3"><div class="card" style="text-align:center;background:#f8f9fa">
-<h3 style="color:#667eea;font-size:2rem">{{recommendations|length}}</h3><p>Total Recommendations</p></div>
-<div class="card" style="text-align:center;background:#f8f9fa"><h3 style="color:#28a745;font-size:2rem">{{active.cnt}}</h3><p>Active Subscribers</p></div>
-<div class="card" style="text-align:center;background:#f8f9fa"><h3 style="color:#667eea;font-size:2rem">{{users|length}}</h3><p>Total Users</p></div></div>
-<div class="card"><h2>All Recommendations</h2><table>
-<tr><th>Stock</th><th>Type</th><th>Entry</th><th>Status</th><th>Result</th><th>Action</th></tr>
-{% for rec in recommendations %}<tr><td><strong>{{rec.stock_name}}</strong><br><small>{{rec.stock_symbol}}</small></td>
-<td><span class="badge badge-{{rec.recommendation_type.lower()}}">{{rec.recommendation_type}}</span></td>
-<td>₹{{"%.2f"|format(rec.entry_price)}}</td><td>{{rec.status}}</td>
-<td>{% if rec.profit_loss_percent %}<span class="{% if rec.profit_loss_percent>0 %}text-success{% else %}text-danger{% endif %}">{{"%.2f"|format(rec.profit_loss_percent)}}%</span>{% else %}-{% endif %}</td>
-<td><a href="{{url_for('update_rec',rec_id=rec.id)}}" class="btn btn-secondary btn-sm">Update</a></td></tr>{% endfor %}
-</table></div>''')
-    return render_template_string(html,recommendations=recs,users=users,active=active,app_name=get_setting('app_name','TradingPro'),logo_exists=os.path.exists('uploads/logo/logo.png'))
+    recs,next_cursor=keyset_page(db,'recommendations',cursor=request.args.get('cursor'))
+    rec_count=get_counter(db,'total_recommendations')
+    user_count=get_counter(db,'total_users')
+    active={'cnt':get_counter(db,'active_subscribers')}
+    return paged_response('admin_dashboard.html','admin_rec_rows.html','adminRecRows',recs,next_cursor,
+                          rec_count=rec_count,user_count=user_count,active=active)
+
+@app.route('/admin/invoices/export')
+@admin_required
+def export_invoices():
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD, both inclusive; defaults to this month
+    today=datetime.now()
+    try:
+        start=datetime.strptime(request.args.get('start') or today.strftime('%Y-%m-01'),'%Y-%m-%d')
+        end=datetime.strptime(request.args.get('end') or today.strftime('%Y-%m-%d'),'%Y-%m-%d')
+    except ValueError:
+        flash('Invalid date range','danger')
+        return redirect(url_for('admin_payments'))
+    rows=get_db().execute('''SELECT p.*, u.name, u.email, u.phone FROM payments p JOIN users u ON p.user_id = u.id
+                             WHERE p.created_at >= ? AND p.created_at < ? ORDER BY p.created_at, p.id''',
+                          (start.strftime('%Y-%m-%d'),(end+timedelta(days=1)).strftime('%Y-%m-%d'))).fetchall()
+    name=f"invoices_{start.strftime('%Y%m%d')}_{end.strftime('%Y%m%d')}.zip"
+    return Response(invoice_zip_stream([dict(r) for r in rows],invoice_company()),mimetype='application/zip',
+                    headers={'Content-Disposition':f'attachment; filename={name}'})
+
+@app.route('/admin/users')
+@admin_required
+def admin_users():
+    users,next_cursor=keyset_page(get_db(),'users','is_admin=0',columns=USER_COLUMNS,cursor=request.args.get('cursor'))
+    return paged_response('admin_users.html','user_rows.html','userRows',users,next_cursor)
+
+@app.route('/admin/payments')
+@admin_required
+def admin_payments():
+    payments,next_cursor=keyset_page(get_db(),'payments',cursor=request.args.get('cursor'))
+    return paged_response('admin_payments.html','payment_rows.html','paymentRows',payments,next_cursor)
 
 @app.route('/admin/add', methods=['GET','POST'])
 @admin_required
 def add_rec():
     if request.method=='POST':
-        chart_filename=None
+        if not float(request.form.get('entry_price') or 0)>0:
+            flash('Entry price must be greater than zero','danger')
+            return redirect(url_for('add_rec'))
+        chart_filename,chart_width,chart_height=None,None,None
         if 'chart_image' in request.files:
             file=request.files['chart_image']
             if file and file.filename and allowed_file(file.filename):
-                filename=secure_filename(f"{request.form['stock_symbol']}_{int(datetime.now().timestamp())}.{file.filename.rsplit('.',1)[1].lower()}")
-                file.save(f"uploads/charts/{filename}")
-                chart_filename=filename
+                chart_filename,chart_width,chart_height=save_chart(file)
         
         db=get_db()
-        db.execute('''INSERT INTO recommendations (stock_name,stock_symbol,recommendation_type,entry_price,target_price,stop_loss,notes,chart_image)
-                     VALUES (?,?,?,?,?,?,?,?)''',
+        cur=db.execute('''INSERT INTO recommendations (stock_name,stock_symbol,recommendation_type,entry_price,target_price,stop_loss,notes,chart_image,chart_width,chart_height)
+                     VALUES (?,?,?,?,?,?,?,?,?,?)''',
                   (request.form['stock_name'],request.form['stock_symbol'],request.form['rec_type'],
                    float(request.form['entry_price']),float(request.form.get('target_price') or 0),
-                   float(request.form.get('stop_loss') or 0),request.form.get('notes',''),chart_filename))
+                   float(request.form.get('stop_loss') or 0),request.form.get('notes',''),chart_filename,chart_width,chart_height))
+        touch_row(db,'recommendations',cur.lastrowid)
+        add_counter(db,'total_recommendations',1)
+        log_event(db,'rec.new',cur.lastrowid,rec_fields(db.execute('SELECT * FROM recommendations WHERE id=?',(cur.lastrowid,)).fetchone()))
         db.commit()
-        db.close()
+        mtm_engine.invalidate()
         flash('Recommendation added! 🎉','success')
         return redirect(url_for('admin_dashboard'))
     
-    html=BASE_HTML.replace('{% block content %}{% endblock %}','''<div class="card"><h1>Add Recommendation</h1>
-<form method="POST" enctype="multipart/form-data"><div class="grid-2">
-<div class="form-group"><label>Stock Name *</label><input type="text" name="stock_name" required class="form-control" placeholder="Reliance Industries"></div>
-<div class="form-group"><label>Symbol *</label><input type="text" name="stock_symbol" required class="form-control" placeholder="RELIANCE"></div></div>
-<div class="form-group"><label>Type *</label><select name="rec_type" required class="form-control"><option value="BUY">BUY</option><option value="SELL">SELL</option></select></div>
-<div class="grid-2">
-<div class="form-group"><label>Entry Price (₹) *</label><input type="number" step="0.01" name="entry_price" required class="form-control" placeholder="2500.00"></div>
-<div class="form-group"><label>Target (₹)</label><input type="number" step="0.01" name="target_price" class="form-control" placeholder="2650.00"></div></div>
-<div class="form-group"><label>Stop Loss (₹)</label><input type="number" step="0.01" name="stop_loss" class="form-control" placeholder="2450.00"></div>
-<div class="form-group"><label>Chart Screenshot</label><input type="file" name="chart_image" accept="image/*" class="form-control"></div>
-<div class="form-group"><label>Notes</label><textarea name="notes" class="form-control" placeholder="Analysis..."></textarea></div>
-<button type="submit" class="btn btn-primary" style="width:100%">Add Recommendation</button>
-<a href="{{url_for('admin_dashboard')}}" class="btn btn-secondary" style="width:100%">Cancel</a></form></div>''')
-    return render_template_string(html,app_name=get_setting('app_name','TradingPro'),logo_exists=os.path.exists('uploads/logo/logo.png'))
+    return render_template('add_rec.html')
 
 @app.route('/admin/update/<int:rec_id>', methods=['GET','POST'])
 @admin_required
 def update_rec(rec_id):
     db=get_db()
+    rec=db.execute('SELECT * FROM recommendations WHERE id=?',(rec_id,)).fetchone()
+    if rec is None:
+        abort(404)
     if request.method=='POST':
         status=request.form['status']
         exit_price=float(request.form.get('exit_price') or 0)
         notes=request.form.get('notes','')
         
-        rec=db.execute('SELECT * FROM recommendations WHERE id=?',(rec_id,)).fetchone()
+        target=float(request.form['target_price'] or 0) if 'target_price' in request.form else rec['target_price']
+        stop=float(request.form['stop_loss'] or 0) if 'stop_loss' in request.form else rec['stop_loss']
         pl=None
         if status=='closed' and exit_price>0:
-            if rec['recommendation_type']=='BUY':
-                pl=((exit_price-rec['entry_price'])/rec['entry_price'])*100
-            else:
-                pl=((rec['entry_price']-exit_price)/rec['entry_price'])*100
+            pl=calc_pl(rec['recommendation_type'],rec['entry_price'],exit_price)
         
-        db.execute('''UPDATE recommendations SET status=?,exit_price=?,profit_loss_percent=?,notes=?,updated_at=CURRENT_TIMESTAMP WHERE id=?''',
-                  (status,exit_price,pl,notes,rec_id))
+        # updated_at is a closed trade's place in the track record, so it
+        # only moves when the trade itself does
+        trade_changed=(status,exit_price,pl)!=(rec['status'],rec['exit_price'],rec['profit_loss_percent'])
+        stamp='CURRENT_TIMESTAMP' if trade_changed or rec['status']!='closed' else 'updated_at'
+        db.execute(f'''UPDATE recommendations SET status=?,exit_price=?,profit_loss_percent=?,notes=?,target_price=?,stop_loss=?,updated_at={stamp} WHERE id=?''',
+                  (status,exit_price,pl,notes,target,stop,rec_id))
+        if rec['status']=='closed':
+            if trade_changed:
+                # reopening or re-pricing a closed trade can move best/worst/drawdown
+                rebuild_rec_stats(db)
+        elif status=='closed':
+            apply_closed_trade(db,rec['created_at'],pl)
+        touch_row(db,'recommendations',rec_id)
+        closing=status=='closed' and rec['status']!='closed'
+        changes=rec_changes(rec,db.execute('SELECT * FROM recommendations WHERE id=?',(rec_id,)).fetchone())
+        if changes:
+            log_event(db,'rec.close' if closing else 'rec.update',rec_id,changes)
         db.commit()
-        db.close()
+        mtm_engine.invalidate()
+        if 'closed' in (status,rec['status']):
+            analytics_cache.invalidate()
         flash('Updated!','success')
         return redirect(url_for('admin_dashboard'))
     
-    rec=db.execute('SELECT * FROM recommendations WHERE id=?',(rec_id,)).fetchone()
-    db.close()
-    html=BASE_HTML.replace('{% block content %}{% endblock %}','''<div class="card"><h1>Update: {{rec.stock_name}}</h1>
-<div style="background:#f8f9fa;padding:1rem;border-radius:8px;margin:1rem 0">
-<p><strong>Symbol:</strong> {{rec.stock_symbol}}</p><p><strong>Type:</strong> {{rec.recommendation_type}}</p>
-<p><strong>Entry:</strong> ₹{{"%.2f"|format(rec.entry_price)}}</p></div>
-<form method="POST"><div class="form-group"><label>Status *</label>
-<select name="status" required class="form-control">
-<option value="active" {% if rec.status=='active' %}selected{% endif %}>Active</option>
-<option value="closed" {% if rec.status=='closed' %}selected{% endif %}>Closed</option></select></div>
-<div class="form-group"><label>Exit Price (₹)</label>
-<input type="number" step="0.01" name="exit_price" class="form-control" value="{{rec.exit_price or ''}}" placeholder="Enter exit price">
-<small style="color:#666">P/L calculated automatically</small></div>
-<div class="form-group"><label>Update Notes</label><textarea name="notes" class="form-control">{{rec.notes or ''}}</textarea></div>
-<button type="submit" class="btn btn-primary" style="width:100%">Update</button>
-<a href="{{url_for('admin_dashboard')}}" class="btn btn-secondary" style="width:100%">Cancel</a></form></div>''')
-    return render_template_string(html,rec=rec,app_name=get_setting('app_name','TradingPro'),logo_exists=os.path.exists('uploads/logo/logo.png'))
+    return render_template('update_rec.html',rec=rec,history=rec_history(db,rec_id))
 
 @app.route('/admin/settings', methods=['GET','POST'])
 @admin_required
@@ -692,19 +2990,15 @@ def admin_settings():
         if 'logo' in request.files:
             file=request.files['logo']
             if file and file.filename and allowed_file(file.filename):
-                file.save('uploads/logo/logo.png')
+                file.save(LOGO_PATH)
+                set_setting('logo_version',str(int(time.time())))
                 flash('Logo uploaded!','success')
         else:
-            set_setting('app_name',request.form.get('app_name',''))
-            set_setting('company_name',request.form.get('company_name',''))
-            set_setting('company_address',request.form.get('company_address',''))
-            set_setting('company_phone',request.form.get('company_phone',''))
-            set_setting('company_email',request.form.get('company_email',''))
-            set_setting('gst_number',request.form.get('gst_number',''))
-            set_setting('monthly_price',request.form.get('monthly_price',''))
-            set_setting('quarterly_price',request.form.get('quarterly_price',''))
-            set_setting('razorpay_key_id',request.form.get('razorpay_key_id',''))
-            set_setting('razorpay_key_secret',request.form.get('razorpay_key_secret',''))
+            invoice_details=invoice_company()
+            set_settings({key:request.form.get(key,'') for key in ('app_name','company_name','company_address','company_phone',
+                          'company_email','gst_number','monthly_price','quarterly_price','razorpay_key_id','razorpay_key_secret')})
+            if invoice_company()!=invoice_details:
+                invoice_queue.enqueue_all()
             flash('Settings saved!','success')
         return redirect(url_for('admin_settings'))
     
@@ -714,31 +3008,7 @@ def admin_settings():
               'monthly_price':get_setting('monthly_price','999'),'quarterly_price':get_setting('quarterly_price','2999'),
               'razorpay_key_id':get_setting('razorpay_key_id',''),'razorpay_key_secret':get_setting('razorpay_key_secret','')}
     
-    html=BASE_HTML.replace('{% block content %}{% endblock %}','''<div class="card"><h1>Settings</h1></div>
-<div class="card"><h2>Logo Upload</h2>
-<form method="POST" enctype="multipart/form-data">
-<div class="form-group"><label>Upload Logo (PNG/JPG, 512x512px recommended)</label>
-<input type="file" name="logo" accept="image/*" class="form-control"></div>
-<button type="submit" class="btn btn-primary">Upload Logo</button></form>
-{% if logo_exists %}<p style="margin-top:1rem">Current logo: <img src="/logo-icon" style="height:50px;border-radius:8px"></p>{% endif %}</div>
-<div class="card"><h2>App Settings</h2><form method="POST">
-<div class="form-group"><label>App Name</label><input type="text" name="app_name" value="{{settings.app_name}}" class="form-control"></div>
-<h3 style="margin-top:2rem">Company Details</h3>
-<div class="form-group"><label>Company Name</label><input type="text" name="company_name" value="{{settings.company_name}}" class="form-control"></div>
-<div class="form-group"><label>Address</label><input type="text" name="company_address" value="{{settings.company_address}}" class="form-control"></div>
-<div class="grid-2">
-<div class="form-group"><label>Phone</label><input type="text" name="company_phone" value="{{settings.company_phone}}" class="form-control"></div>
-<div class="form-group"><label>Email</label><input type="email" name="company_email" value="{{settings.company_email}}" class="form-control"></div></div>
-<div class="form-group"><label>GST Number</label><input type="text" name="gst_number" value="{{settings.gst_number}}" class="form-control"></div>
-<h3 style="margin-top:2rem">Subscription Pricing</h3><div class="grid-2">
-<div class="form-group"><label>Monthly Price (₹)</label><input type="number" name="monthly_price" value="{{settings.monthly_price}}" class="form-control"></div>
-<div class="form-group"><label>Quarterly Price (₹)</label><input type="number" name="quarterly_price" value="{{settings.quarterly_price}}" class="form-control"></div></div>
-<h3 style="margin-top:2rem">Razorpay Integration</h3><div class="grid-2">
-<div class="form-group"><label>Razorpay Key ID</label><input type="text" name="razorpay_key_id" value="{{settings.razorpay_key_id}}" class="form-control" placeholder="rzp_live_..."></div>
-<div class="form-group"><label>Razorpay Key Secret</label><input type="password" name="razorpay_key_secret" value="{{settings.razorpay_key_secret}}" class="form-control" placeholder="Secret key"></div></div>
-<button type="submit" class="btn btn-success" style="width:100%">Save All Settings</button></form></div>
-<div class="card"><h2>Discount Coupons</h2><a href="{{url_for('admin_coupons')}}" class="btn btn-primary">Manage Coupons</a></div>''')
-    return render_template_string(html,settings=settings,app_name=get_setting('app_name','TradingPro'),logo_exists=os.path.exists('uploads/logo/logo.png'))
+    return render_template('admin_settings.html',settings=settings)
 
 @app.route('/admin/coupons', methods=['GET','POST'])
 @admin_required
@@ -749,81 +3019,737 @@ def admin_coupons():
                   (request.form.get('code').upper(),int(request.form.get('discount_percent')),
                    request.form.get('valid_until') or None,int(request.form.get('max_uses') or 0)))
         db.commit()
-        db.close()
         flash('Coupon created!','success')
         return redirect(url_for('admin_coupons'))
     
-    db=get_db()
-    coupons=db.execute('SELECT * FROM coupons ORDER BY created_at DESC').fetchall()
-    db.close()
-    html=BASE_HTML.replace('{% block content %}{% endblock %}','''<div class="card"><h1>Discount Coupons</h1>
-<form method="POST"><div class="grid-2">
-<div class="form-group"><label>Coupon Code</label><input type="text" name="code" required class="form-control" placeholder="SAVE20"></div>
-<div class="form-group"><label>Discount %</label><input type="number" name="discount_percent" required class="form-control" placeholder="20"></div></div>
-<div class="grid-2">
-<div class="form-group"><label>Valid Until</label><input type="date" name="valid_until" class="form-control"></div>
-<div class="form-group"><label>Max Uses (0=unlimited)</label><input type="number" name="max_uses" value="0" class="form-control"></div></div>
-<button type="submit" class="btn btn-primary">Create Coupon</button></form></div>
-<div class="card"><h2>Active Coupons</h2><table><tr><th>Code</th><th>Discount</th><th>Used</th><th>Valid Until</th><th>Status</th></tr>
-{% for c in coupons %}<tr><td><strong>{{c.code}}</strong></td><td>{{c.discount_percent}}% OFF</td>
-<td>{{c.current_uses}}/{% if c.max_uses==0 %}∞{% else %}{{c.max_uses}}{% endif %}</td>
-<td>{{c.valid_until or 'No expiry'}}</td><td>{% if c.active %}✅ Active{% else %}❌{% endif %}</td></tr>{% endfor %}
-</table></div><a href="{{url_for('admin_settings')}}" class="btn btn-secondary">Back to Settings</a>''')
-    return render_template_string(html,coupons=coupons,app_name=get_setting('app_name','TradingPro'),logo_exists=os.path.exists('uploads/logo/logo.png'))
+    coupons,next_cursor=keyset_page(get_db(),'coupons',cursor=request.args.get('cursor'))
+    return paged_response('admin_coupons.html','coupon_rows.html','couponRows',coupons,next_cursor)
+
+@app.route('/admin/db-stats')
+@admin_required
+def db_stats():
+    return jsonify(db_pool.stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get('Authorization')!=f'Bearer {METRICS_TOKEN}':
+        return '',401
+    pool=db_pool.stats()
+    cache=analytics_cache.stats()
+    gauges=[('db_pool_in_use','Pooled SQLite connections checked out.',pool['in_use']),
+            ('db_pool_idle','Pooled SQLite connections idle.',pool['idle']),
+            ('db_pool_opened','SQLite connections opened since start.',pool['opened']),
+            ('analytics_cache_hits','Analytics cache hits since start.',cache['hits']),
+            ('analytics_cache_misses','Analytics cache misses since start.',cache['misses']),
+            ('analytics_cache_entries','Analytics views held in the cache.',cache['entries']),
+            ('push_clients','Open event stream and long-poll clients.',rec_events.clients),
+            ('mtm_positions','Active recommendations tracked by the mark-to-market engine.',mtm_engine.stats()['positions'])]
+    return app.response_class(metrics.render(gauges),mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/cache-stats')
+@admin_required
+def cache_stats():
+    return jsonify({'analytics':analytics_cache.stats()})
 
 @app.route('/analytics')
 @login_required
 def analytics():
-    month=datetime.now().strftime('%Y-%m')
+    today=datetime.now().strftime('%Y-%m-%d')
+    month=today[:7]
+    cap=session_capital()
+    data=analytics_cache.get_or_build((month,cap,today),lambda: build_analytics(month,cap,today))
+    return render_template('analytics.html',month=month,capital=cap,**data)
+
+@app.route('/analytics/simulate')
+@login_required
+def simulate_json():
+    if not HAS_NUMPY:
+        return jsonify({'error':'numpy is not installed'}),503
+    args=request.args
+    try:
+        start=args.get('start') and datetime.strptime(args['start'],'%Y-%m-%d').strftime('%Y-%m-%d')
+        end=args.get('end') and datetime.strptime(args['end'],'%Y-%m-%d').strftime('%Y-%m-%d')
+        capital=float(args.get('capital') or 0)
+        pct=float(args.get('pct') or 5)
+        amount=float(args['amount']) if args.get('amount') else None
+        kelly_cap=float(args.get('kelly_cap') or 25)
+    except ValueError:
+        return jsonify({'error':'bad parameter'}),400
     db=get_db()
-    monthly=db.execute("SELECT * FROM recommendations WHERE strftime('%Y-%m',created_at)=? AND status='closed'",(month,)).fetchall()
-    user=db.execute('SELECT capital FROM users WHERE id=?',(session['user_id'],)).fetchone()
-    cap=user['capital'] or 0
-    
-    total=len(monthly)
-    wins=len([r for r in monthly if r['profit_loss_percent'] and r['profit_loss_percent']>0])
-    avg=sum([r['profit_loss_percent'] or 0 for r in monthly])/total if total>0 else 0
-    
-    potential=0
-    if cap>0 and total>0:
-        per_stock=cap*0.05
-        potential=sum([(per_stock*(r['profit_loss_percent']/100)) for r in monthly if r['profit_loss_percent']])
-    
-    db.close()
-    html=BASE_HTML.replace('{% block content %}{% endblock %}','''<div class="card"><h1>📊 Monthly Analytics</h1><p>Performance for {{month}}</p></div>
-<div class="card"><h2>Your Capital</h2><div class="grid-2">
-<div class="stat-box"><div class="stat-number">₹{{"{:,.0f}".format(capital)}}</div><div>Total Capital</div></div>
-<div class="stat-box"><div class="stat-number">₹{{"{:,.0f}".format(capital*0.05)}}</div><div>Per Stock (5%)</div></div></div>
-<form method="POST" action="/update-capital"><div class="form-group"><label>Update Capital</label>
-<input type="number" name="capital" value="{{capital}}" class="form-control" placeholder="100000"></div>
-<button type="submit" class="btn btn-primary">Update</button></form></div>
-<div class="profit-calc"><h2 style="color:#fff">💰 Potential Monthly Profit</h2>
-<div style="font-size:2rem;margin:1rem 0">{% if potential>=0 %}+₹{{"{:,.2f}".format(potential)}}{% else %}-₹{{"{:,.2f}".format(abs(potential))}}{% endif %}</div>
-<p>Based on 5% capital per stock</p>
-<p><small>This month: {{total}} trades | {{wins}} profitable | {{"%.1f"|format((wins/total*100) if total>0 else 0)}}% win rate</small></p></div>
-<div class="card"><h2>Monthly Performance</h2><div class="grid-3">
-<div class="stat-box"><div class="stat-number">{{total}}</div><div>Trades</div></div>
-<div class="stat-box"><div class="stat-number">{{wins}}</div><div>Winners</div></div>
-<div class="stat-box"><div class="stat-number {% if avg>0 %}text-success{% endif %}">{{"%.2f"|format(avg)}}%</div><div>Avg Return</div></div></div></div>
-<div class="card"><h2>This Month's Trades</h2>
-{% for rec in monthly_recs %}<div class="rec-card {% if rec.profit_loss_percent>0 %}profit{% else %}loss{% endif %}">
-<h3>{{rec.stock_name}} ({{rec.stock_symbol}})</h3>
-<p><strong>Entry:</strong> ₹{{"%.2f"|format(rec.entry_price)}} | <strong>Exit:</strong> ₹{{"%.2f"|format(rec.exit_price)}}</p>
-<p style="font-size:1.2rem"><strong>Result:</strong> <span class="{% if rec.profit_loss_percent>0 %}text-success{% else %}text-danger{% endif %}">
-{{"%.2f"|format(rec.profit_loss_percent)}}% {% if rec.profit_loss_percent>0 %}📈{% else %}📉{% endif %}</span></p>
-<p><strong>Your Profit:</strong> ₹{{"{:,.2f}".format((capital*0.05)*(rec.profit_loss_percent/100)) if capital>0 else '0'}}</p></div>{% endfor %}</div>''')
-    return render_template_string(html,month=month,capital=cap,potential=potential,total=total,wins=wins,avg=avg,monthly_recs=monthly,app_name=get_setting('app_name','TradingPro'),logo_exists=os.path.exists('uploads/logo/logo.png'))
+    if capital<=0:
+        capital=session_capital() or SIM_DEFAULT_CAPITAL
+    rules=SIZING_RULES if args.get('rule','all')=='all' else [args['rule']]
+    if any(rule not in SIZING_RULES for rule in rules):
+        return jsonify({'error':'rule must be one of '+', '.join(SIZING_RULES)+' or all'}),400
+    days,returns=trade_history.window(db,start,end)
+    return jsonify({'start':start,'end':end,
+                    'results':[simulate(days,returns,capital,rule,pct,amount,kelly_cap,start,end) for rule in rules]})
 
 @app.route('/update-capital', methods=['POST'])
 @login_required
 def update_capital():
     db=get_db()
-    db.execute('UPDATE users SET capital=? WHERE id=?',(float(request.form.get('capital',0)),session['user_id']))
+    capital=float(request.form.get('capital') or 0)
+    old=db.execute('SELECT capital FROM users WHERE id=?',(session['user_id'],)).fetchone()[0]
+    db.execute('UPDATE users SET capital=? WHERE id=?',(capital,session['user_id']))
+    if old!=capital:
+        log_event(db,'user.capital',session['user_id'],{'capital':[old,capital]})
     db.commit()
-    db.close()
+    session['capital']=capital
     flash('Capital updated!','success')
     return redirect(url_for('analytics'))
 
+# ═══════════════════ BULK IMPORT ═══════════════════
+
+# Streams a CSV or JSONL file of rows, each either a new recommendation
+# (has entry_price) or a close (id or stock_symbol, plus exit_price; a
+# symbol closes every active call on it). Rows are validated one by one and
+# written IMPORT_CHUNK at a time, each chunk in one write transaction, so a
+# bad row costs only its own line in the report. Back-catalogue rows may
+# carry status=closed, exit_price and created_at; those never were live, so
+# unlike new active calls and closes they don't go out on the push feed.
+# They also land in the past, which moves the drawdown history, so rec_stats
+# is rebuilt once at the end rather than applied trade by trade.
+
+IMPORT_CHUNK = 1000
+IMPORT_MAX_ERRORS = 1000
+IMPORT_INSERT_SQL = '''INSERT INTO recommendations (stock_name, stock_symbol, recommendation_type, entry_price, target_price, stop_loss,
+    notes, status, exit_price, profit_loss_percent, created_at, updated_at, row_version)
+    VALUES (?,?,?,?,?,?,?,?,?,?,COALESCE(?, CURRENT_TIMESTAMP),COALESCE(?, ?, CURRENT_TIMESTAMP),?)'''
+
+class ImportReport:
+    def __init__(self):
+        self.added = 0
+        self.closed = 0
+        self.failed = 0
+        self.backfilled = 0
+        self.errors = []
+
+    def fail(self, line, message):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append((line, message))
+
+    def as_dict(self):
+        return {'added': self.added, 'closed': self.closed, 'failed': self.failed,
+                'errors': [{'line': line, 'error': message} for line, message in self.errors]}
+
+def import_format(filename):
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+def read_import_rows(stream, fmt):
+    # Yields (line, row, error) from a text stream without reading it whole
+    if fmt == 'jsonl':
+        for line, text in enumerate(stream, 1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError as e:
+                yield line, None, f'invalid JSON: {e}'
+                continue
+            if isinstance(row, dict):
+                yield line, {str(k).strip().lower(): v for k, v in row.items()}, None
+            else:
+                yield line, None, 'expected a JSON object'
+        return
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, {(k or '').strip().lower(): v for k, v in row.items()}, None
+
+def import_field(row, *names):
+    for name in names:
+        value = row.get(name)
+        if value is not None and str(value).strip() != '':
+            return str(value).strip()
+    return None
+
+def import_price(row, name, required=False):
+    value = import_field(row, name)
+    if value is None:
+        if required:
+            raise ValueError(f'{name} is required')
+        return None
+    try:
+        price = float(value)
+    except ValueError:
+        raise ValueError(f'{name} is not a number: {value!r}')
+    if price < 0 or price != price or price == float('inf') or (required and price == 0):
+        raise ValueError(f'{name} must be a positive number')
+    return price
+
+def import_time(row, name):
+    value = import_field(row, name)
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=None, microsecond=0).isoformat(' ')
+    except ValueError:
+        raise ValueError(f'{name} is not a date: {value!r}')
+
+def parse_new_rec(row):
+    name, symbol = import_field(row, 'stock_name'), import_field(row, 'stock_symbol')
+    if not name or not symbol:
+        raise ValueError('stock_name and stock_symbol are required')
+    rec_type = (import_field(row, 'rec_type', 'recommendation_type') or '').upper()
+    if rec_type not in ('BUY', 'SELL'):
+        raise ValueError('rec_type must be BUY or SELL')
+    entry = import_price(row, 'entry_price', required=True)
+    status = (import_field(row, 'status') or 'active').lower()
+    if status not in ('active', 'closed'):
+        raise ValueError('status must be active or closed')
+    exit_price = import_price(row, 'exit_price')
+    pl = None
+    if status == 'closed':
+        if not exit_price:
+            raise ValueError('a closed recommendation needs exit_price')
+        pl = calc_pl(rec_type, entry, exit_price)
+    created_at = import_time(row, 'created_at')
+    return (name, symbol, rec_type, entry, import_price(row, 'target_price') or 0, import_price(row, 'stop_loss') or 0,
+            import_field(row, 'notes') or '', status, exit_price, pl, created_at, import_time(row, 'closed_at'), created_at)
+
+def parse_close(row):
+    rec_id, symbol = import_field(row, 'id', 'rec_id'), import_field(row, 'stock_symbol')
+    if rec_id is None and symbol is None:
+        raise ValueError('a close needs id or stock_symbol (a new recommendation needs entry_price)')
+    if rec_id is not None and not rec_id.isdigit():
+        raise ValueError(f'id is not a number: {rec_id!r}')
+    exit_price = import_price(row, 'exit_price', required=True)
+    return int(rec_id) if rec_id is not None else None, symbol, exit_price, import_field(row, 'note', 'notes')
+
+def import_chunk(db, chunk, report):
+    adds, closes = [], []
+    for line, row, error in chunk:
+        try:
+            if error:
+                raise ValueError(error)
+            if import_field(row, 'entry_price') is not None:
+                adds.append(parse_new_rec(row))
+            else:
+                closes.append((line, parse_close(row)))
+        except ValueError as e:
+            report.fail(line, str(e))
+    if not adds and not closes:
+        return
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        bump_version(db, 'recommendations')
+        version = get_version(db, 'recommendations')
+        # staged under -version so the search index takes them in one pass
+        db.executemany(IMPORT_INSERT_SQL, [(*rec, -version) for rec in adds])
+        add_counter(db, 'total_recommendations', len(adds))
+        if search_backend(db) == 'fts':
+            db.execute('''INSERT INTO recs_fts (rowid, stock_symbol, stock_name, notes)
+                          SELECT id, stock_symbol, stock_name, notes FROM recommendations WHERE row_version = ?''', (-version,))
+        db.execute('UPDATE recommendations SET row_version = ? WHERE row_version = ?', (version, -version))
+        # looked up under the write lock, so no other worker can close a
+        # rec between the status check and the UPDATE
+        updates, closing, before = [], set(), {}
+        for line, (rec_id, symbol, exit_price, note) in closes:
+            if rec_id is not None:
+                recs = db.execute('SELECT * FROM recommendations WHERE id=?', (rec_id,)).fetchall()
+                if not recs:
+                    report.fail(line, f'no recommendation {rec_id}')
+                    continue
+            else:
+                recs = db.execute("SELECT * FROM recommendations WHERE stock_symbol = ? COLLATE NOCASE AND status='active'", (symbol,)).fetchall()
+                if not recs:
+                    report.fail(line, f'no active recommendation for {symbol}')
+                    continue
+            for rec in recs:
+                if rec['status'] != 'active' or rec['id'] in closing:
+                    report.fail(line, f"recommendation {rec['id']} is already closed")
+                    continue
+                closing.add(rec['id'])
+                before[rec['id']] = rec
+                pl = calc_pl(rec['recommendation_type'], rec['entry_price'], exit_price)
+                notes = f"{rec['notes']}\n{note}" if rec['notes'] and note else (note or rec['notes'])
+                updates.append((exit_price, pl, notes, version, rec['id'], rec['created_at']))
+        # closes in one transaction share updated_at, and rebuild_rec_stats
+        # breaks that tie by id
+        updates.sort(key=lambda u: u[4])
+        db.executemany("""UPDATE recommendations SET status='closed', exit_price=?, profit_loss_percent=?, notes=?,
+                            updated_at=CURRENT_TIMESTAMP, row_version=? WHERE id=? AND status='active'""",
+                       [u[:5] for u in updates])
+        if updates:
+            apply_closed_trades(db, [(u[5], u[1]) for u in updates])
+        changed = db.execute('SELECT * FROM recommendations WHERE row_version = ?', (version,)).fetchall()
+        log_events(db, 'rec.new', [(rec['id'], rec_fields(rec)) for rec in changed if rec['id'] not in closing])
+        log_events(db, 'rec.close', [(rec['id'], rec_changes(before[rec['id']], rec)) for rec in changed if rec['id'] in closing])
+        db.commit()
+    except:
+        db.rollback()
+        raise
+    report.added += len(adds)
+    report.backfilled += sum(1 for rec in adds if rec[7] == 'closed')
+    report.closed += len(updates)
+
+def import_recs(db, rows, chunk_size=IMPORT_CHUNK):
+    report = ImportReport()
+    chunk = []
+    for item in rows:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            import_chunk(db, chunk, report)
+            chunk = []
+    if chunk:
+        import_chunk(db, chunk, report)
+    report.errors.sort()
+    if report.backfilled:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            rebuild_rec_stats(db)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+    if report.added or report.closed:
+        mtm_engine.invalidate()
+        analytics_cache.invalidate()
+    return report
+
+@app.route('/admin/import', methods=['GET','POST'])
+@admin_required
+def import_recs_page():
+    report=None
+    if request.method=='POST':
+        file=request.files.get('file')
+        if not file or not file.filename:
+            flash('Choose a CSV or JSONL file','danger')
+            return redirect(url_for('import_recs_page'))
+        stream=io.TextIOWrapper(file.stream,encoding='utf-8-sig',newline='')
+        try:
+            report=import_recs(get_db(),read_import_rows(stream,import_format(file.filename)))
+        except (UnicodeDecodeError,csv.Error) as e:
+            flash(f'Could not read the file: {e}','danger')
+            return redirect(url_for('import_recs_page'))
+        if request.args.get('format')=='json':
+            return jsonify(report.as_dict())
+        flash(f'{report.added} added, {report.closed} closed, {report.failed} rows rejected','warning' if report.failed else 'success')
+    return render_template('import_recs.html',report=report)
+
+@app.cli.command('import-recs')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+@click.option('--chunk-size', default=IMPORT_CHUNK, show_default=True)
+def import_recs_command(path, fmt, chunk_size):
+    """Add or close recommendations in bulk from a CSV or JSONL file."""
+    db = get_db()
+    migrate(db)
+    started = time.perf_counter()
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        report = import_recs(db, read_import_rows(f, fmt or import_format(path)), chunk_size)
+    for line, message in report.errors:
+        click.echo(f'line {line}: {message}', err=True)
+    if report.failed > len(report.errors):
+        click.echo(f'... and {report.failed - len(report.errors)} more', err=True)
+    print(f'{report.added} added, {report.closed} closed, {report.failed} rejected in {time.perf_counter() - started:.1f}s')
+    if report.failed:
+        raise SystemExit(1)
+
+# ═══════════════════ EXPORTS ═══════════════════
+
+# CSV exports for reporting. Rows go straight from the SQLite cursor to the
+# response a few hundred at a time, so memory stays flat however big the
+# table is. The files open cleanly in Excel: UTF-8 with a BOM, CRLF line
+# ends, and text cells that look like formulas are prefixed with a quote.
+# start/end filter on created_at and are both inclusive.
+
+EXPORT_FLUSH_ROWS = 500
+EXPORTS = {
+    'recommendations': (
+        ('id', 'created_at', 'updated_at', 'stock_symbol', 'stock_name', 'type', 'entry_price', 'target_price', 'stop_loss',
+         'status', 'exit_price', 'profit_loss_percent', 'notes'),
+        '''SELECT id, created_at, updated_at, stock_symbol, stock_name, recommendation_type, entry_price, target_price, stop_loss,
+                  status, exit_price, ROUND(profit_loss_percent, 2), notes
+           FROM recommendations WHERE created_at >= ? AND created_at < ? ORDER BY created_at, id'''),
+    'payments': (
+        ('id', 'created_at', 'invoice_number', 'user_id', 'name', 'email', 'plan', 'original_amount', 'coupon_code',
+         'discount_percent', 'discount_amount', 'amount_paid', 'status', 'payment_id'),
+        '''SELECT p.id, p.created_at, p.invoice_number, p.user_id, u.name, u.email, p.plan_type, COALESCE(p.original_amount, p.amount),
+                  p.coupon_code, c.discount_percent, COALESCE(p.discount_amount, 0), p.amount, p.status, p.payment_id
+           FROM payments p LEFT JOIN users u ON u.id = p.user_id LEFT JOIN coupons c ON c.code = p.coupon_code
+           WHERE p.created_at >= ? AND p.created_at < ? ORDER BY p.created_at, p.id'''),
+    'users': (
+        ('id', 'created_at', 'name', 'email', 'phone', 'subscription_status', 'subscription_end_date', 'subscribed_today',
+         'capital', 'payments', 'total_paid'),
+        '''SELECT u.id, u.created_at, u.name, u.email, u.phone, u.subscription_status, u.subscription_end_date,
+                  CASE WHEN u.subscription_status = 'active' AND u.subscription_end_date >= date('now', 'localtime') THEN 'yes' ELSE 'no' END,
+                  u.capital, (SELECT COUNT(*) FROM payments p WHERE p.user_id = u.id),
+                  (SELECT COALESCE(SUM(p.amount), 0) FROM payments p WHERE p.user_id = u.id)
+           FROM users u WHERE u.is_admin = 0 AND u.created_at >= ? AND u.created_at < ? ORDER BY u.created_at, u.id'''),
+}
+ROUTE_QUERIES += [(f'export.{kind}', sql, ('2024-01-01', '2024-02-01')) for kind, (_, sql) in EXPORTS.items()]
+
+def csv_cell(value):
+    if isinstance(value, str) and value[:1] in ('=', '+', '-', '@', '\t', '\r'):
+        return "'" + value
+    return value
+
+def csv_stream(header, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write('\ufeff')
+    writer.writerow(header)
+    for n, row in enumerate(rows, 1):
+        writer.writerow([csv_cell(v) for v in row])
+        if n % EXPORT_FLUSH_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+@app.route('/admin/export/<kind>.csv')
+@admin_required
+def export_csv(kind):
+    if kind not in EXPORTS:
+        return '', 404
+    try:
+        start=request.args.get('start') and datetime.strptime(request.args['start'],'%Y-%m-%d')
+        end=request.args.get('end') and datetime.strptime(request.args['end'],'%Y-%m-%d')
+    except ValueError:
+        flash('Invalid date range','danger')
+        return redirect(request.referrer or url_for('admin_dashboard'))
+    header,sql=EXPORTS[kind]
+    params=(start.strftime('%Y-%m-%d') if start else '',(end+timedelta(days=1)).strftime('%Y-%m-%d') if end else '9999')
+
+    def rows():
+        # the cursor is opened inside the stream, on the request's connection
+        yield from get_db().execute(sql,params)
+
+    span='_'.join(d.strftime('%Y%m%d') for d in (start,end) if d) or datetime.now().strftime('%Y%m%d')
+    return Response(stream_with_context(csv_stream(header,rows())),mimetype='text/csv',
+                    headers={'Content-Disposition':f'attachment; filename={kind}_{span}.csv'})
+
+# ═══════════════════ SEARCH ═══════════════════
+
+# recs_fts is an external-content FTS5 index over the text columns of
+# recommendations, kept in step by triggers; updates that only touch
+# prices or status don't fire them. Search terms are prefixes, so "REL"
+# finds RELIANCE. Exact symbol hits come first straight off
+# idx_recs_symbol; the rest are the newest SEARCH_WINDOW matches ranked by
+# which columns they matched in, newest first within a score. bm25() is
+# no use here: its IDF step walks the whole doclist of every term, which
+# for a common word is most of the table. Prefixes longer than the prefix
+# index have the same problem, so whole words are tried first and the
+# prefix query only runs when they don't fill the window. Without FTS5 the
+# search falls back to LIKE, which is fine for small tables. Rows inserted
+# with a negative row_version are staged by a bulk import, which indexes
+# them a chunk at a time (see import_chunk); the insert trigger skips them.
+#
+# With a status or date filter, walking matches newest first and dropping
+# the ones the filter rejects costs every match when it rejects most of
+# them, so both sides are counted (up to SEARCH_CHUNK) and the smaller one
+# drives. From the filter side, filtered_matches takes SEARCH_CHUNK ids at
+# a time off idx_recs_status_created or idx_recs_created and asks recs_fts
+# only for matches in that chunk's rowid range. A date range keeps those
+# ids close together; a status alone spreads them over the whole table,
+# so when both sides are large a status-only search walks the matches.
+
+SEARCH_LIMIT = 50
+SEARCH_WINDOW = int(os.environ.get('SEARCH_WINDOW', 200))
+SEARCH_CHUNK = 5000
+REC_SEARCH_DDL = (
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS recs_fts USING fts5(stock_symbol, stock_name, notes,
+       content='recommendations', content_rowid='id', prefix='2 3')''',
+    '''CREATE TRIGGER IF NOT EXISTS recs_fts_insert AFTER INSERT ON recommendations WHEN new.row_version >= 0 BEGIN
+       INSERT INTO recs_fts (rowid, stock_symbol, stock_name, notes) VALUES (new.id, new.stock_symbol, new.stock_name, new.notes); END''',
+    '''CREATE TRIGGER IF NOT EXISTS recs_fts_delete AFTER DELETE ON recommendations BEGIN
+       INSERT INTO recs_fts (recs_fts, rowid, stock_symbol, stock_name, notes) VALUES ('delete', old.id, old.stock_symbol, old.stock_name, old.notes); END''',
+    '''CREATE TRIGGER IF NOT EXISTS recs_fts_update AFTER UPDATE OF stock_symbol, stock_name, notes ON recommendations BEGIN
+       INSERT INTO recs_fts (recs_fts, rowid, stock_symbol, stock_name, notes) VALUES ('delete', old.id, old.stock_symbol, old.stock_name, old.notes);
+       INSERT INTO recs_fts (rowid, stock_symbol, stock_name, notes) VALUES (new.id, new.stock_symbol, new.stock_name, new.notes); END''',
+)
+
+def create_rec_search(db):
+    if not HAS_FTS5:
+        return False
+    for statement in REC_SEARCH_DDL:
+        db.execute(statement)
+    db.execute("INSERT INTO recs_fts (recs_fts) VALUES ('rebuild')")
+    return True
+
+_search_backend = None
+
+def search_backend(db):
+    global _search_backend
+    if _search_backend is None:
+        has_index = db.execute("SELECT 1 FROM sqlite_master WHERE name='recs_fts'").fetchone()
+        _search_backend = 'fts' if HAS_FTS5 and has_index else 'like'
+    return _search_backend
+
+def count_upto(db, sql, params, cap):
+    return db.execute(f'SELECT COUNT(*) FROM ({sql} LIMIT ?)', [*params, cap]).fetchone()[0]
+
+def filtered_matches(db, match, filters, params):
+    # newest SEARCH_WINDOW ids that pass the filters and match, see above;
+    # the intersection stays in SQL, building Python rows costs more
+    found, page = [], ()
+    order = 'ORDER BY r.created_at DESC, r.id DESC'
+    while len(found) < SEARCH_WINDOW:
+        chunk, chunk_params = filters, list(params)
+        if page:
+            chunk += ' AND (r.created_at, r.id) < (?, ?)'
+            chunk_params += page
+        edge = db.execute(f'SELECT r.created_at, r.id FROM recommendations r WHERE 1{chunk} {order} LIMIT 1 OFFSET ?',
+                          [*chunk_params, SEARCH_CHUNK - 1]).fetchone()
+        if edge:
+            chunk += ' AND (r.created_at, r.id) >= (?, ?)'
+            chunk_params += edge
+        low, high = db.execute(f'SELECT MIN(r.id), MAX(r.id) FROM recommendations r WHERE 1{chunk}', chunk_params).fetchone()
+        if low is None:
+            break
+        found += [r[0] for r in db.execute(f'''SELECT r.id FROM recommendations r WHERE 1{chunk} AND r.id IN (
+                                                 SELECT rowid FROM recs_fts WHERE recs_fts MATCH ? AND rowid BETWEEN ? AND ?)
+                                               {order} LIMIT ?''', [*chunk_params, match, low, high, SEARCH_WINDOW - len(found)])]
+        if not edge:
+            break
+        page = tuple(edge)
+    return found
+
+def search_recs(db, text, status=None, start=None, end=None, limit=SEARCH_LIMIT):
+    terms = re.findall(r'\w+', text.lower())[:8]
+    if not terms:
+        return []
+    filters, params = '', []
+    if status:
+        filters += ' AND r.status = ?'
+        params.append(status)
+    if start:
+        filters += ' AND r.created_at >= ?'
+        params.append(start)
+    if end:
+        filters += ' AND r.created_at < ?'
+        params.append((datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+    if search_backend(db) == 'fts':
+        exact = db.execute(f'''SELECT r.* FROM recommendations r INDEXED BY idx_recs_symbol WHERE r.stock_symbol = ? COLLATE NOCASE{filters}
+                                ORDER BY r.created_at DESC LIMIT ?''', [text.strip(), *params, limit]).fetchall()
+        seen = {r['id'] for r in exact}
+        score = ' + '.join('10 * (stock_symbol LIKE ?) + 4 * (instr(lower(stock_name), ?) > 0) + (instr(lower(notes), ?) > 0)' for _ in terms)
+        score_params = [p for t in terms for p in (f'{t}%', t, t)]
+        window_sql = f'''SELECT * FROM (
+                           SELECT r.* FROM recs_fts JOIN recommendations r ON r.id = recs_fts.rowid
+                           WHERE recs_fts MATCH ?{filters} ORDER BY recs_fts.rowid DESC LIMIT ?)
+                         ORDER BY {score} DESC, id DESC'''
+        # sizes of both sides, counted no further than needed to compare them
+        rows = filters and count_upto(db, f'SELECT 1 FROM recommendations r WHERE 1{filters}', params, SEARCH_CHUNK)
+        window, hits = [], None
+        for match in (' '.join(f'"{t}"' for t in terms), ' '.join(f'"{t}"*' for t in terms)):
+            if filters:
+                if not rows:
+                    break
+                last, hits = hits, count_upto(db, 'SELECT 1 FROM recs_fts WHERE recs_fts MATCH ?', [match], rows + 1)
+                if hits == last and hits <= rows:
+                    break  # the prefixes match nothing the whole words didn't
+            if filters and hits > rows and (rows < SEARCH_CHUNK or start or end):
+                ids = filtered_matches(db, match, filters, params)
+                marks = ','.join('?' * len(ids))
+                window = db.execute(f'SELECT * FROM recommendations WHERE id IN ({marks}) ORDER BY {score} DESC, created_at DESC, id DESC',
+                                    [*ids, *score_params]).fetchall() if ids else []
+            else:
+                window = db.execute(window_sql, [match, *params, SEARCH_WINDOW, *score_params]).fetchall()
+            if len(window) >= SEARCH_WINDOW:
+                break
+        return (exact + [r for r in window if r['id'] not in seen])[:limit]
+    like = ' AND '.join('(r.stock_symbol LIKE ? OR r.stock_name LIKE ? OR r.notes LIKE ?)' for _ in terms)
+    like_params = [p for t in terms for p in (f'{t}%', f'%{t}%', f'%{t}%')]
+    return db.execute(f'''SELECT r.* FROM recommendations r WHERE {like}{filters}
+                           ORDER BY r.stock_symbol = ? COLLATE NOCASE DESC, r.created_at DESC LIMIT ?''',
+                      [*like_params, *params, text.strip(), limit]).fetchall()
+
+def symbol_stats(db, symbol):
+    row = db.execute("""SELECT COUNT(*) AS trades, SUM(profit_loss_percent > 0) AS wins, AVG(profit_loss_percent) AS avg_pl,
+                          MAX(profit_loss_percent) AS best_pl, MIN(profit_loss_percent) AS worst_pl
+                          FROM recommendations WHERE stock_symbol = ? COLLATE NOCASE AND status = 'closed'""", (symbol,)).fetchone()
+    return {'trades': row['trades'], 'wins': row['wins'] or 0, 'avg_pl': row['avg_pl'] or 0,
+            'win_rate': (row['wins'] or 0) / row['trades'] * 100 if row['trades'] else 0,
+            'best_pl': row['best_pl'], 'worst_pl': row['worst_pl']}
+
+@app.route('/search')
+@login_required
+def search():
+    if not subscriber_allowed():
+        flash('Subscribe to search past recommendations','warning')
+        return redirect(url_for('subscribe'))
+    args=request.args
+    q=args.get('q','').strip()
+    status=args.get('status') if args.get('status') in ('active','closed') else None
+    try:
+        start=args.get('start') and datetime.strptime(args['start'],'%Y-%m-%d').strftime('%Y-%m-%d')
+        end=args.get('end') and datetime.strptime(args['end'],'%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        flash('Invalid date','danger')
+        start=end=None
+    results=search_recs(get_db(),q,status,start,end) if q else []
+    if args.get('format')=='json':
+        return jsonify({'items':[dict(r) for r in results]})
+    return render_template('search.html',q=q,status=status or '',start=start or '',end=end or '',items=results)
+
+@app.route('/symbol/<symbol>')
+@login_required
+def symbol_history(symbol):
+    if not subscriber_allowed():
+        flash('Subscribe to see symbol history','warning')
+        return redirect(url_for('subscribe'))
+    db=get_db()
+    recs,next_cursor=keyset_page(db,'recommendations','stock_symbol = ? COLLATE NOCASE',(symbol,),cursor=request.args.get('cursor'))
+    return paged_response('symbol.html','dashboard_recs.html','symbolRecs',recs,next_cursor,symbol=symbol.upper(),stats=symbol_stats(db,symbol))
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Create the full-text index if it is missing and rebuild it from recommendations."""
+    db = get_db()
+    migrate(db)
+    if create_rec_search(db):
+        db.commit()
+        print(f"Indexed {db.execute('SELECT COUNT(*) FROM recommendations').fetchone()[0]} recommendations")
+    else:
+        print('This SQLite build has no FTS5; search uses LIKE')
+
+# ═══════════════════ JSON API ═══════════════════
+
+# Read-only API for the PWA and mobile clients. List endpoints send rows as
+# arrays under one "columns" header and page by ?since=<cursor>, where the
+# cursor is "<row_version>.<id>" of the last row seen: pass back the cursor
+# of the previous response to get only rows that changed since. ETags come
+# from the per-table change counters, so an unchanged poll is a 304 that
+# never touches the table.
+
+API_PAGE_SIZE = 500
+API_MAX_PAGE_SIZE = 2000
+API_REC_COLUMNS = ('id', 'stock_name', 'stock_symbol', 'recommendation_type', 'entry_price', 'target_price', 'stop_loss',
+                   'status', 'exit_price', 'profit_loss_percent', 'notes', 'chart_image', 'chart_width', 'chart_height',
+                   'created_at', 'updated_at', 'row_version')
+API_PAYMENT_COLUMNS = ('id', 'invoice_number', 'amount', 'original_amount', 'discount_amount', 'plan_type', 'coupon_code',
+                       'status', 'created_at', 'row_version')
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+@app.errorhandler(ApiError)
+def api_error(e):
+    return jsonify({'error': str(e)}), e.status
+
+def api_json(payload):
+    return app.response_class(json.dumps(payload, separators=(',', ':'), default=str), mimetype='application/json')
+
+def api_etag(*parts):
+    # Versions plus everything else the body depends on, query string included
+    key = '|'.join(str(p) for p in parts + (request.query_string.decode(),))
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+def api_since():
+    value = request.args.get('since') or '0.0'
+    version, _, row_id = value.partition('.')
+    try:
+        return int(version), int(row_id or 0)
+    except ValueError:
+        raise ApiError('since must be a cursor from a previous response')
+
+def api_limit():
+    try:
+        return min(max(int(request.args.get('limit') or API_PAGE_SIZE), 1), API_MAX_PAGE_SIZE)
+    except ValueError:
+        raise ApiError('limit must be a number')
+
+def api_month():
+    month = request.args.get('month')
+    if month and not re.fullmatch(r'\d{4}-\d{2}', month):
+        raise ApiError('month must be YYYY-MM')
+    return month
+
+def delta_page(db, table, columns, where, params, since, limit):
+    rows = db.execute(f'''SELECT {', '.join(columns)} FROM {table} WHERE (row_version, id) > (?, ?) {where}
+                          ORDER BY row_version, id LIMIT ?''', (*since, *params, limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    cursor = f"{rows[-1]['row_version']}.{rows[-1]['id']}" if rows else '%d.%d' % since
+    return {'columns': columns, 'rows': [tuple(r) for r in rows], 'cursor': cursor, 'more': more}
+
+@app.route('/api/v1/recommendations')
+@api_login_required
+def api_recommendations():
+    # ?status=active|closed &symbol= &month=YYYY-MM &since= &limit=. With a
+    # filter, deltas only carry rows that match it now; mirror unfiltered
+    # if you need to see rows leave a filter.
+    if not subscriber_allowed():
+        raise ApiError('subscription required', 403)
+    since, limit, month = api_since(), api_limit(), api_month()
+    status, symbol = request.args.get('status'), request.args.get('symbol')
+    if status and status not in ('active', 'closed'):
+        raise ApiError('status must be active or closed')
+    where, params = '', []
+    for clause, value in (('status = ?', status), ('stock_symbol = ? COLLATE NOCASE', symbol), ('created_month = ?', month)):
+        if value:
+            where += ' AND ' + clause
+            params.append(value)
+    db = get_db()
+    version = get_version(db, 'recommendations')
+    return conditional_response(api_etag('recs', version),
+                                lambda: api_json(dict(delta_page(db, 'recommendations', API_REC_COLUMNS, where, params, since, limit), version=version)),
+                                private=True)
+
+@app.route('/api/v1/stats')
+def api_stats():
+    month = api_month()
+    db = get_db()
+    version = get_version(db, 'rec_stats')
+    return conditional_response(api_etag('stats', version),
+                                lambda: api_json(dict(get_rec_stats(db, month or 'all'), bucket=month or 'all', version=version)))
+
+@app.route('/api/v1/analytics')
+@api_login_required
+def api_analytics():
+    today = datetime.now().strftime('%Y-%m-%d')
+    month = api_month() or today[:7]
+    capital = session_capital()
+
+    def build():
+        data = analytics_cache.get_or_build((month, capital, today), lambda: build_analytics(month, capital, today))
+        rows = data['monthly_recs']
+        return api_json({'month': month, 'capital': capital, 'total': data['total'], 'wins': data['wins'],
+                         'avg': data['avg'], 'potential': data['potential'], 'sims': data['sims'],
+                         'columns': API_REC_COLUMNS + ('profit',),
+                         'rows': [[r[c] for c in API_REC_COLUMNS + ('profit',)] for r in rows]})
+    # month and today are resolved server-side, so a rollover must change the tag
+    return conditional_response(api_etag('analytics', get_version(get_db(), 'rec_stats'), capital, month, today), build, private=True)
+
+@app.route('/api/v1/payments')
+@api_login_required
+def api_payments():
+    since, limit = api_since(), api_limit()
+    db = get_db()
+    version = get_version(db, 'payments')
+    return conditional_response(api_etag('payments', version, session['user_id']),
+                                lambda: api_json(dict(delta_page(db, 'payments', API_PAYMENT_COLUMNS, 'AND user_id = ?', [session['user_id']], since, limit),
+                                                      version=version)),
+                                private=True)
+
+@app.route('/api/v1/events')
+@api_login_required
+def api_events():
+    # Admin feed of the event log; ?since=<seq> is the cursor of the last
+    # response. 410 means the rows after it were archived: start again from
+    # the tables and then follow the feed from the current seq.
+    if not session.get('is_admin'):
+        raise ApiError('admin only', 403)
+    try:
+        since = int(request.args.get('since') or 0)
+    except ValueError:
+        raise ApiError('since must be a cursor from a previous response')
+    kinds = tuple(k for k in request.args.get('kind', '').split(',') if k) or None
+    db = get_db()
+    limit = api_limit()
+    events = events_after(db, since, kinds, limit + 1)
+    if events is None:
+        raise ApiError(f'events up to {archived_seq(db)} are archived', 410)
+    more = len(events) > limit
+    events = events[:limit]
+    cursor = events[-1]['seq'] if events else since
+    return api_json({'events': events, 'cursor': cursor, 'more': more, 'latest': latest_event_seq(db)})
+
 # ═══════════════════ STARTUP ═══════════════════
 
 if __name__=='__main__':
@@ -0,0 +1,592 @@
+"""
+Benchmarks for the trading app.
+
+    python bench.py templates [--iterations 2000]
+    python bench.py checkout [--threads 32] [--buyers 400] [--max-uses 100]
+    python bench.py load [--users 2000] [--recs 5000] [--payments 3000] [--coupons 50]
+                         [--requests 200] [--concurrency 8] [--gunicorn] [--output run.json]
+    python bench.py compare baseline.json run.json
+    python bench.py import [--rows 100000] [--closes 1000] [--chunk-size 1000]
+    python bench.py push [--clients 2000]
+    python bench.py search [--rows 200000] [--iterations 50] [--target-ms 10]
+
+Runs against a throwaway database in a temporary directory, never against
+the trading.db next to app.py.
+"""
+
+import argparse
+import http.cookiejar
+import io
+import json
+import os
+import platform
+import random
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO)
+
+BENCH_EMAIL = 'bench@load'
+BENCH_PASSWORD = 'bench'
+LOAD_ROUTES = ('/', '/dashboard', '/analytics', '/subscribe', '/chart/{rec_id}', '/invoice/{payment_id}')
+
+
+def load_app(workdir=None):
+    # app.py creates uploads/ and trading.db relative to the working directory
+    os.chdir(workdir or tempfile.mkdtemp(prefix='trading-bench-'))
+    import app as trading
+    trading.init_db()
+    return trading
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def summarize(samples):
+    return {
+        'n': len(samples),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 4),
+        'p50_ms': round(percentile(samples, 50) * 1000, 4),
+        'p95_ms': round(percentile(samples, 95) * 1000, 4),
+        'p99_ms': round(percentile(samples, 99) * 1000, 4),
+    }
+
+
+def timed(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_templates(args):
+    from flask import render_template, render_template_string
+    trading = load_app()
+    recs = [{'id': i, 'stock_name': f'Stock {i}', 'stock_symbol': f'SYM{i}', 'recommendation_type': 'BUY',
+             'entry_price': 100.0 + i, 'target_price': 110.0 + i, 'stop_loss': 95.0 + i, 'status': 'closed',
+             'exit_price': 108.0 + i, 'profit_loss_percent': 8.0, 'chart_image': None} for i in range(5)]
+    stats = {'total_trades': 120, 'winning_trades': 80, 'win_rate': 66.7, 'avg_return': 3.2}
+    prefix = "{% extends 'base.html' %}{% block content %}"
+    body = trading.TEMPLATES['index.html'][len(prefix):-len('{% endblock %}')]
+
+    def legacy():
+        html = trading.BASE_HTML.replace('{% block content %}{% endblock %}', body)
+        render_template_string(html, recommendations=recs, stats=stats,
+                               app_name=trading.get_setting('app_name', 'TradingPro'),
+                               logo_exists=os.path.exists(trading.LOGO_PATH))
+
+    def registry():
+        render_template('index.html', recommendations=recs, stats=stats)
+
+    with trading.app.test_request_context('/'):
+        legacy()
+        registry()
+        results = {'legacy_replace_render_string': summarize(timed(legacy, args.iterations)),
+                   'compiled_registry': summarize(timed(registry, args.iterations))}
+    results['speedup_p50'] = round(results['legacy_replace_render_string']['p50_ms'] /
+                                   results['compiled_registry']['p50_ms'], 2)
+    return results
+
+
+def bench_checkout(args):
+    # Every buyer races for the same coupon and double-submits its order, so
+    # both the max_uses accounting and the idempotency keys are under load.
+    from werkzeug.security import generate_password_hash
+    trading = load_app()
+    with trading.app.app_context():
+        db = trading.get_db()
+        password = generate_password_hash('bench')
+        db.executemany('INSERT INTO users (email, password) VALUES (?, ?)',
+                       [(f'buyer{i}@bench', password) for i in range(args.buyers)])
+        db.execute('INSERT INTO coupons (code, discount_percent, max_uses) VALUES (?, ?, ?)', ('RUSH', 50, args.max_uses))
+        db.commit()
+        user_ids = [r[0] for r in db.execute("SELECT id FROM users WHERE email LIKE '%@bench' ORDER BY id")]
+
+    pending = list(user_ids)
+    lock = threading.Lock()
+    samples, replays, errors = [], [], []
+    start_line = threading.Barrier(args.threads)
+
+    def buyer():
+        start_line.wait()
+        while True:
+            with lock:
+                if not pending:
+                    return
+                user_id = pending.pop()
+            key = f'order-{user_id}'
+            with trading.app.app_context():
+                db = trading.get_db()
+                for _ in range(2):
+                    start = time.perf_counter()
+                    try:
+                        replayed = trading.checkout(db, user_id, 'monthly', 'RUSH', key)[3]
+                    except Exception as e:
+                        errors.append(repr(e))
+                        continue
+                    samples.append(time.perf_counter() - start)
+                    replays.append(replayed)
+
+    threads = [threading.Thread(target=buyer) for _ in range(args.threads)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with trading.app.app_context():
+        db = trading.get_db()
+        uses = db.execute("SELECT current_uses FROM coupons WHERE code='RUSH'").fetchone()[0]
+        payments = db.execute('SELECT COUNT(*) FROM payments').fetchone()[0]
+        discounted = db.execute("SELECT COUNT(*) FROM payments WHERE coupon_code='RUSH'").fetchone()[0]
+        active = trading.get_counter(db, 'active_subscribers')
+        numbers = [r[0] for r in db.execute('SELECT invoice_number FROM payments')]
+    sequence = sorted(int(n.rsplit('/', 1)[1]) for n in numbers)
+    expected_uses = min(args.buyers, args.max_uses)
+    checks = {'coupon_uses': uses == expected_uses, 'discounted_payments': discounted == expected_uses,
+              'one_payment_per_buyer': payments == args.buyers, 'replays': sum(replays) == args.buyers,
+              'active_counter': active == args.buyers, 'no_errors': not errors,
+              'unique_invoice_numbers': len(set(numbers)) == len(numbers)}
+    if trading.INVOICE_BLOCK_SIZE <= 1:
+        checks['gapless_invoice_numbers'] = sequence == list(range(1, len(sequence) + 1))
+    return {'threads': args.threads, 'buyers': args.buyers, 'max_uses': args.max_uses,
+            'coupon_uses': uses, 'discounted_payments': discounted, 'payments': payments,
+            'checkouts_per_sec': round(len(samples) / elapsed, 1), 'latency': summarize(samples),
+            'errors': errors[:5], 'checks': checks, 'ok': all(checks.values())}
+
+
+def bench_import(args):
+    # A back catalogue, two thirds already closed, then a batch of closes by
+    # id; checks the stats and search index agree with a full rebuild.
+    trading = load_app()
+    rng = random.Random(1)
+    start = datetime(2023, 1, 1)
+    path = os.path.join(os.getcwd(), 'import.csv')
+    with open(path, 'w', newline='') as f:
+        f.write('stock_name,stock_symbol,rec_type,entry_price,target_price,stop_loss,notes,status,exit_price,created_at\n')
+        for i in range(args.rows):
+            entry = round(rng.uniform(50, 3000), 2)
+            closed = i % 3 != 0
+            f.write(f"Stock {i % 2000},SYM{i % 2000},{rng.choice(('BUY', 'SELL'))},{entry},{round(entry * 1.08, 2)},"
+                    f"{round(entry * 0.95, 2)},imported call {i},{'closed' if closed else 'active'},"
+                    f"{round(entry * rng.uniform(0.9, 1.12), 2) if closed else ''},"
+                    f"{(start + timedelta(minutes=10 * i)).strftime('%Y-%m-%d %H:%M:%S')}\n")
+    with trading.app.app_context():
+        db = trading.get_db()
+        started = time.perf_counter()
+        with open(path, newline='') as f:
+            added = trading.import_recs(db, trading.read_import_rows(f, 'csv'), args.chunk_size)
+        import_seconds = time.perf_counter() - started
+        ids = [r[0] for r in db.execute("SELECT id FROM recommendations WHERE status='active' LIMIT ?", (args.closes,))]
+        rows = [(i, {'id': str(rec_id), 'exit_price': '100'}, None) for i, rec_id in enumerate(ids, 2)]
+        started = time.perf_counter()
+        closed = trading.import_recs(db, iter(rows), args.chunk_size)
+        close_seconds = time.perf_counter() - started
+        incremental = dict(db.execute("SELECT * FROM rec_stats WHERE bucket='all'").fetchone())
+        db.execute('BEGIN IMMEDIATE')
+        trading.rebuild_rec_stats(db)
+        db.commit()
+        rebuilt = dict(db.execute("SELECT * FROM rec_stats WHERE bucket='all'").fetchone())
+        indexed = db.execute("SELECT COUNT(*) FROM recs_fts WHERE recs_fts MATCH 'imported'").fetchone()[0] if trading.HAS_FTS5 else args.rows
+    checks = {'all_added': added.added == args.rows and not added.failed, 'all_closed': closed.closed == len(ids),
+              'stats_match_rebuild': all(abs((incremental[k] or 0) - (rebuilt[k] or 0)) < 1e-6 for k in rebuilt if k != 'bucket'),
+              'search_indexed': indexed == args.rows}
+    return {'rows': args.rows, 'chunk_size': args.chunk_size, 'import_seconds': round(import_seconds, 2),
+            'rows_per_sec': round(args.rows / import_seconds), 'closes': len(ids), 'close_seconds': round(close_seconds, 3),
+            'checks': checks, 'ok': all(checks.values())}
+
+
+SEARCH_WORDS = ('breakout', 'support', 'momentum', 'reversal', 'earnings', 'volume', 'pullback', 'gapfill')
+SEARCH_CASES = (
+    # (name, query, status, start, end)
+    ('symbol', 'SYM42', None, None, None),
+    ('common_word', 'breakout', None, None, None),
+    ('prefix', 'break', None, None, None),
+    ('common_active', 'breakout', 'active', None, None),
+    ('common_closed', 'momentum', 'closed', None, None),
+    ('common_week', 'support', None, '2024-03-04', '2024-03-10'),
+    ('common_closed_month', 'volume', 'closed', '2023-06-01', '2023-06-30'),
+    ('rare_closed', 'earnings reversal', 'closed', None, None),
+    ('prefix_active_month', 'pull', 'active', '2024-01-01', '2024-01-31'),
+    ('rejects_all', 'gapfill', 'closed', None, None),
+    ('empty_range', 'breakout', None, '2030-01-01', '2030-01-31'),
+)
+
+
+def bench_search(args):
+    # A catalogue where a few note words are very common, so text matches
+    # run to tens of thousands of rows, then text searches with and without
+    # status/date filters. 'gapfill' only appears on active calls, so
+    # searching it among closed ones matches nothing.
+    trading = load_app()
+    rng = random.Random(1)
+    start = datetime(2023, 1, 1)
+    rows = []
+    for i in range(args.rows):
+        entry = round(rng.uniform(50, 3000), 2)
+        closed = i % 3 != 0
+        words = [SEARCH_WORDS[0]] if rng.random() < 0.3 else []
+        words += rng.sample(SEARCH_WORDS[1:6], 2)
+        if not closed and rng.random() < 0.05:
+            words.append('gapfill')
+        if rng.random() < 0.1:
+            words.append('pullback')
+        row = {'stock_name': f'Stock {i % 2000}', 'stock_symbol': f'SYM{i % 2000}', 'rec_type': rng.choice(('BUY', 'SELL')),
+               'entry_price': str(entry), 'notes': ' '.join(words), 'status': 'closed' if closed else 'active',
+               'exit_price': str(round(entry * 1.05, 2)) if closed else '',
+               'created_at': (start + timedelta(minutes=7 * i)).strftime('%Y-%m-%d %H:%M:%S')}
+        rows.append((i + 2, row, None))
+    with trading.app.app_context():
+        db = trading.get_db()
+        trading.import_recs(db, iter(rows))
+        db.execute('ANALYZE')
+        cases = {}
+        for name, text, status, since, until in SEARCH_CASES:
+            found = len(trading.search_recs(db, text, status, since, until))
+            cases[name] = dict(summarize(timed(lambda: trading.search_recs(db, text, status, since, until), args.iterations)), results=found)
+    checks = {f'{name}_p95_under_{args.target_ms}ms': case['p95_ms'] < args.target_ms for name, case in cases.items()}
+    checks['rejects_all_is_empty'] = cases['rejects_all']['results'] == 0
+    return {'rows': args.rows, 'backend': trading._search_backend, 'cases': cases, 'checks': checks, 'ok': all(checks.values())}
+
+
+def seed_load_db(trading, args):
+    # Volumes are configurable; the bench user is an active subscriber with
+    # capital, a few payments and access to every page under test.
+    from werkzeug.datastructures import FileStorage
+    from werkzeug.security import generate_password_hash
+    rng = random.Random(args.seed)
+    now = datetime.now()
+    stamp = lambda days_ago: (now - timedelta(days=days_ago, seconds=rng.randint(0, 86399))).strftime('%Y-%m-%d %H:%M:%S')
+    with trading.app.app_context():
+        db = trading.get_db()
+        password = generate_password_hash(BENCH_PASSWORD)
+        end = (now + timedelta(days=30)).strftime('%Y-%m-%d')
+        db.execute('INSERT INTO users (email, password, name, subscription_status, subscription_end_date, capital) VALUES (?,?,?,?,?,?)',
+                   (BENCH_EMAIL, password, 'Bench', 'active', end, 100000))
+        db.executemany('INSERT INTO users (email, password, name, subscription_status, subscription_end_date, capital, created_at) VALUES (?,?,?,?,?,?,?)',
+                       [(f'user{i}@load', password, f'User {i}', rng.choice(('active', 'inactive', 'expired')),
+                         (now + timedelta(days=rng.randint(-60, 90))).strftime('%Y-%m-%d'), rng.choice((0, 50000, 200000)), stamp(rng.randint(0, 365)))
+                        for i in range(args.users)])
+        db.executemany('INSERT INTO coupons (code, discount_percent, max_uses, current_uses) VALUES (?,?,?,?)',
+                       [(f'LOAD{i}', rng.choice((10, 20, 50)), rng.choice((0, 100)), rng.randint(0, 50)) for i in range(args.coupons)])
+
+        chart = (None, None, None)
+        if trading.HAS_PIL:
+            image = trading.Image.new('RGB', (1600, 900), (240, 244, 248))
+            buf = io.BytesIO()
+            image.save(buf, 'PNG')
+            chart = trading.save_chart(FileStorage(io.BytesIO(buf.getvalue()), filename='seed.png'))
+        recs = []
+        for i in range(args.recs):
+            age = rng.randint(0, 365)
+            entry = round(rng.uniform(50, 3000), 2)
+            kind = rng.choice(('BUY', 'SELL'))
+            status = 'active' if age < 20 and rng.random() < 0.5 else 'closed'
+            exit_price = round(entry * (1 + rng.gauss(0.01, 0.06)), 2) if status == 'closed' else None
+            pl = trading.calc_pl(kind, entry, exit_price) if exit_price else None
+            created = stamp(age)
+            recs.append((f'Stock {i % 500}', f'SYM{i % 500}', kind, entry, round(entry * 1.1, 2), round(entry * 0.95, 2), status,
+                         exit_price, pl, f'Setup note {i}', *(chart if i % 10 == 0 else (None, None, None)),
+                         created, stamp(max(age - rng.randint(0, 20), 0)) if status == 'closed' else created))
+        db.executemany('''INSERT INTO recommendations (stock_name, stock_symbol, recommendation_type, entry_price, target_price, stop_loss,
+                          status, exit_price, profit_loss_percent, notes, chart_image, chart_width, chart_height, created_at, updated_at)
+                          VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', recs)
+
+        fy = trading.financial_year(now)
+        user_ids = [r[0] for r in db.execute('SELECT id FROM users ORDER BY id')]
+        bench_id = user_ids[0]
+        payments = []
+        for i in range(args.payments):
+            plan = rng.choice(('monthly', 'quarterly'))
+            price = 999 if plan == 'monthly' else 2999
+            payments.append((bench_id if i < 5 else rng.choice(user_ids), price, price, 0, plan,
+                             trading.format_invoice_number(fy, i + 1), stamp(rng.randint(0, 365))))
+        db.executemany('''INSERT INTO payments (user_id, amount, original_amount, discount_amount, plan_type, invoice_number, created_at)
+                          VALUES (?,?,?,?,?,?,?)''', payments)
+        db.execute('INSERT OR REPLACE INTO invoice_sequences (fy, last_value) VALUES (?, ?)', (fy, args.payments))
+        trading.rebuild_rec_stats(db)
+        trading.recount_active_subscribers(db)
+        trading.recount_row_totals(db)
+        db.commit()
+        rec_id = db.execute('SELECT id FROM recommendations WHERE chart_image IS NOT NULL LIMIT 1').fetchone()
+        payment_id = db.execute('SELECT id FROM payments WHERE user_id=? LIMIT 1', (bench_id,)).fetchone()
+    return {'rec_id': rec_id[0] if rec_id else 1, 'payment_id': payment_id[0] if payment_id else 1}
+
+
+def drive(make_fetch, paths, requests, concurrency):
+    # Each thread gets its own logged-in fetch(path) -> status callable
+    fetchers = [make_fetch() for _ in range(concurrency)]
+    results = {}
+    for label, path in paths:
+        samples, statuses, lock = [], {}, threading.Lock()
+        remaining = [requests]
+
+        def worker(fetch):
+            while True:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                start = time.perf_counter()
+                status = fetch(path)
+                elapsed = time.perf_counter() - start
+                with lock:
+                    samples.append(elapsed)
+                    statuses[status] = statuses.get(status, 0) + 1
+
+        fetchers[0](path)  # warm caches and lazy threads outside the timing
+        threads = [threading.Thread(target=worker, args=(fetch,)) for fetch in fetchers]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - started
+        results[label] = dict(summarize(samples), rps=round(len(samples) / wall, 1), statuses={str(k): v for k, v in statuses.items()})
+    return results
+
+
+def test_client_fetcher(trading):
+    def make():
+        client = trading.app.test_client()
+        client.post('/login', data={'email': BENCH_EMAIL, 'password': BENCH_PASSWORD})
+
+        def fetch(path):
+            resp = client.get(path, follow_redirects=True)
+            resp.get_data()
+            return resp.status_code
+        return fetch
+    return make
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workdir, workers, options=()):
+    # Sessions must survive hopping between workers, so pin the secret key
+    port = free_port()
+    env = dict(os.environ, SECRET_KEY='bench-secret-key', SCHEDULER_INTERVAL='0')
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', *options,
+                             '--pythonpath', REPO, '--log-level', 'warning', 'app:app'],
+                            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(base + '/manifest.json', timeout=1).read()
+            return proc, base
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError('gunicorn exited during startup')
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('gunicorn did not start within 30s')
+
+
+def http_fetcher(base):
+    def make():
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        opener.open(base + '/login', urllib.parse.urlencode({'email': BENCH_EMAIL, 'password': BENCH_PASSWORD}).encode()).read()
+
+        def fetch(path):
+            try:
+                with opener.open(base + path, timeout=30) as resp:
+                    resp.read()
+                    return resp.status
+            except urllib.error.HTTPError as e:
+                return e.code
+        return fetch
+    return make
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_load(args):
+    workdir = tempfile.mkdtemp(prefix='trading-load-')
+    trading = load_app(workdir)
+    ids = seed_load_db(trading, args)
+    paths = [(route, route.format(**ids)) for route in LOAD_ROUTES]
+    result = {'meta': {'revision': git_revision(), 'started_at': datetime.now().isoformat(timespec='seconds'),
+                       'python': platform.python_version(), 'users': args.users, 'recs': args.recs,
+                       'payments': args.payments, 'coupons': args.coupons, 'requests': args.requests,
+                       'concurrency': args.concurrency}}
+    result['test_client'] = drive(test_client_fetcher(trading), paths, args.requests, args.concurrency)
+    if args.gunicorn:
+        proc, base = start_gunicorn(workdir, args.workers)
+        try:
+            result['meta']['gunicorn_workers'] = args.workers
+            result['gunicorn'] = drive(http_fetcher(base), paths, args.requests, args.concurrency)
+        finally:
+            proc.terminate()
+            proc.wait(10)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+def worker_threads(proc):
+    # OS threads in gunicorn's (single) worker process
+    with open(f'/proc/{proc.pid}/task/{proc.pid}/children') as f:
+        worker = f.read().split()[0]
+    with open(f'/proc/{worker}/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('Threads:'))
+
+
+def bench_push(args):
+    # Holds --clients idle /events streams on one gevent worker, the way the
+    # Procfile runs it, then adds a recommendation and times the fan-out to
+    # every stream. Also checks a page still answers while they are open and
+    # that the worker did not grow a thread per client.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.clients * 2 + 256)), hard))
+    workdir = tempfile.mkdtemp(prefix='trading-push-')
+    load_app(workdir)
+    proc, base = start_gunicorn(workdir, 1, ('-k', 'gevent', '--worker-connections', str(args.clients + 100), '--graceful-timeout', '2'))
+    streams = []
+    try:
+        jar = http.cookiejar.CookieJar()
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+        opener.open(base + '/login', urllib.parse.urlencode({'email': 'admin@ugesh.com', 'password': 'admin@123'}).encode()).read()
+        cookie = '; '.join(f'{c.name}={c.value}' for c in jar)
+        host = urllib.parse.urlsplit(base).netloc
+        request = f'GET /events HTTP/1.1\r\nHost: {host}\r\nAccept: text/event-stream\r\nCookie: {cookie}\r\n\r\n'.encode()
+        selector = selectors.DefaultSelector()
+        received = {}
+        started = time.perf_counter()
+        for _ in range(args.clients):
+            sock = socket.create_connection(('127.0.0.1', int(host.rsplit(':', 1)[1])))
+            sock.sendall(request)
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ)
+            streams.append(sock)
+            received[sock] = b''
+
+        def pump(until, timeout):
+            deadline = time.monotonic() + timeout
+            while not until() and time.monotonic() < deadline:
+                for key, _ in selector.select(0.2):
+                    try:
+                        chunk = key.fileobj.recv(65536)
+                    except BlockingIOError:
+                        continue
+                    received[key.fileobj] += chunk
+            return until()
+
+        connected = pump(lambda: all(b'retry:' in data for data in received.values()), 60)
+        connect_seconds = time.perf_counter() - started
+        threads = worker_threads(proc)
+        page_times = []
+        for _ in range(20):
+            t = time.perf_counter()
+            opener.open(base + '/').read()
+            page_times.append(time.perf_counter() - t)
+        opener.open(base + '/admin/add', urllib.parse.urlencode({'stock_name': 'Push Bench', 'stock_symbol': 'PUSH', 'rec_type': 'BUY',
+                                                                  'entry_price': '100', 'target_price': '110', 'stop_loss': '95'}).encode()).read()
+        started = time.perf_counter()
+        delivered = pump(lambda: all(b'event: rec' in data for data in received.values()), 60)
+        fanout_seconds = time.perf_counter() - started
+        got = sum(1 for data in received.values() if b'event: rec' in data)
+    finally:
+        for sock in streams:
+            sock.close()
+        proc.terminate()
+        proc.wait(10)
+    checks = {'all_connected': connected, 'all_delivered': delivered,
+              'no_thread_per_client': threads < 50, 'page_p95_under_250ms': percentile(page_times, 95) < 0.25}
+    return {'clients': args.clients, 'connect_seconds': round(connect_seconds, 2), 'worker_threads': threads,
+            'page_while_connected': summarize(page_times), 'fanout_seconds': round(fanout_seconds, 3), 'delivered': got,
+            'checks': checks, 'ok': all(checks.values())}
+
+
+def bench_compare(args):
+    # Percentage change per mode and route; positive means slower / fewer rps
+    with open(args.baseline) as f:
+        before = json.load(f)
+    with open(args.run) as f:
+        after = json.load(f)
+    changes = {}
+    for mode in ('test_client', 'gunicorn'):
+        for route, new in after.get(mode, {}).items():
+            old = before.get(mode, {}).get(route)
+            if not old:
+                continue
+            change = lambda key: round((new[key] - old[key]) / old[key] * 100, 1) if old[key] else None
+            changes.setdefault(mode, {})[route] = {'p50_pct': change('p50_ms'), 'p95_pct': change('p95_ms'),
+                                                   'p99_pct': change('p99_ms'), 'rps_pct': change('rps')}
+    return {'baseline': before.get('meta', {}).get('revision'), 'run': after.get('meta', {}).get('revision'), 'changes': changes}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    templates = sub.add_parser('templates', help='index page render latency, legacy vs compiled registry')
+    templates.add_argument('--iterations', type=int, default=2000)
+    templates.set_defaults(func=bench_templates)
+    checkout = sub.add_parser('checkout', help='parallel coupon redemptions with double submits; checks exact accounting')
+    checkout.add_argument('--threads', type=int, default=32)
+    checkout.add_argument('--buyers', type=int, default=400)
+    checkout.add_argument('--max-uses', type=int, default=100)
+    checkout.set_defaults(func=bench_checkout)
+    load = sub.add_parser('load', help='seed a database and drive the main pages; p50/p95/p99 and rps per route')
+    load.add_argument('--users', type=int, default=2000)
+    load.add_argument('--recs', type=int, default=5000)
+    load.add_argument('--payments', type=int, default=3000)
+    load.add_argument('--coupons', type=int, default=50)
+    load.add_argument('--requests', type=int, default=200, help='requests per route')
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--seed', type=int, default=1)
+    load.add_argument('--gunicorn', action='store_true', help='also run the routes through a local gunicorn')
+    load.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    load.add_argument('--output', help='write the results here as JSON')
+    load.set_defaults(func=bench_load)
+    compare = sub.add_parser('compare', help='percentage change between two load results')
+    compare.add_argument('baseline')
+    compare.add_argument('run')
+    compare.set_defaults(func=bench_compare)
+    bulk = sub.add_parser('import', help='bulk CSV import of a back catalogue, then a batch close; checks stats and search')
+    bulk.add_argument('--rows', type=int, default=100000)
+    bulk.add_argument('--closes', type=int, default=1000)
+    bulk.add_argument('--chunk-size', type=int, default=1000)
+    bulk.set_defaults(func=bench_import)
+    push = sub.add_parser('push', help='idle /events streams on one gevent worker; fan-out time and threads held')
+    push.add_argument('--clients', type=int, default=2000)
+    push.set_defaults(func=bench_push)
+    search = sub.add_parser('search', help='text search latency with and without status/date filters')
+    search.add_argument('--rows', type=int, default=200000)
+    search.add_argument('--iterations', type=int, default=50)
+    search.add_argument('--target-ms', type=float, default=10.0)
+    search.set_defaults(func=bench_search)
+    args = parser.parse_args(argv)
+    result = args.func(args)
+    print(json.dumps(result, indent=2))
+    if result.get('ok') is False:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()